@@ -0,0 +1,77 @@
+"""
+Microbenchmark: metal column resolution + numeric coercion in pdf_export.py
+on wide lab exports.
+
+Compares the previous per-column loop (which rebuilt the flattened keyword
+list with sum(METAL_KEYWORDS.values(), []) for every column and coerced
+matches one by one) against resolve_metal_schema.
+
+    python benchmarks/bench_metal_schema.py --columns 500 --rows 2000
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pdf_export import METAL_KEYWORDS, map_columns_to_metals, resolve_metal_schema  # noqa: E402
+
+
+def make_wide_export(n_columns, n_rows, seed=0):
+    """Lab-export shaped frame: a few metal columns buried among many irrelevant ones (as strings, like Mongo reads)."""
+    rng = np.random.default_rng(seed)
+    data = {
+        'location': [f"S{i:05d}" for i in range(n_rows)],
+        'Latitude': rng.uniform(28.4, 28.5, n_rows),
+        'Longitude': rng.uniform(77.0, 77.1, n_rows),
+    }
+    for metal_col in ['pb_mg_l', 'as_mg_l', 'cd_mg_l', 'hg_mg_l', 'cr_mg_l', 'ni_mg_l', 'cu_mg_l', 'zn_mg_l']:
+        data[metal_col] = rng.gamma(2.0, 0.01, n_rows).astype(str)
+    for i in range(max(0, n_columns - len(data))):
+        data[f"param_{i:04d}_value"] = rng.normal(size=n_rows).astype(str)
+    return pd.DataFrame(data)
+
+
+def legacy_coerce(df):
+    for col in df.columns:
+        if any(kw in col.lower() for kw in sum(METAL_KEYWORDS.values(), [])):
+            df[col] = pd.to_numeric(df[col], errors='coerce')
+    return df, map_columns_to_metals(df)
+
+
+def best_of(fn, frame, repeat):
+    timings = []
+    for _ in range(repeat):
+        df = frame.copy()
+        start = time.perf_counter()
+        fn(df)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--columns', type=int, default=500)
+    parser.add_argument('--rows', type=int, default=2000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    frame = make_wide_export(args.columns, args.rows)
+    legacy = best_of(legacy_coerce, frame, args.repeat)
+    resolved = best_of(resolve_metal_schema, frame, args.repeat)
+
+    _, legacy_cols = legacy_coerce(frame.copy())
+    _, resolved_cols = resolve_metal_schema(frame.copy())
+    assert legacy_cols == resolved_cols, (legacy_cols, resolved_cols)
+
+    print(f"columns={frame.shape[1]} rows={frame.shape[0]}")
+    print(f"legacy loop          {legacy * 1000:9.2f} ms")
+    print(f"resolve_metal_schema {resolved * 1000:9.2f} ms  ({legacy / resolved:.1f}x)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,333 @@
+"""
+End-to-end load test: serves proj.app on a local port against a Mongo
+stand-in and drives a weighted mix of real HTTP traffic at a fixed
+concurrency, then reports p50/p95/p99 latency, throughput and error rate
+per endpoint.
+
+The database is mongomock (in-process; `pip install mongomock`) unless
+--mongo-uri points at a local mongod, in which case a fresh
+heavy_metal_loadtest_<timestamp> database is used and dropped afterwards.
+Either way it runs offline. Uploads are synthetic (see synthetic.py); each
+/process call sends new content unless --duplicate-share says otherwise.
+
+    python benchmarks/load_test.py --concurrency 8 --duration 60
+    python benchmarks/load_test.py --mix "process=1,geojson=5,predictions_data=2" --out load.json
+"""
+import argparse
+import inspect
+import itertools
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import synthetic  # noqa: E402
+import proj  # noqa: E402
+from werkzeug.serving import make_server  # noqa: E402
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Token traffic is spread over this many user ids (topped up before the run)
+LOAD_USERS = 50
+
+# operation -> relative weight in the default mix
+DEFAULT_MIX = {
+    "process": 1,
+    "geojson": 4,
+    "summary": 2,
+    "charts": 1,
+    "download_csv": 2,
+    "download_excel": 1,
+    "download_pdf_short": 1,
+    "predictions_data": 1,
+    "predictions_comparison": 2,
+    "predictions_sample_trend": 2,
+    "predictions_cluster_zones": 1,
+    "token_balance": 3,
+    "token_add": 1,
+    "token_deduct": 1,
+    "token_pricing": 1,
+}
+
+
+class Context:
+    """State shared by the workers: stored uploads, prediction site ids, upload bodies."""
+
+    def __init__(self, base_url, rows, seed, duplicate_share):
+        self.base_url, self.rows, self.duplicate_share = base_url, rows, duplicate_share
+        self.file_ids = []
+        self.site_ids = []
+        self.upload_seeds = itertools.count(seed * 1_000_000)
+        self.first_upload = None
+
+    def upload_body(self, rng):
+        if self.first_upload is not None and rng.random() < self.duplicate_share:
+            return self.first_upload
+        body = synthetic.make_upload(self.rows, missing=0.05, seed=next(self.upload_seeds)).to_csv(index=False).encode()
+        if self.first_upload is None:
+            self.first_upload = body
+        return body
+
+
+def multipart(fields, files):
+    """multipart/form-data body for urllib: fields {name: value}, files {name: (filename, bytes)}."""
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    for name, (filename, data) in files.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+                     f'Content-Type: text/csv\r\n\r\n'.encode() + data + b"\r\n")
+    parts.append(f"--{boundary}--\r\n".encode())
+    return b"".join(parts), f"multipart/form-data; boundary={boundary}"
+
+
+def _json(payload):
+    return json.dumps(payload).encode(), "application/json"
+
+
+def _user(rng):
+    return f"load-user-{rng.randrange(LOAD_USERS)}"
+
+
+# operation -> fn(ctx, rng) returning (method, path, body, content type)
+OPERATIONS = {
+    "process": lambda ctx, rng: ("POST", "/process", *multipart({"strategy": "half"},
+                                                                 {"file": ("load.csv", ctx.upload_body(rng))})),
+    "geojson": lambda ctx, rng: ("GET", f"/geojson/{rng.choice(ctx.file_ids)}", None, None),
+    "summary": lambda ctx, rng: ("GET", f"/summary/{rng.choice(ctx.file_ids)}", None, None),
+    "charts": lambda ctx, rng: ("GET", f"/charts/{rng.choice(ctx.file_ids)}", None, None),
+    "download_csv": lambda ctx, rng: ("GET", f"/download/{rng.choice(ctx.file_ids)}", None, None),
+    "download_excel": lambda ctx, rng: ("GET", f"/download_excel/{rng.choice(ctx.file_ids)}", None, None),
+    "download_pdf_short": lambda ctx, rng: ("GET", f"/download_pdf_short/{rng.choice(ctx.file_ids)}", None, None),
+    "download_pdf_long": lambda ctx, rng: ("GET", f"/download_pdf_long/{rng.choice(ctx.file_ids)}", None, None),
+    "predictions_data": lambda ctx, rng: ("GET", "/predictions/data", None, None),
+    "predictions_comparison": lambda ctx, rng: ("GET", "/predictions/comparison", None, None),
+    "predictions_spatial": lambda ctx, rng: ("GET", "/predictions/spatial-data", None, None),
+    "predictions_sample_trend": lambda ctx, rng: ("GET", f"/predictions/sample-trend/{rng.choice(ctx.site_ids)}",
+                                                  None, None),
+    "predictions_cluster_zones": lambda ctx, rng: ("GET", "/predictions/cluster-zones", None, None),
+    "token_balance": lambda ctx, rng: ("GET", f"/token/get-balance?user_id={_user(rng)}", None, None),
+    "token_add": lambda ctx, rng: ("POST", "/token/add", *_json({"user_id": _user(rng), "tokens": 10})),
+    "token_deduct": lambda ctx, rng: ("POST", "/token/deduct", *_json({"user_id": _user(rng), "tokens": 1})),
+    "token_pricing": lambda ctx, rng: ("GET", "/token/pricing", None, None),
+}
+
+
+def parse_mix(text):
+    if not text:
+        return dict(DEFAULT_MIX)
+    mix = {}
+    for item in text.split(","):
+        name, _, weight = item.strip().partition("=")
+        if name not in OPERATIONS:
+            raise SystemExit(f"unknown operation {name!r}; choose from {', '.join(OPERATIONS)}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def send(ctx, method, path, body, content_type, timeout):
+    """One request. Returns (status or None, response bytes, latency seconds, error or None)."""
+    request = urllib.request.Request(ctx.base_url + path, data=body, method=method)
+    if content_type:
+        request.add_header("Content-Type", content_type)
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            payload = response.read()
+            return response.status, payload, time.perf_counter() - start, None
+    except urllib.error.HTTPError as e:
+        payload = e.read()
+        return e.code, payload, time.perf_counter() - start, None
+    except Exception as e:
+        return None, b"", time.perf_counter() - start, repr(e)
+
+
+def patch_mongomock_bulk(mongomock):
+    """Newer pymongo passes sort= to the bulk builder, which mongomock's add_update does not take yet."""
+    builder = mongomock.collection.BulkOperationBuilder
+    if "sort" in inspect.signature(builder.add_update).parameters:
+        return
+    add_update = builder.add_update
+
+    def add_update_without_sort(self, *args, sort=None, **kwargs):
+        return add_update(self, *args, **kwargs)
+    builder.add_update = add_update_without_sort
+
+
+def open_database(mongo_uri):
+    """(database, cleanup) for the stand-in: mongomock, or a throwaway database on a local mongod."""
+    if mongo_uri:
+        from pymongo import MongoClient
+        client = MongoClient(mongo_uri, serverSelectionTimeoutMS=5000)
+        name = f"heavy_metal_loadtest_{datetime.utcnow():%Y%m%d%H%M%S}"
+        return client[name], lambda: client.drop_database(name)
+    try:
+        import mongomock
+    except ImportError:
+        raise SystemExit("mongomock is not installed: pip install mongomock, or pass --mongo-uri of a local mongod")
+    patch_mongomock_bulk(mongomock)
+    return mongomock.MongoClient()["heavy_metal_db"], lambda: None
+
+
+def bind_database(database):
+    """Point proj's module-level client / collections at the stand-in."""
+    proj.client = database.client
+    proj.db = database
+    proj.samples_collection = database["samples"]
+    proj.site_timeseries_collection = database["site_timeseries"]
+    proj.forecast_models_collection = database["forecast_models"]
+    proj.upload_hashes_collection = database["upload_hashes"]
+
+
+def run_workers(ctx, mix, concurrency, duration, max_requests, timeout, seed):
+    names, weights = list(mix), list(mix.values())
+    deadline = time.perf_counter() + duration
+    issued = itertools.count()
+
+    def worker(index):
+        rng = random.Random(seed * 1000 + index)
+        samples = []
+        while time.perf_counter() < deadline and (max_requests is None or next(issued) < max_requests):
+            op = rng.choices(names, weights)[0]
+            method, path, body, content_type = OPERATIONS[op](ctx, rng)
+            status, payload, latency, error = send(ctx, method, path, body, content_type, timeout)
+            if op == "process" and status == 200:
+                ctx.file_ids.append(json.loads(payload)["file_id"])
+            samples.append((op, latency, status, len(payload), error))
+        return samples
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        samples = [s for batch in pool.map(worker, range(concurrency)) for s in batch]
+    return samples, time.perf_counter() - start
+
+
+def summarize(samples, elapsed):
+    """Per-operation and overall latency percentiles, throughput and error rates."""
+    groups = {}
+    for sample in samples:
+        groups.setdefault(sample[0], []).append(sample)
+    groups["ALL"] = samples
+
+    report = {}
+    for op, group in groups.items():
+        latencies = np.array([s[1] for s in group]) * 1000
+        failures = [s for s in group if s[2] is None or s[2] >= 400]
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) if len(latencies) else (np.nan,) * 3
+        statuses = {}
+        for s in group:
+            key = str(s[2]) if s[2] is not None else "error"
+            statuses[key] = statuses.get(key, 0) + 1
+        report[op] = {
+            "requests": len(group),
+            "throughput_rps": len(group) / elapsed if elapsed else None,
+            "errors": len(failures),
+            "error_rate": len(failures) / len(group) if group else None,
+            "p50_ms": float(p50),
+            "p95_ms": float(p95),
+            "p99_ms": float(p99),
+            "max_ms": float(latencies.max()) if len(latencies) else None,
+            "mean_bytes": float(np.mean([s[3] for s in group])) if group else None,
+            "statuses": statuses,
+            "sample_errors": sorted({s[4] for s in failures if s[4]})[:3],
+        }
+    return report
+
+
+def print_report(report):
+    print(f"{'operation':28s} {'reqs':>6s} {'rps':>7s} {'err%':>6s} {'p50 ms':>9s} {'p95 ms':>9s} {'p99 ms':>9s}")
+    for op in sorted(report, key=lambda o: (o == "ALL", o)):
+        r = report[op]
+        print(f"{op:28s} {r['requests']:6d} {r['throughput_rps']:7.2f} {100 * r['error_rate']:6.1f} "
+              f"{r['p50_ms']:9.1f} {r['p95_ms']:9.1f} {r['p99_ms']:9.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds of traffic")
+    parser.add_argument("--requests", type=int, help="stop after this many requests")
+    parser.add_argument("--mix", help="operation=weight,... (default: %s)" % ",".join(f"{k}={v}" for k, v in DEFAULT_MIX.items()))
+    parser.add_argument("--rows", type=int, default=200, help="rows per synthetic upload")
+    parser.add_argument("--seed-uploads", type=int, default=4, help="uploads stored before the traffic starts")
+    parser.add_argument("--duplicate-share", type=float, default=0.0, help="share of /process calls resending one file")
+    parser.add_argument("--mongo-uri", help="local mongod to use instead of mongomock")
+    parser.add_argument("--port", type=int, default=0, help="0 picks a free port")
+    parser.add_argument("--timeout", type=float, default=120.0, help="per-request timeout in seconds")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--max-error-rate", type=float, help="exit non-zero when the overall error rate exceeds this")
+    parser.add_argument("--out", help="write the report as JSON here")
+    args = parser.parse_args()
+
+    mix = parse_mix(args.mix)
+    database, cleanup = open_database(args.mongo_uri)
+    bind_database(database)
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+
+    # Predictions endpoints read (and refreshes rewrite) the predictions CSV: work on a copy
+    workdir = tempfile.mkdtemp(prefix="hmpi-load-")
+    predictions_path = os.path.join(workdir, "predictions.csv")
+    source = os.path.join(REPO_DIR, "future_hmpi_predictions_2026.csv")
+    if os.path.exists(source):
+        shutil.copyfile(source, predictions_path)
+    else:
+        synthetic.make_predictions(50, seed=args.seed).to_csv(predictions_path, index=False)
+    proj.PREDICTIONS_FILE = predictions_path
+
+    server = make_server("127.0.0.1", args.port, proj.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    ctx = Context(f"http://127.0.0.1:{server.server_port}", args.rows, args.seed, args.duplicate_share)
+    ctx.site_ids = sorted(set(synthetic.pd.read_csv(predictions_path, usecols=["Sample_ID"])["Sample_ID"].astype(str)))
+
+    try:
+        rng = random.Random(args.seed)
+        for _ in range(args.seed_uploads):
+            status, payload, _, error = send(ctx, *OPERATIONS["process"](ctx, rng), args.timeout)
+            if status != 200:
+                raise SystemExit(f"seed upload failed: {status} {error or payload[:200]!r}")
+            ctx.file_ids.append(json.loads(payload)["file_id"])
+        for i in range(LOAD_USERS):
+            send(ctx, "POST", "/token/sync", *_json({"user_id": f"load-user-{i}", "tokens": 1000}), args.timeout)
+
+        print(f"{ctx.base_url}: {args.concurrency} workers, {args.duration:g}s, "
+              f"{'mongod' if args.mongo_uri else 'mongomock'}, {len(ctx.file_ids)} seed uploads")
+        samples, elapsed = run_workers(ctx, mix, args.concurrency, args.duration, args.requests, args.timeout, args.seed)
+    finally:
+        server.shutdown()
+        cleanup()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = summarize(samples, elapsed)
+    print_report(report)
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump({
+                "created_at": datetime.utcnow().isoformat() + "Z",
+                "config": dict(vars(args), mix=mix, elapsed_s=elapsed),
+                "environment": {"python": platform.python_version(), "cpu_count": os.cpu_count()},
+                "endpoints": report,
+            }, f, indent=2)
+        print(f"report -> {args.out}")
+    if args.max_error_rate is not None and report["ALL"]["error_rate"] > args.max_error_rate:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
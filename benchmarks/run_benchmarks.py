@@ -0,0 +1,213 @@
+"""
+Benchmark suite: times the hot paths of proj.py on seeded synthetic uploads
+(see synthetic.py) and writes the results as JSON for tracking over time.
+
+Per size it times CSV parsing, metal detection, cleaning, HMPI scoring, the
+whole processing pipeline, GeoJSON features, the per-sample charts, the Excel
+export, the long / short PDF reports and the predictions endpoints (through
+the Flask test client, against a generated predictions file). Cases that
+render per sample or per page run on at most their `max_rows` rows; the rows
+actually used are recorded with every result.
+
+    python benchmarks/run_benchmarks.py --sizes 1k,100k --missing 0.05 --ug-share 0.25
+    python benchmarks/run_benchmarks.py --sizes 10M --only "detect|compute|pipeline"
+
+Nothing here touches MongoDB.
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import synthetic  # noqa: E402
+import proj  # noqa: E402
+from werkzeug.datastructures import FileStorage  # noqa: E402
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+
+class Case:
+    """One timed function: setup(data) builds the arguments once, run(*args) is what gets timed."""
+
+    def __init__(self, name, run, setup, max_rows=None):
+        self.name, self.run, self.setup, self.max_rows = name, run, setup, max_rows
+
+
+def _csv_upload(data):
+    body = data["frame"].to_csv(index=False).encode()
+    return (lambda: FileStorage(stream=io.BytesIO(body), filename="bench.csv")),
+
+
+def _stored_frame(data):
+    """The frame the report / export endpoints rebuild from stored GeoJSON features."""
+    df_hmpi, metals, features, schema = proj.run_processing_pipeline(data["frame"].copy())
+    df = pd.DataFrame(features)
+    df = pd.concat([df.drop(columns=["all_metal_conc"]), pd.json_normalize(df["all_metal_conc"])], axis=1)
+    metal_cols = {m: m for m in df.columns if m in proj.STANDARD_LIMITS}
+    return proj.compute_hmpi_vectorized(df, metal_cols, unit_factors=schema["unit_factors"]), metal_cols, \
+        proj.compute_upload_summary(df_hmpi, metals)
+
+
+def _report_args(data):
+    df_hmpi, metal_cols, summary = _stored_frame(data)
+    return df_hmpi, "bench", "bench.csv", metal_cols, summary
+
+
+def _cleaned(data):
+    metal_cols = proj.detect_metal_columns(data["frame"])
+    return proj.preprocess_dataframe(data["frame"], "half", metal_cols)
+
+
+def _get(path):
+    def run(client, site_id):
+        url = path.format(site_id=site_id)
+        response = client.get(url)
+        assert response.status_code == 200, (url, response.status_code)
+        return response.get_data()
+    return run
+
+
+def _predictions_client(data):
+    return proj.app.test_client(), data["site_id"]
+
+
+CASES = [
+    Case("load_file", lambda make: proj.load_file(make()), _csv_upload),
+    Case("detect_metal_columns", proj.detect_metal_columns, lambda d: (d["frame"],)),
+    Case("preprocess_dataframe", lambda df: proj.preprocess_dataframe(df, "half"), lambda d: (d["frame"],)),
+    Case("compute_hmpi_vectorized", proj.compute_hmpi_vectorized, _cleaned),
+    Case("run_processing_pipeline", lambda df: proj.run_processing_pipeline(df, "half"), lambda d: (d["frame"],)),
+    Case("build_geojson_features", proj.build_geojson_features,
+         lambda d: proj.run_processing_pipeline(d["frame"].copy())[:2]),
+    Case("generate_sample_charts", proj.generate_sample_charts, lambda d: _stored_frame(d)[:2], max_rows=50),
+    Case("export_to_excel", lambda df: proj.export_to_excel(df, "bench.csv"),
+         lambda d: (_stored_frame(d)[0],), max_rows=100_000),
+    Case("generate_long_report_pdf", proj.generate_long_report_pdf, _report_args, max_rows=200),
+    Case("generate_short_report_pdf", proj.generate_short_report_pdf, _report_args, max_rows=5_000),
+    Case("GET /predictions/data", _get("/predictions/data"), _predictions_client, max_rows=10_000),
+    Case("GET /predictions/comparison", _get("/predictions/comparison"), _predictions_client, max_rows=10_000),
+    Case("GET /predictions/spatial-data", _get("/predictions/spatial-data"), _predictions_client, max_rows=2_000),
+    Case("GET /predictions/sample-trend", _get("/predictions/sample-trend/{site_id}"), _predictions_client,
+         max_rows=10_000),
+    Case("GET /predictions/cluster-zones", _get("/predictions/cluster-zones"), _predictions_client,
+         max_rows=10_000),
+]
+
+
+def time_case(case, args, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        case.run(*args)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, timeout=10,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+    }
+
+
+def run_size(n_rows, options, cases, repeat, predictions_path):
+    full = synthetic.make_upload(n_rows, **options)
+    results = []
+    for case in cases:
+        rows = min(n_rows, case.max_rows or n_rows)
+        data = {"frame": full if rows == n_rows else full.iloc[:rows].copy()}
+        if case.name.startswith("GET /predictions"):
+            predictions = synthetic.make_predictions(rows, seed=options["seed"])
+            predictions.to_csv(predictions_path, index=False)
+            proj.PREDICTIONS_FILE = predictions_path
+            data["site_id"] = predictions["Sample_ID"].iloc[0]
+        try:
+            args = case.setup(data)
+            timings = time_case(case, args, repeat)
+        except Exception as e:
+            print(f"  {case.name:34s} failed: {e!r}")
+            results.append({"name": case.name, "size": n_rows, "rows": rows, "error": repr(e)})
+            continue
+        median = statistics.median(timings)
+        results.append({
+            "name": case.name,
+            "size": n_rows,
+            "rows": rows,
+            "repeat": repeat,
+            "best_s": min(timings),
+            "median_s": median,
+            "mean_s": statistics.fmean(timings),
+            "rows_per_s": rows / median if median > 0 else None,
+            "timings_s": timings,
+        })
+        print(f"  {case.name:34s} rows={rows:<9d} median {median * 1000:10.2f} ms  best {min(timings) * 1000:10.2f} ms")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="1k,100k", help="comma-separated row counts, e.g. 1k,100k,10M")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--metals", default=",".join(synthetic.IN_CSV_METALS))
+    parser.add_argument("--missing", type=float, default=0.05)
+    parser.add_argument("--ug-share", type=float, default=0.0)
+    parser.add_argument("--silent-units", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--only", help="regex; run only the cases whose name matches")
+    parser.add_argument("--out", help="results JSON path (default benchmarks/results/<UTC timestamp>.json)")
+    args = parser.parse_args()
+
+    options = {
+        "metals": [m.strip() for m in args.metals.split(",") if m.strip()],
+        "missing": args.missing,
+        "ug_share": args.ug_share,
+        "silent_units": args.silent_units,
+        "seed": args.seed,
+    }
+    cases = [c for c in CASES if not args.only or re.search(args.only, c.name)]
+    sizes = [synthetic.parse_size(s) for s in args.sizes.split(",") if s.strip()]
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for n_rows in sizes:
+            print(f"size={n_rows}")
+            results.extend(run_size(n_rows, options, cases, args.repeat, os.path.join(tmp, "predictions.csv")))
+
+    created_at = datetime.utcnow()
+    out = args.out or os.path.join(RESULTS_DIR, created_at.strftime("%Y%m%d-%H%M%S") + ".json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, "w") as f:
+        json.dump({
+            "created_at": created_at.isoformat() + "Z",
+            "environment": environment(),
+            "dataset": dict(options, sizes=sizes),
+            "results": results,
+        }, f, indent=2)
+    print(f"results -> {out}")
+
+
+if __name__ == "__main__":
+    main()
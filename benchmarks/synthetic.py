@@ -0,0 +1,146 @@
+"""
+Seeded synthetic uploads shaped like in.csv (Sample_ID, Latitude, Longitude,
+one <Sym>_mg_L column per metal), for benchmarks at sizes the sample files
+cannot reach.
+
+Concentrations are log-normal per metal with the log-mean / log-std of
+in.csv (Iron and Manganese, absent there, use typical groundwater levels);
+coordinates fall in the in.csv bounding box. Missingness, the metal subset
+and the unit mix (share of columns reported in µg/L, with or without a unit
+in the header) are configurable. The same arguments always give the same
+file.
+
+    python benchmarks/synthetic.py --rows 100000 --missing 0.05 --ug-share 0.25 --out upload.csv
+"""
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+# metal -> (header symbol, log-mean, log-std) of the mg/L concentration
+METAL_PROFILE = {
+    "Arsenic": ("As", -4.298, 0.779),
+    "Cadmium": ("Cd", -5.663, 0.775),
+    "Chromium": ("Cr", -2.750, 0.765),
+    "Copper": ("Cu", 0.454, 0.525),
+    "Lead": ("Pb", -4.129, 1.030),
+    "Mercury": ("Hg", -7.242, 1.032),
+    "Nickel": ("Ni", -2.522, 0.711),
+    "Zinc": ("Zn", 1.607, 0.603),
+    "Iron": ("Fe", -1.200, 0.800),
+    "Manganese": ("Mn", -2.500, 0.800),
+}
+IN_CSV_METALS = ("Arsenic", "Cadmium", "Chromium", "Copper", "Lead", "Mercury", "Nickel", "Zinc")
+
+LATITUDE_RANGE = (28.4350, 28.4950)
+LONGITUDE_RANGE = (77.0112, 77.0490)
+
+# Rows generated per block; a block's values depend only on (seed, block number)
+BLOCK_ROWS = 1_000_000
+
+
+def parse_size(text):
+    """'1k' -> 1000, '100k' -> 100000, '10M' -> 10000000."""
+    text = str(text).strip().lower()
+    scale = {"k": 1_000, "m": 1_000_000}.get(text[-1:], 1)
+    return int(float(text[:-1] if scale > 1 else text) * scale)
+
+
+def metal_headers(metals=IN_CSV_METALS, ug_share=0.0, silent_units=False, seed=0):
+    """
+    Header and factor (value multiplier from mg/L) per metal. ug_share of the
+    metals are reported in µg/L; silent_units drops the unit from those headers
+    so the upload has to fall back to value-based unit detection.
+    """
+    rng = np.random.default_rng([seed, 1])
+    metals = list(metals)
+    in_ug = set(rng.choice(metals, size=int(round(ug_share * len(metals))), replace=False)) if metals else set()
+    headers = {}
+    for metal in metals:
+        symbol = METAL_PROFILE[metal][0]
+        if metal in in_ug:
+            headers[metal] = (symbol if silent_units else f"{symbol}_ug_L", 1000.0)
+        else:
+            headers[metal] = (f"{symbol}_mg_L", 1.0)
+    return headers
+
+
+def make_block(start, n_rows, headers, missing=0.0, seed=0, width=3):
+    """Rows start..start+n_rows of the synthetic upload (Sample_IDs zero-padded to width digits)."""
+    rng = np.random.default_rng([seed, 0, start // BLOCK_ROWS])
+    data = {
+        "Sample_ID": [f"S{i:0{width}d}" for i in range(start + 1, start + n_rows + 1)],
+        "Latitude": rng.uniform(*LATITUDE_RANGE, n_rows).round(4),
+        "Longitude": rng.uniform(*LONGITUDE_RANGE, n_rows).round(4),
+    }
+    for metal, (header, factor) in headers.items():
+        _, log_mean, log_std = METAL_PROFILE[metal]
+        values = (np.exp(rng.normal(log_mean, log_std, n_rows)) * factor).round(4 if factor == 1.0 else 2)
+        if missing > 0:
+            values[rng.random(n_rows) < missing] = np.nan
+        data[header] = values
+    return pd.DataFrame(data)
+
+
+def iter_upload_blocks(n_rows, metals=IN_CSV_METALS, missing=0.0, ug_share=0.0, silent_units=False, seed=0):
+    """The synthetic upload in blocks of at most BLOCK_ROWS rows."""
+    headers = metal_headers(metals, ug_share, silent_units, seed)
+    width = max(3, len(str(n_rows)))
+    for start in range(0, n_rows, BLOCK_ROWS):
+        yield make_block(start, min(BLOCK_ROWS, n_rows - start), headers, missing, seed, width)
+
+
+def make_upload(n_rows, **options):
+    """The whole synthetic upload as one DataFrame (see iter_upload_blocks for the options)."""
+    return pd.concat(list(iter_upload_blocks(n_rows, **options)), ignore_index=True)
+
+
+def write_upload(path, n_rows, **options):
+    """Write the synthetic upload as CSV block by block, so 10M-row files need no 10M-row frame."""
+    for i, block in enumerate(iter_upload_blocks(n_rows, **options)):
+        block.to_csv(path, mode="w" if i == 0 else "a", header=i == 0, index=False)
+    return path
+
+
+def make_predictions(n_sites, months=12, seed=0, start="2026-01-31"):
+    """A predictions table shaped like future_hmpi_predictions_2026.csv for n_sites sites."""
+    rng = np.random.default_rng([seed, 2])
+    width = max(3, len(str(n_sites)))
+    dates = pd.date_range(start, periods=months, freq="ME").strftime("%Y-%m-%d")
+    lat = rng.uniform(*LATITUDE_RANGE, n_sites).round(4)
+    lon = rng.uniform(*LONGITUDE_RANGE, n_sites).round(4)
+    level = np.exp(rng.normal(4.3, 0.6, n_sites))
+    drift = rng.normal(0, 0.01, (n_sites, months)).cumsum(axis=1)
+    arima = level[:, None] * np.exp(drift)
+    svm = arima * np.exp(rng.normal(0.1, 0.15, (n_sites, 1)))
+    return pd.DataFrame({
+        "Date": np.tile(dates, n_sites),
+        "Sample_ID": np.repeat([f"S{i:0{width}d}" for i in range(1, n_sites + 1)], months),
+        "Latitude": np.repeat(lat, months),
+        "Longitude": np.repeat(lon, months),
+        "Predicted_HMPI_ARIMA": arima.ravel(),
+        "Predicted_HMPI_SVM": svm.ravel(),
+        "Predicted_HMPI_Ensemble": ((arima + svm) / 2).ravel(),
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", default="1k", help="row count, e.g. 1k, 100k, 10M")
+    parser.add_argument("--metals", default=",".join(IN_CSV_METALS), help="comma-separated metal names")
+    parser.add_argument("--missing", type=float, default=0.0, help="share of metal cells left empty")
+    parser.add_argument("--ug-share", type=float, default=0.0, help="share of metal columns reported in µg/L")
+    parser.add_argument("--silent-units", action="store_true", help="no unit in the µg/L headers")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", required=True)
+    args = parser.parse_args()
+
+    n_rows = parse_size(args.rows)
+    write_upload(args.out, n_rows, metals=[m.strip() for m in args.metals.split(",") if m.strip()],
+                 missing=args.missing, ug_share=args.ug_share, silent_units=args.silent_units, seed=args.seed)
+    print(f"{args.out}: {n_rows} rows, {os.path.getsize(args.out) / 1e6:.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,694 @@
+"""
+Batch HMPI forecasting for the /predictions views.
+
+Fits per-site models from the stored site time series and writes the same
+schema as future_hmpi_predictions_2026.csv:
+
+    Date, Sample_ID, Latitude, Longitude,
+    Predicted_HMPI_ARIMA, Predicted_HMPI_SVM, Predicted_HMPI_Ensemble
+
+Sites are split into chunks that are fitted in a process pool. Within a chunk
+everything is array-shaped: histories become a (sites x months) matrix, the
+ARIMA(p,1,0) coefficients of all sites come from one batched solve of their
+normal equations, and the SVM is a single SVR fitted on the pooled,
+per-site-standardised lag windows of the chunk and rolled forward for all
+sites at once.
+
+Full fits save per-site state (accumulated AR normal equations, recent levels,
+level sums) and the chunk SVRs to the forecast_models collection, so that new
+measurements only cost a warm-start update of the sites they touch
+(update_site_predictions).
+
+This module has no Flask or Mongo client of its own, so it imports cleanly in
+pool workers; proj.py passes it the collections.
+"""
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # not on POSIX: writes are only serialised within the process
+    fcntl = None
+
+import numpy as np
+import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
+from sklearn.svm import SVR
+
+PREDICTION_COLUMNS = [
+    "Date", "Sample_ID", "Latitude", "Longitude",
+    "Predicted_HMPI_ARIMA", "Predicted_HMPI_SVM", "Predicted_HMPI_Ensemble"
+]
+
+FORECAST_HORIZON = 12          # months forecast after the last observed month
+FORECAST_AR_ORDER = 3          # p of ARIMA(p,1,0)
+FORECAST_RIDGE = 1.0           # shrinkage on the AR coefficients; short histories fall back towards drift only
+FORECAST_CHUNK_SITES = 500
+FORECAST_WORKERS = int(os.getenv("FORECAST_WORKERS", "0")) or os.cpu_count() or 1
+FORECAST_AR_MAX_ROOT_SUM = 0.95  # cap on sum(|phi|), which keeps every site's AR part stationary
+FORECAST_SVR_MAX_SAMPLES = 2000
+FORECAST_SVR_PARAMS = {"kernel": "rbf", "C": 10.0, "epsilon": 0.1, "gamma": "scale"}
+
+
+# ========== HISTORY ==========
+
+def load_site_histories(collection, match=None):
+    """Flatten the site_timeseries buckets into one row per measurement: site_id, date, hmpi, lon, lat."""
+    pipeline = [{"$match": match}] if match else []
+    pipeline += [
+        {"$unwind": "$measurements"},
+        {"$project": {
+            "_id": 0,
+            "site_id": 1,
+            "date": "$measurements.date",
+            "hmpi": "$measurements.hmpi",
+            "coordinates": "$measurements.coordinates"
+        }},
+    ]
+    rows = list(collection.aggregate(pipeline))
+    if not rows:
+        return pd.DataFrame(columns=["site_id", "date", "hmpi", "lon", "lat"])
+
+    coordinates = [r.get("coordinates") or [None, None] for r in rows]
+    return pd.DataFrame({
+        "site_id": [r["site_id"] for r in rows],
+        "date": pd.to_datetime([r["date"] for r in rows]),
+        "hmpi": pd.to_numeric(pd.Series([r.get("hmpi") for r in rows]), errors="coerce"),
+        "lon": pd.to_numeric(pd.Series([c[0] for c in coordinates]), errors="coerce"),
+        "lat": pd.to_numeric(pd.Series([c[1] for c in coordinates]), errors="coerce"),
+    })
+
+
+def month_index(dates):
+    """Months since year 0, so consecutive calendar months are consecutive integers."""
+    dates = pd.DatetimeIndex(dates)
+    return np.asarray(dates.year * 12 + dates.month - 1, dtype=np.int64)
+
+
+def month_end_labels(months):
+    return [(pd.Period(year=int(m // 12), month=int(m % 12) + 1, freq="M").end_time).strftime("%Y-%m-%d") for m in months]
+
+
+def monthly_matrix(site_codes, months, values, n_sites):
+    """
+    (sites x months) matrix of monthly mean HMPI over the chunk's month range,
+    with interior gaps linearly interpolated and nothing extrapolated.
+    Returns (matrix, first_month, last_observed_column per site).
+    """
+    first_month = int(months.min())
+    n_months = int(months.max()) - first_month + 1
+    sums = np.zeros((n_sites, n_months))
+    counts = np.zeros((n_sites, n_months))
+    columns = months - first_month
+    np.add.at(sums, (site_codes, columns), values)
+    np.add.at(counts, (site_codes, columns), 1)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        matrix = sums / counts
+    matrix = pd.DataFrame(matrix).interpolate(axis=1, limit_area="inside").to_numpy()
+
+    observed = counts > 0
+    last_column = n_months - 1 - np.argmax(observed[:, ::-1], axis=1)
+    return matrix, first_month, last_column
+
+
+def _tail(matrix, end_column, width):
+    """The `width` values of each row ending at end_column (inclusive), NaN where the row has no history."""
+    offsets = np.arange(-width + 1, 1)
+    columns = end_column[:, None] + offsets[None, :]
+    valid = columns >= 0
+    tail = matrix[np.arange(len(matrix))[:, None], np.clip(columns, 0, None)]
+    tail[~valid] = np.nan
+    return tail
+
+
+# ========== MODELS ==========
+
+def ar_design(diffs, order):
+    """
+    Lag design for AR(order)-with-intercept on each row of `diffs`:
+    X of shape (sites, rows, order + 1) = [1, d(t-1) .. d(t-order)], y = d(t).
+    Rows with any missing value are zeroed out so they drop from the normal equations.
+    """
+    n_sites = diffs.shape[0]
+    if diffs.shape[1] <= order:
+        return np.zeros((n_sites, 0, order + 1)), np.zeros((n_sites, 0))
+
+    windows = sliding_window_view(diffs, order + 1, axis=1)
+    y = windows[:, :, -1]
+    lags = windows[:, :, -2::-1]
+    valid = np.isfinite(y) & np.isfinite(lags).all(axis=2)
+
+    X = np.concatenate([np.ones(y.shape + (1,)), lags], axis=2)
+    X = np.where(valid[:, :, None], X, 0.0)
+    y = np.where(valid, y, 0.0)
+    return X, y
+
+
+def ar_sufficient_statistics(X, y):
+    """Per-site X'X, X'y, y'y and row count of the AR design."""
+    xtx = np.einsum("srk,srl->skl", X, X)
+    xty = np.einsum("srk,sr->sk", X, y)
+    yty = np.einsum("sr,sr->s", y, y)
+    n = (X[:, :, 0] != 0).sum(axis=1)
+    return xtx, xty, yty, n
+
+
+def solve_ar(xtx, xty, ridge=FORECAST_RIDGE):
+    """Batched ridge solve; the intercept (drift) is only nominally penalised."""
+    order = xtx.shape[1] - 1
+    penalty = np.diag([1e-6] + [ridge] * order)
+    coefficients = np.linalg.solve(xtx + penalty[None, :, :], xty[:, :, None])[:, :, 0]
+    return stabilize_ar(coefficients)
+
+
+def stabilize_ar(coefficients, limit=FORECAST_AR_MAX_ROOT_SUM):
+    """Shrink AR lags whose absolute sum reaches `limit`; sum(|phi|) < 1 rules out explosive roots."""
+    total = np.abs(coefficients[:, 1:]).sum(axis=1)
+    shrink = np.where(total > limit, limit / np.maximum(total, 1e-12), 1.0)
+    coefficients = coefficients.copy()
+    coefficients[:, 1:] *= shrink[:, None]
+    return coefficients
+
+
+def roll_arima(coefficients, last_level, last_diffs, steps):
+    """
+    Recursive ARIMA(p,1,0) forecast for every site at once.
+    last_diffs holds the most recent p differences, oldest first (NaN treated as 0).
+    Returns (sites x steps) levels.
+    """
+    lags = np.nan_to_num(last_diffs[:, ::-1])
+    level = last_level.copy()
+    out = np.empty((len(level), steps))
+    for step in range(steps):
+        diff = coefficients[:, 0] + np.einsum("sk,sk->s", coefficients[:, 1:], lags)
+        level = level + diff
+        out[:, step] = level
+        lags = np.concatenate([diff[:, None], lags[:, :-1]], axis=1)
+    return out
+
+
+def level_moments(state):
+    """Per-site mean and standardising scale of the monthly levels, from the saved running sums."""
+    count = np.maximum(state["level_count"], 1)
+    mean = state["level_sum"] / count
+    std = np.sqrt(np.maximum(state["level_sumsq"] / count - mean ** 2, 0.0))
+    scale = np.maximum(std, np.maximum(0.05 * np.abs(mean), 1e-6))
+    return mean, scale
+
+
+def fit_pooled_svr(matrix, mean, scale, order=FORECAST_AR_ORDER, seed=0):
+    """
+    One SVR on the pooled lag windows of all sites, each site standardised by its
+    own mean/scale. Returns the fitted RBF expansion as plain arrays (see
+    svr_predictor), or None when the chunk has too little history.
+    """
+    if matrix.shape[1] <= order:
+        return None
+    z = (matrix - mean[:, None]) / scale[:, None]
+    windows = sliding_window_view(z, order + 1, axis=1).reshape(-1, order + 1)
+    windows = windows[np.isfinite(windows).all(axis=1)]
+    if len(windows) < 2 * order:
+        return None
+    if len(windows) > FORECAST_SVR_MAX_SAMPLES:
+        rng = np.random.default_rng(seed)
+        windows = windows[rng.choice(len(windows), FORECAST_SVR_MAX_SAMPLES, replace=False)]
+
+    model = SVR(**FORECAST_SVR_PARAMS)
+    model.fit(windows[:, :-1], windows[:, -1])
+    return {
+        "order": order,
+        "support": model.support_vectors_,
+        "dual": model.dual_coef_[0],
+        "intercept": float(model.intercept_[0]),
+        "gamma": float(model._gamma)
+    }
+
+
+def svr_predictor(svr):
+    """
+    Evaluate a fitted RBF SVR as one matrix product against its support vectors,
+    which is much cheaper than SVR.predict when called once per forecast step.
+    """
+    support = np.asarray(svr["support"], dtype=float).reshape(-1, svr["order"])
+    dual = np.asarray(svr["dual"], dtype=float)
+    gamma, intercept = svr["gamma"], svr["intercept"]
+    support_sq = np.einsum("ij,ij->i", support, support)
+
+    def predict(X):
+        sq_dist = np.einsum("ij,ij->i", X, X)[:, None] + support_sq[None, :] - 2.0 * X @ support.T
+        return np.exp(-gamma * np.maximum(sq_dist, 0.0)) @ dual + intercept
+    return predict
+
+
+def roll_svr(svr, tail_levels, mean, scale, steps):
+    """
+    Recursive SVR forecast for every site at once from its last `order` levels.
+    Sites without that much history (or without a model) get NaN.
+    """
+    out = np.full((len(mean), steps), np.nan)
+    if svr is None:
+        return out
+    order = svr["order"]
+    z = (tail_levels[:, -order:] - mean[:, None]) / scale[:, None]
+    ready = np.isfinite(z).all(axis=1)
+    if not ready.any():
+        return out
+
+    predict = svr_predictor(svr)
+    z = z[ready]
+    for step in range(steps):
+        nxt = predict(z)
+        out[ready, step] = nxt * scale[ready] + mean[ready]
+        z = np.concatenate([z[:, 1:], nxt[:, None]], axis=1)
+    return out
+
+
+# ========== SITE STATE ==========
+
+def site_states(matrix, first_month, last_column, order=FORECAST_AR_ORDER):
+    """
+    Everything a later warm start needs per site: the AR normal equations
+    accumulated so far, the last order + 1 monthly levels, running level sums
+    for the SVR standardisation, and the last fitted month.
+    """
+    X, y = ar_design(np.diff(matrix, axis=1), order)
+    xtx, xty, _, n = ar_sufficient_statistics(X, y)
+    finite = np.isfinite(matrix)
+    return {
+        "xtx": xtx,
+        "xty": xty,
+        "n": n,
+        "last_month": first_month + last_column,
+        "tail_levels": _tail(matrix, last_column, order + 1),
+        "level_sum": np.where(finite, matrix, 0.0).sum(axis=1),
+        "level_sumsq": np.where(finite, matrix ** 2, 0.0).sum(axis=1),
+        "level_count": finite.sum(axis=1),
+    }
+
+
+def advance_states(state, site_codes, rel_months, values, order=FORECAST_AR_ORDER):
+    """
+    Fold observations made after each site's last fitted month into its saved
+    state (recursive least squares by accumulating the new normal-equation rows).
+    rel_months counts months after the site's last_month and must be >= 1.
+    """
+    n_sites = len(state["last_month"])
+    anchor = state["tail_levels"][:, -1]
+    matrix, _, last_column = monthly_matrix(
+        np.concatenate([np.arange(n_sites), site_codes]),
+        np.concatenate([np.zeros(n_sites, dtype=np.int64), rel_months]),
+        np.concatenate([anchor, values]),
+        n_sites
+    )
+
+    # The saved levels supply the lags of the first new rows
+    prior_diffs = np.diff(state["tail_levels"], axis=1)
+    X, y = ar_design(np.concatenate([prior_diffs, np.diff(matrix, axis=1)], axis=1), order)
+    xtx, xty, _, n = ar_sufficient_statistics(X, y)
+
+    new_levels = matrix[:, 1:]
+    finite = np.isfinite(new_levels)
+    levels = np.concatenate([state["tail_levels"], new_levels], axis=1)
+    return {
+        "xtx": state["xtx"] + xtx,
+        "xty": state["xty"] + xty,
+        "n": state["n"] + n,
+        "last_month": state["last_month"] + last_column,
+        "tail_levels": _tail(levels, order + last_column, order + 1),
+        "level_sum": state["level_sum"] + np.where(finite, new_levels, 0.0).sum(axis=1),
+        "level_sumsq": state["level_sumsq"] + np.where(finite, new_levels ** 2, 0.0).sum(axis=1),
+        "level_count": state["level_count"] + finite.sum(axis=1),
+    }
+
+
+def forecast_states(state, svr, target_months):
+    """
+    ARIMA and SVM forecasts for the given absolute target months from saved site states.
+    Returns (arima, svm) arrays of shape (sites, len(target_months)).
+    """
+    n_sites = len(state["last_month"])
+    last_month = state["last_month"]
+    steps = int(max(1, target_months.max() - last_month.min()))
+
+    coefficients = solve_ar(state["xtx"], state["xty"])
+    tail = state["tail_levels"]
+    arima_path = roll_arima(coefficients, tail[:, -1], np.diff(tail, axis=1), steps)
+    mean, scale = level_moments(state)
+    svm_path = roll_svr(svr, tail, mean, scale, steps)
+    svm_path = np.where(np.isfinite(svm_path), svm_path, arima_path)
+
+    # Column k of each path is last_month + k + 1; pick the requested calendar months
+    pick = np.clip(target_months[None, :] - last_month[:, None] - 1, 0, steps - 1)
+    rows = np.arange(n_sites)[:, None]
+    return np.clip(arima_path[rows, pick], 0, None), np.clip(svm_path[rows, pick], 0, None)
+
+
+def take_states(state, index):
+    return {key: value[index] for key, value in state.items()}
+
+
+def concat_states(states):
+    return {key: np.concatenate([s[key] for s in states]) for key in states[0]}
+
+
+# ========== BATCH ==========
+
+def forecast_chunk(site_ids, site_codes, months, values, target_months, order=FORECAST_AR_ORDER, svr=None):
+    """
+    Fit and forecast one chunk of sites for the given absolute target months.
+    The pooled SVR is fitted here unless a saved one is passed in.
+    Returns (arima, svm, state, svr).
+    """
+    matrix, first_month, last_column = monthly_matrix(site_codes, months, values, len(site_ids))
+    state = site_states(matrix, first_month, last_column, order)
+    if svr is None:
+        svr = fit_pooled_svr(matrix, *level_moments(state), order)
+    arima, svm = forecast_states(state, svr, target_months)
+    return arima, svm, state, svr
+
+
+def _forecast_chunk_task(args):
+    return forecast_chunk(*args)
+
+
+def _encode_history(history):
+    history = history.dropna(subset=["hmpi", "date"]).sort_values(["site_id", "date"])
+    site_ids, site_codes = np.unique(history["site_id"].to_numpy(dtype=str), return_inverse=True)
+    latest = history.groupby("site_id", sort=True)[["lat", "lon"]].last().reindex(site_ids)
+    return (site_ids, site_codes, month_index(history["date"]), history["hmpi"].to_numpy(dtype=float),
+            latest["lat"].to_numpy(), latest["lon"].to_numpy())
+
+
+def forecast_sites(history, horizon=FORECAST_HORIZON, chunk_sites=FORECAST_CHUNK_SITES, workers=FORECAST_WORKERS):
+    """
+    Forecast every site in `history` (see load_site_histories) for the `horizon`
+    months after the latest observed month.
+    Returns (predictions DataFrame in PREDICTION_COLUMNS, fitted model) where the
+    model carries the per-chunk states and SVRs for save_models.
+    """
+    site_ids, site_codes, months, values, lat, lon = _encode_history(history)
+    if len(site_ids) == 0:
+        return pd.DataFrame(columns=PREDICTION_COLUMNS), None
+    target_months = np.arange(months.max() + 1, months.max() + 1 + horizon)
+
+    bounds = np.searchsorted(site_codes, np.arange(0, len(site_ids) + chunk_sites, chunk_sites))
+    tasks = []
+    for start in range(0, len(site_ids), chunk_sites):
+        lo, hi = bounds[start // chunk_sites], bounds[start // chunk_sites + 1]
+        tasks.append((
+            site_ids[start:start + chunk_sites],
+            site_codes[lo:hi] - start,
+            months[lo:hi],
+            values[lo:hi],
+            target_months
+        ))
+
+    if workers > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(tasks))) as pool:
+            results = list(pool.map(_forecast_chunk_task, tasks))
+    else:
+        results = [_forecast_chunk_task(task) for task in tasks]
+
+    arima = np.vstack([r[0] for r in results])
+    svm = np.vstack([r[1] for r in results])
+    model = {
+        "site_ids": site_ids,
+        "lat": lat,
+        "lon": lon,
+        "measurement_count": np.bincount(site_codes, minlength=len(site_ids)),
+        "chunks": [(len(task[0]), r[2], r[3]) for task, r in zip(tasks, results)],
+        "target_months": target_months,
+    }
+    return predictions_frame(site_ids, lat, lon, target_months, arima, svm), model
+
+
+def predictions_frame(site_ids, lat, lon, target_months, arima, svm):
+    """Long-format predictions table (one row per site and month), ordered by site then date."""
+    n_sites, horizon = arima.shape
+    return pd.DataFrame({
+        "Date": np.tile(month_end_labels(target_months), n_sites),
+        "Sample_ID": np.repeat(site_ids, horizon),
+        "Latitude": np.repeat(lat, horizon),
+        "Longitude": np.repeat(lon, horizon),
+        "Predicted_HMPI_ARIMA": arima.ravel(),
+        "Predicted_HMPI_SVM": svm.ravel(),
+        "Predicted_HMPI_Ensemble": (arima.ravel() + svm.ravel()) / 2,
+    }, columns=PREDICTION_COLUMNS)
+
+
+@contextmanager
+def predictions_file_lock(path):
+    """
+    Exclusive lock on <path>.lock, held by whichever worker process is rewriting
+    the predictions file (proj's in-process lock does not reach other workers).
+    """
+    if fcntl is None:
+        yield
+        return
+    with open(f"{path}.lock", "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _replace_predictions(df_predictions, path):
+    """Write to a private temp file next to path and swap it in, so readers never see a partial CSV."""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", newline="") as f:
+            df_predictions.to_csv(f, index=False)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def write_predictions(df_predictions, path):
+    """Replace the predictions file atomically."""
+    with predictions_file_lock(path):
+        _replace_predictions(df_predictions, path)
+
+
+def patch_predictions(df_updates, path, removed=()):
+    """Swap in the rows of the updated sites and drop those of `removed`, leaving every other site's rows untouched."""
+    with predictions_file_lock(path):
+        if not os.path.exists(path):
+            _replace_predictions(df_updates, path)
+            return
+        df_existing = pd.read_csv(path, dtype={"Sample_ID": str})
+        keep = ~df_existing["Sample_ID"].isin(set(df_updates["Sample_ID"]) | set(removed))
+        df_patched = pd.concat([df_existing[keep], df_updates], ignore_index=True)
+        df_patched = df_patched.sort_values(["Sample_ID", "Date"], kind="stable")
+        _replace_predictions(df_patched[PREDICTION_COLUMNS], path)
+
+
+# ========== PERSISTED MODELS ==========
+
+def _state_documents(site_ids, state, svr_id, lat, lon, measurement_count):
+    now = pd.Timestamp.utcnow().to_pydatetime()
+    tail = state["tail_levels"]
+    return [{
+        "_id": f"site:{site_id}",
+        "kind": "site",
+        "site_id": site_id,
+        "svr_id": svr_id[i],
+        "xtx": state["xtx"][i].tolist(),
+        "xty": state["xty"][i].tolist(),
+        "n": int(state["n"][i]),
+        "last_month": int(state["last_month"][i]),
+        "tail_levels": [None if v != v else float(v) for v in tail[i]],
+        "level_sum": float(state["level_sum"][i]),
+        "level_sumsq": float(state["level_sumsq"][i]),
+        "level_count": int(state["level_count"][i]),
+        "measurement_count": int(measurement_count[i]),
+        "latitude": None if lat[i] != lat[i] else float(lat[i]),
+        "longitude": None if lon[i] != lon[i] else float(lon[i]),
+        "updated_at": now
+    } for i, site_id in enumerate(site_ids)]
+
+
+def _states_from_documents(docs):
+    return {
+        "xtx": np.array([d["xtx"] for d in docs], dtype=float),
+        "xty": np.array([d["xty"] for d in docs], dtype=float),
+        "n": np.array([d["n"] for d in docs], dtype=np.int64),
+        "last_month": np.array([d["last_month"] for d in docs], dtype=np.int64),
+        "tail_levels": np.array([d["tail_levels"] for d in docs], dtype=float),
+        "level_sum": np.array([d["level_sum"] for d in docs], dtype=float),
+        "level_sumsq": np.array([d["level_sumsq"] for d in docs], dtype=float),
+        "level_count": np.array([d["level_count"] for d in docs], dtype=np.int64),
+    }
+
+
+def _svr_document(svr_id, svr):
+    return {
+        "_id": svr_id,
+        "kind": "svr",
+        "order": svr["order"],
+        "support": np.asarray(svr["support"]).tolist(),
+        "dual": np.asarray(svr["dual"]).tolist(),
+        "intercept": svr["intercept"],
+        "gamma": svr["gamma"]
+    }
+
+
+def save_models(model_collection, model, horizon):
+    """Replace all saved forecast state with the result of a full fit."""
+    site_docs, svr_docs = [], []
+    start = 0
+    for chunk_index, (size, state, svr) in enumerate(model["chunks"]):
+        svr_id = f"svr:{chunk_index}" if svr is not None else None
+        if svr is not None:
+            svr_docs.append(_svr_document(svr_id, svr))
+        site_docs += _state_documents(
+            model["site_ids"][start:start + size], state, [svr_id] * size,
+            model["lat"][start:start + size], model["lon"][start:start + size],
+            model["measurement_count"][start:start + size]
+        )
+        start += size
+
+    model_collection.delete_many({})
+    if svr_docs:
+        model_collection.insert_many(svr_docs)
+    for i in range(0, len(site_docs), 1000):
+        model_collection.insert_many(site_docs[i:i + 1000])
+    model_collection.insert_one({
+        "_id": "meta",
+        "kind": "meta",
+        "target_months": [int(m) for m in model["target_months"]],
+        "horizon": horizon,
+        "order": FORECAST_AR_ORDER,
+        # Sites seen for the first time by an incremental update borrow this SVR
+        "default_svr_id": next((d["_id"] for d in svr_docs), None)
+    })
+
+
+def update_site_predictions(collection, model_collection, path, site_ids):
+    """
+    Warm-start update for the sites that just received measurements.
+
+    Sites whose new measurements all fall after their last fitted month have the
+    new rows folded into their saved normal equations; sites that are new, or
+    that got a measurement inside already-fitted history, are refitted from
+    their own history. The saved SVRs are reused, and only the rows of these
+    sites are replaced in the predictions file; sites left without any
+    measurements (their uploads were deleted) lose their rows and saved state.
+    Returns None when no full fit has been saved yet.
+
+    The forecast months are those of the last full fit. Once a site has a
+    measurement in one of them, the calendar has moved on for every site, so a
+    full refresh runs instead (its result carries "full_refresh": True).
+    """
+    start = time.perf_counter()
+    meta = model_collection.find_one({"_id": "meta"})
+    if meta is None or meta.get("order") != FORECAST_AR_ORDER:
+        return None
+    target_months = np.asarray(meta["target_months"], dtype=np.int64)
+
+    requested = [str(s) for s in site_ids]
+    site_ids, site_codes, months, values, lat, lon = _encode_history(
+        load_site_histories(collection, {"site_id": {"$in": requested}}))
+    removed = sorted(set(requested) - set(site_ids))
+    if removed:
+        model_collection.delete_many({"_id": {"$in": [f"site:{s}" for s in removed]}})
+    if len(site_ids) == 0:
+        if removed:
+            patch_predictions(pd.DataFrame(columns=PREDICTION_COLUMNS), path, removed)
+        return {"sites": 0, "warm": 0, "cold": 0, "rows": 0, "removed": len(removed),
+                "elapsed_seconds": round(time.perf_counter() - start, 3)}
+    if months.max() >= target_months.min():
+        result = refresh_predictions(collection, path, horizon=meta["horizon"], model_collection=model_collection)
+        result["full_refresh"] = True
+        return result
+
+    saved = {d["site_id"]: d for d in model_collection.find({"_id": {"$in": [f"site:{s}" for s in site_ids]}})}
+    measurement_count = np.bincount(site_codes, minlength=len(site_ids))
+    saved_last_month = np.array([saved[s]["last_month"] if s in saved else -1 for s in site_ids], dtype=np.int64)
+    fitted_count = np.bincount(site_codes, weights=months <= saved_last_month[site_codes], minlength=len(site_ids))
+    warm = np.array([s in saved and saved[s]["measurement_count"] == fitted_count[i] for i, s in enumerate(site_ids)], dtype=bool)
+
+    svr_cache = {}
+
+    def load_svr(svr_id):
+        if svr_id not in svr_cache:
+            svr_cache[svr_id] = model_collection.find_one({"_id": svr_id}) if svr_id else None
+        return svr_cache[svr_id]
+
+    parts = []
+    warm_index = np.flatnonzero(warm)
+    if len(warm_index):
+        positions = np.full(len(site_ids), -1)
+        positions[warm_index] = np.arange(len(warm_index))
+        new_rows = warm[site_codes] & (months > saved_last_month[site_codes])
+        state = advance_states(
+            _states_from_documents([saved[site_ids[i]] for i in warm_index]),
+            positions[site_codes[new_rows]],
+            months[new_rows] - saved_last_month[site_codes[new_rows]],
+            values[new_rows]
+        )
+        parts.append((warm_index, state, [saved[site_ids[i]]["svr_id"] for i in warm_index]))
+
+    cold_index = np.flatnonzero(~warm)
+    if len(cold_index):
+        positions = np.full(len(site_ids), -1)
+        positions[cold_index] = np.arange(len(cold_index))
+        rows = ~warm[site_codes]
+        matrix, first_month, last_column = monthly_matrix(positions[site_codes[rows]], months[rows], values[rows], len(cold_index))
+        state = site_states(matrix, first_month, last_column)
+        svr_ids = [saved[site_ids[i]]["svr_id"] if site_ids[i] in saved else meta.get("default_svr_id") for i in cold_index]
+        parts.append((cold_index, state, svr_ids))
+
+    order = np.concatenate([index for index, _, _ in parts])
+    state = concat_states([s for _, s, _ in parts])
+    svr_ids = np.array(sum([ids for _, _, ids in parts], []), dtype=object)
+
+    arima = np.zeros((len(order), len(target_months)))
+    svm = np.zeros_like(arima)
+    for svr_id in set(svr_ids):
+        group = np.flatnonzero(svr_ids == svr_id)
+        arima[group], svm[group] = forecast_states(take_states(state, group), load_svr(svr_id), target_months)
+
+    ids, lat, lon, measurement_count = site_ids[order], lat[order], lon[order], measurement_count[order]
+    for doc in _state_documents(ids, state, svr_ids, lat, lon, measurement_count):
+        model_collection.replace_one({"_id": doc["_id"]}, doc, upsert=True)
+    df_updates = predictions_frame(ids, lat, lon, target_months, arima, svm)
+    patch_predictions(df_updates, path, removed)
+
+    return {
+        "sites": int(len(ids)),
+        "warm": int(len(warm_index)),
+        "cold": int(len(cold_index)),
+        "rows": int(len(df_updates)),
+        "removed": len(removed),
+        "elapsed_seconds": round(time.perf_counter() - start, 3)
+    }
+
+
+def refresh_predictions(collection, path, horizon=FORECAST_HORIZON, workers=FORECAST_WORKERS, model_collection=None):
+    """
+    Re-fit all sites from the site_timeseries collection and rewrite the
+    predictions file; with model_collection, also save the state that
+    update_site_predictions warm-starts from.
+    """
+    start = time.perf_counter()
+    history = load_site_histories(collection)
+    df_predictions, model = forecast_sites(history, horizon=horizon, workers=workers)
+    if not df_predictions.empty:
+        write_predictions(df_predictions, path)
+        if model_collection is not None:
+            save_models(model_collection, model, horizon)
+    return {
+        "sites": int(df_predictions["Sample_ID"].nunique()) if not df_predictions.empty else 0,
+        "rows": int(len(df_predictions)),
+        "measurements": int(len(history)),
+        "horizon": horizon,
+        "elapsed_seconds": round(time.perf_counter() - start, 3)
+    }
@@ -0,0 +1,217 @@
+"""
+Opt-in sampling memory profiler for Flask requests (tracemalloc).
+
+A MEMPROFILE_SAMPLE_RATE fraction of requests is traced from the start of
+the request until its response is closed (so streamed bodies count). For each
+one we record the peak traced memory, what was allocated during the request
+and is still alive at the end ("retained"), the RSS change, and the top
+allocation sites with the deepest app frame (proj.py, pdf_export.py, ...)
+that led to each. Aggregates are kept per route.
+
+tracemalloc is process-wide, so only one request is traced at a time: a
+sampled request that arrives while another is being traced is skipped.
+Allocations by requests running concurrently on other threads are still
+traced, which the per-site app frames help tell apart. Tracing is off
+between sampled requests, and with the rate at 0 (the default) no hooks are
+installed at all.
+"""
+import linecache
+import os
+import random
+import threading
+import time
+import tracemalloc
+
+MEMPROFILE_SAMPLE_RATE = float(os.getenv("MEMPROFILE_SAMPLE_RATE", "0"))
+MEMPROFILE_FRAMES = int(os.getenv("MEMPROFILE_FRAMES", "16"))
+# Allocation sites kept per traced request / per route aggregate
+MEMPROFILE_TOP_SITES = 10
+MEMPROFILE_ROUTE_SITES = 25
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+_trace_lock = threading.Lock()
+_stats_lock = threading.Lock()
+_routes = {}
+_skipped = {"busy": 0, "external_tracing": 0}
+_sample_rate = 0.0
+
+
+def _rss_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def _is_app_frame(filename):
+    return filename.startswith(APP_DIR) and "site-packages" not in filename and filename != __file__
+
+
+def _short(frame):
+    filename = frame.filename
+    if filename.startswith(APP_DIR):
+        filename = os.path.relpath(filename, APP_DIR)
+    return f"{filename}:{frame.lineno}"
+
+
+def _top_sites(snapshot, limit=MEMPROFILE_TOP_SITES):
+    """Largest live allocation sites: innermost frame, deepest app frame and its source line."""
+    snapshot = snapshot.filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, __file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap*>"),
+    ))
+    sites = {}
+    for stat in snapshot.statistics("traceback"):
+        frames = list(stat.traceback)
+        app = next((f for f in reversed(frames) if _is_app_frame(f.filename)), None)
+        key = (_short(frames[-1]), _short(app) if app else None)
+        site = sites.setdefault(key, {"site": key[0], "app_frame": key[1], "bytes": 0, "count": 0,
+                                      "app_line": linecache.getline(app.filename, app.lineno).strip() if app else None})
+        site["bytes"] += stat.size
+        site["count"] += stat.count
+    return sorted(sites.values(), key=lambda s: s["bytes"], reverse=True)[:limit]
+
+
+def _record(route, peak, retained, rss_delta, elapsed, sites):
+    with _stats_lock:
+        entry = _routes.setdefault(route, {
+            "samples": 0, "peak_bytes_max": 0, "peak_bytes_sum": 0, "retained_bytes_max": 0,
+            "retained_bytes_sum": 0, "rss_delta_bytes_max": None, "rss_delta_bytes_sum": 0,
+            "seconds_sum": 0.0, "sites": {},
+        })
+        entry["samples"] += 1
+        entry["peak_bytes_max"] = max(entry["peak_bytes_max"], peak)
+        entry["peak_bytes_sum"] += peak
+        entry["retained_bytes_max"] = max(entry["retained_bytes_max"], retained)
+        entry["retained_bytes_sum"] += retained
+        if rss_delta is not None:
+            entry["rss_delta_bytes_max"] = rss_delta if entry["rss_delta_bytes_max"] is None \
+                else max(entry["rss_delta_bytes_max"], rss_delta)
+            entry["rss_delta_bytes_sum"] += rss_delta
+        entry["seconds_sum"] += elapsed
+
+        for site in sites:
+            key = (site["site"], site["app_frame"])
+            agg = entry["sites"].setdefault(key, {
+                "site": site["site"], "app_frame": site["app_frame"], "app_line": site["app_line"],
+                "requests": 0, "bytes_sum": 0, "bytes_max": 0, "count_sum": 0,
+            })
+            agg["requests"] += 1
+            agg["bytes_sum"] += site["bytes"]
+            agg["bytes_max"] = max(agg["bytes_max"], site["bytes"])
+            agg["count_sum"] += site["count"]
+        if len(entry["sites"]) > 4 * MEMPROFILE_ROUTE_SITES:
+            keep = sorted(entry["sites"].items(), key=lambda kv: kv[1]["bytes_sum"], reverse=True)
+            entry["sites"] = dict(keep[:MEMPROFILE_ROUTE_SITES])
+
+
+def _count_skip(reason):
+    with _stats_lock:
+        _skipped[reason] += 1
+
+
+class _Trace:
+    """One traced request; finish() runs once, when the response is closed or the request is torn down."""
+
+    def __init__(self, route):
+        self.route = route
+        self.rss_before = _rss_bytes()
+        self.started = time.perf_counter()
+        self._done = False
+        tracemalloc.start(MEMPROFILE_FRAMES)
+
+    def finish(self):
+        if self._done:
+            return
+        self._done = True
+        try:
+            snapshot = tracemalloc.take_snapshot()
+            retained, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+            _trace_lock.release()
+        rss_after = _rss_bytes()
+        rss_delta = rss_after - self.rss_before if rss_after is not None and self.rss_before is not None else None
+        _record(self.route, peak, retained, rss_delta, time.perf_counter() - self.started, _top_sites(snapshot))
+
+
+def init_app(app, sample_rate=None):
+    """Trace a sample_rate (default MEMPROFILE_SAMPLE_RATE) fraction of app's requests."""
+    global _sample_rate
+    rate = MEMPROFILE_SAMPLE_RATE if sample_rate is None else sample_rate
+    if rate <= 0:
+        return
+    _sample_rate = rate
+    from flask import g, request
+
+    @app.before_request
+    def _start_trace():
+        if random.random() >= rate:
+            return
+        if not _trace_lock.acquire(blocking=False):
+            _count_skip("busy")
+            return
+        if tracemalloc.is_tracing():
+            # Started elsewhere (e.g. PYTHONTRACEMALLOC); its traces would swamp the request's
+            _trace_lock.release()
+            _count_skip("external_tracing")
+            return
+        try:
+            g._memprofile = _Trace(request.url_rule.rule if request.url_rule is not None else "unmatched")
+        except Exception:
+            _trace_lock.release()
+            raise
+
+    @app.after_request
+    def _finish_on_close(response):
+        trace = g.pop("_memprofile", None)
+        if trace is None:
+            pass
+        elif response.direct_passthrough:
+            # send_file bodies are already built, and werkzeug skips close callbacks for them
+            trace.finish()
+        else:
+            response.call_on_close(trace.finish)
+        return response
+
+    @app.teardown_request
+    def _finish_on_error(exc):
+        # after_request is skipped when the view raised
+        trace = g.pop("_memprofile", None)
+        if trace is not None:
+            trace.finish()
+
+
+def summary(top=MEMPROFILE_ROUTE_SITES):
+    """Per-route aggregates, heaviest retained memory first."""
+    with _stats_lock:
+        routes = {route: dict(entry, sites=list(entry["sites"].values())) for route, entry in _routes.items()}
+        skipped = dict(_skipped)
+
+    out = []
+    for route, entry in routes.items():
+        n = entry["samples"]
+        out.append({
+            "route": route,
+            "samples": n,
+            "peak_bytes_max": entry["peak_bytes_max"],
+            "peak_bytes_mean": entry["peak_bytes_sum"] / n,
+            "retained_bytes_max": entry["retained_bytes_max"],
+            "retained_bytes_mean": entry["retained_bytes_sum"] / n,
+            "rss_delta_bytes_max": entry["rss_delta_bytes_max"],
+            "rss_delta_bytes_mean": entry["rss_delta_bytes_sum"] / n if entry["rss_delta_bytes_max"] is not None else None,
+            "seconds_mean": entry["seconds_sum"] / n,
+            "top_sites": sorted(entry["sites"], key=lambda s: s["bytes_sum"], reverse=True)[:top],
+        })
+    out.sort(key=lambda r: r["retained_bytes_mean"], reverse=True)
+    return {"sample_rate": _sample_rate, "frames": MEMPROFILE_FRAMES, "skipped": skipped, "routes": out}
+
+
+def reset():
+    with _stats_lock:
+        _routes.clear()
+        for key in _skipped:
+            _skipped[key] = 0
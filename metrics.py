@@ -0,0 +1,224 @@
+"""
+In-process pipeline and endpoint metrics in the Prometheus text format.
+
+Stages are timed with `stage(...)` blocks or the `timed(...)` decorator and
+land in latency histograms with row and byte counters beside them; requests
+are timed by the hooks `init_app` installs. Everything lives in this
+process's memory, so each worker exposes its own series (scrape them per
+worker). With METRICS_ENABLED=0 the decorators return the function unchanged
+and `stage` hands back a shared no-op, so instrumented code costs nothing.
+"""
+import bisect
+import functools
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import pandas as pd
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1").lower() not in ("0", "false", "no", "off")
+METRICS_PREFIX = "hmpi"
+
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+HELP = {
+    "stage_duration_seconds": "Time spent in a processing stage",
+    "stage_rows_total": "Rows handled by a processing stage",
+    "stage_bytes_total": "Bytes handled by a processing stage",
+    "http_request_duration_seconds": "Time to produce a response, by route",
+    "http_requests_total": "Responses, by route, method and status",
+    "http_request_bytes_total": "Request body bytes, by route",
+    "http_response_bytes_total": "Response body bytes (when known up front), by route",
+    "mongo_command_duration_seconds": "MongoDB command round-trip time measured by the driver, by collection and command",
+    "mongo_reply_bytes_total": "Encoded MongoDB reply bytes, by collection and command",
+    "mongo_command_failures_total": "Failed MongoDB commands, by collection and command",
+}
+
+_lock = threading.Lock()
+_histograms = {}
+_counters = {}
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def observe(name, value, **labels):
+    """Add one observation to the histogram `name`."""
+    key = _key(name, labels)
+    with _lock:
+        entry = _histograms.get(key)
+        if entry is None:
+            entry = _histograms[key] = [[0] * (len(LATENCY_BUCKETS) + 1), 0.0, 0]
+        entry[0][bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+        entry[1] += value
+        entry[2] += 1
+
+
+def inc(name, amount=1, **labels):
+    """Increase the counter `name`."""
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+
+class _Stage:
+    __slots__ = ("rows", "nbytes")
+
+    def __init__(self, rows=None, nbytes=None):
+        self.rows, self.nbytes = rows, nbytes
+
+    def record(self, rows=None, nbytes=None):
+        """Set the row / byte counts once they are known inside the block."""
+        if rows is not None:
+            self.rows = rows
+        if nbytes is not None:
+            self.nbytes = nbytes
+
+
+class _NoopStage:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def record(self, rows=None, nbytes=None):
+        pass
+
+
+_NOOP_STAGE = _NoopStage()
+
+
+@contextmanager
+def _timed_stage(name, rows, nbytes):
+    handle = _Stage(rows, nbytes)
+    start = time.perf_counter()
+    try:
+        yield handle
+    finally:
+        observe("stage_duration_seconds", time.perf_counter() - start, stage=name)
+        if handle.rows is not None:
+            inc("stage_rows_total", int(handle.rows), stage=name)
+        if handle.nbytes is not None:
+            inc("stage_bytes_total", int(handle.nbytes), stage=name)
+
+
+def stage(name, rows=None, nbytes=None):
+    """
+    Time a block as pipeline stage `name`:
+
+        with metrics.stage("mongo_insert") as s:
+            ...
+            s.record(rows=len(features))
+    """
+    if not METRICS_ENABLED:
+        return _NOOP_STAGE
+    return _timed_stage(name, rows, nbytes)
+
+
+def _result_rows(result):
+    frame = result[0] if isinstance(result, tuple) and result else result
+    return len(frame) if isinstance(frame, (pd.DataFrame, list)) else None
+
+
+def timed(name):
+    """Decorator form of `stage`; rows are taken from a returned DataFrame / list (or the first item of a tuple)."""
+    def decorator(fn):
+        if not METRICS_ENABLED:
+            return fn
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with _timed_stage(name, None, None) as handle:
+                result = fn(*args, **kwargs)
+                handle.record(rows=_result_rows(result))
+                return result
+        return wrapper
+    return decorator
+
+
+def init_app(app):
+    """Time every request by route (the URL rule, so label values stay bounded)."""
+    if not METRICS_ENABLED:
+        return
+    from flask import g, request
+
+    @app.before_request
+    def _start_request_timer():
+        g._metrics_start = time.perf_counter()
+
+    @app.after_request
+    def _record_request(response):
+        start = getattr(g, "_metrics_start", None)
+        if start is None:
+            return response
+        route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+        observe("http_request_duration_seconds", time.perf_counter() - start, route=route)
+        inc("http_requests_total", route=route, method=request.method, status=str(response.status_code))
+        if request.content_length:
+            inc("http_request_bytes_total", request.content_length, route=route)
+        if not response.is_streamed and response.content_length is not None:
+            inc("http_response_bytes_total", response.content_length, route=route)
+        return response
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(pairs, extra=()):
+    pairs = list(pairs) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+def _format_number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render():
+    """All series in the Prometheus text exposition format."""
+    with _lock:
+        histograms = {k: (list(v[0]), v[1], v[2]) for k, v in _histograms.items()}
+        counters = dict(_counters)
+
+    lines = []
+    for name in sorted({k[0] for k in histograms}):
+        full = f"{METRICS_PREFIX}_{name}"
+        lines.append(f"# HELP {full} {HELP.get(name, name)}")
+        lines.append(f"# TYPE {full} histogram")
+        for (series, labels), (buckets, total, count) in sorted(histograms.items()):
+            if series != name:
+                continue
+            cumulative = 0
+            for bound, n in zip(LATENCY_BUCKETS + (float("inf"),), buckets):
+                cumulative += n
+                lines.append(f"{full}_bucket{_labels(labels, [('le', _format_number(bound))])} {cumulative}")
+            lines.append(f"{full}_sum{_labels(labels)} {_format_number(total)}")
+            lines.append(f"{full}_count{_labels(labels)} {count}")
+
+    for name in sorted({k[0] for k in counters}):
+        full = f"{METRICS_PREFIX}_{name}"
+        lines.append(f"# HELP {full} {HELP.get(name, name)}")
+        lines.append(f"# TYPE {full} counter")
+        for (series, labels), value in sorted(counters.items()):
+            if series == name:
+                lines.append(f"{full}{_labels(labels)} {_format_number(value)}")
+    return "\n".join(lines) + "\n"
+
+
+def reset():
+    """Drop all recorded series."""
+    with _lock:
+        _histograms.clear()
+        _counters.clear()
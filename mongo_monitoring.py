@@ -0,0 +1,196 @@
+"""
+MongoDB command monitoring: latency, reply size and collection of every
+command the app sends, and a log of the slow / oversized ones.
+
+Pass `listeners()` as a MongoClient's event_listeners. For each command it
+records the duration the driver measured (the whole round trip, so network
+and queueing on the server count too) and the encoded size of the reply (so
+a find_one that pulls a multi-MB GeoJSON document stands out from a tiny
+lookup), aggregated per (collection, command). Commands slower than
+MONGO_SLOW_MS or with replies over MONGO_LARGE_REPLY_BYTES are logged and
+grouped by query shape (the filter, or an aggregate's $match stages, with
+values replaced by "?"), which is what a missing index or an unprojected
+read has in common across calls.
+Series also go to metrics.py, so they show on /metrics.
+
+Measuring reply sizes re-encodes each reply, which costs about as much as
+decoding it did; MONGO_MONITORING_ENABLED=0 turns the listener off.
+"""
+import os
+import threading
+from collections import deque
+from datetime import datetime
+
+import bson
+from pymongo import monitoring
+
+import metrics
+
+MONGO_MONITORING_ENABLED = os.getenv("MONGO_MONITORING_ENABLED", "1").lower() not in ("0", "false", "no", "off")
+MONGO_SLOW_MS = float(os.getenv("MONGO_SLOW_MS", "100"))
+MONGO_LARGE_REPLY_BYTES = int(os.getenv("MONGO_LARGE_REPLY_BYTES", str(1024 * 1024)))
+MONGO_SLOW_LOG_SIZE = 200
+
+# Connection handshakes, auth and session housekeeping
+IGNORED_COMMANDS = frozenset({
+    "hello", "ismaster", "isMaster", "ping", "buildInfo", "buildinfo", "endSessions",
+    "saslStart", "saslContinue", "authenticate", "getnonce", "killCursors",
+})
+
+# command name -> where its query filter lives in the command document
+FILTER_FIELDS = {
+    "find": lambda cmd: cmd.get("filter"),
+    "count": lambda cmd: cmd.get("query"),
+    "distinct": lambda cmd: cmd.get("query"),
+    "findAndModify": lambda cmd: cmd.get("query"),
+    "update": lambda cmd: (cmd.get("updates") or [{}])[0].get("q"),
+    "delete": lambda cmd: (cmd.get("deletes") or [{}])[0].get("q"),
+    # Stage names, plus the fields of $match stages (the ones an index would serve)
+    "aggregate": lambda cmd: [{stage: body if stage == "$match" else "?" for stage, body in step.items()}
+                              for step in cmd.get("pipeline", [])],
+}
+
+_lock = threading.Lock()
+_pending = {}
+_operations = {}
+_slow_shapes = {}
+_slow_log = deque(maxlen=MONGO_SLOW_LOG_SIZE)
+
+
+def query_shape(value):
+    """The filter with every value replaced by "?" (operators and field names kept)."""
+    if isinstance(value, dict):
+        return {k: query_shape(v) if k.startswith("$") or isinstance(v, (dict, list)) else "?" for k, v in value.items()}
+    if isinstance(value, list):
+        shapes = [query_shape(v) for v in value]
+        return shapes if any(isinstance(s, (dict, list)) for s in shapes) else "?"
+    return "?"
+
+
+def _collection(command_name, command):
+    if command_name == "getMore":
+        return command.get("collection")
+    target = command.get(command_name)
+    return target if isinstance(target, str) else None
+
+
+def _returned_documents(reply):
+    cursor = reply.get("cursor") if isinstance(reply, dict) else None
+    if isinstance(cursor, dict):
+        return len(cursor.get("firstBatch") or cursor.get("nextBatch") or [])
+    if isinstance(reply, dict) and isinstance(reply.get("value"), dict):
+        return 1
+    return None
+
+
+class CommandMonitor(monitoring.CommandListener):
+
+    def started(self, event):
+        if event.command_name in IGNORED_COMMANDS:
+            return
+        command = event.command
+        shape = FILTER_FIELDS.get(event.command_name)
+        _pending[(event.connection_id, event.request_id)] = (
+            _collection(event.command_name, command),
+            query_shape(shape(command)) if shape else None,
+            command.get("projection") is not None,
+        )
+
+    def succeeded(self, event):
+        info = _pending.pop((event.connection_id, event.request_id), None)
+        if info is None:
+            return
+        try:
+            reply_bytes = len(bson.encode(event.reply))
+        except Exception:
+            reply_bytes = 0
+        _record(event, info, reply_bytes, _returned_documents(event.reply), failed=False)
+
+    def failed(self, event):
+        info = _pending.pop((event.connection_id, event.request_id), None)
+        if info is not None:
+            _record(event, info, 0, None, failed=True)
+
+
+def _record(event, info, reply_bytes, documents, failed):
+    collection, shape, projected = info
+    command = event.command_name
+    duration_ms = event.duration_micros / 1000.0
+    label = collection or "-"
+
+    if metrics.METRICS_ENABLED:
+        metrics.observe("mongo_command_duration_seconds", duration_ms / 1000.0, collection=label, command=command)
+        metrics.inc("mongo_reply_bytes_total", reply_bytes, collection=label, command=command)
+        if failed:
+            metrics.inc("mongo_command_failures_total", collection=label, command=command)
+
+    slow = duration_ms >= MONGO_SLOW_MS
+    large = reply_bytes >= MONGO_LARGE_REPLY_BYTES
+    with _lock:
+        entry = _operations.setdefault((label, command), {
+            "collection": label, "command": command, "count": 0, "failures": 0, "total_ms": 0.0,
+            "max_ms": 0.0, "reply_bytes_total": 0, "reply_bytes_max": 0, "slow": 0, "large": 0,
+        })
+        entry["count"] += 1
+        entry["failures"] += failed
+        entry["total_ms"] += duration_ms
+        entry["max_ms"] = max(entry["max_ms"], duration_ms)
+        entry["reply_bytes_total"] += reply_bytes
+        entry["reply_bytes_max"] = max(entry["reply_bytes_max"], reply_bytes)
+        entry["slow"] += slow
+        entry["large"] += large
+        if not (slow or large):
+            return
+
+        shape_key = (label, command, repr(shape), projected)
+        grouped = _slow_shapes.setdefault(shape_key, {
+            "collection": label, "command": command, "shape": shape, "projected": projected,
+            "count": 0, "total_ms": 0.0, "max_ms": 0.0, "reply_bytes_max": 0, "last_seen": None,
+        })
+        grouped["count"] += 1
+        grouped["total_ms"] += duration_ms
+        grouped["max_ms"] = max(grouped["max_ms"], duration_ms)
+        grouped["reply_bytes_max"] = max(grouped["reply_bytes_max"], reply_bytes)
+        grouped["last_seen"] = datetime.utcnow().isoformat() + "Z"
+        _slow_log.append({
+            "at": grouped["last_seen"], "collection": label, "command": command, "duration_ms": round(duration_ms, 3),
+            "reply_bytes": reply_bytes, "documents": documents, "shape": shape, "projected": projected,
+            "failed": failed,
+        })
+
+    print(f"[LOG] {'Slow' if slow else 'Large'} Mongo {command} on {label}: {duration_ms:.1f} ms, {reply_bytes} reply bytes, "
+          f"filter {shape}{'' if projected else ' (no projection)'}")
+
+
+def listeners():
+    """event_listeners for MongoClient (empty when monitoring is disabled)."""
+    return [CommandMonitor()] if MONGO_MONITORING_ENABLED else []
+
+
+def summary(limit=50):
+    """Per (collection, command) totals by time spent, slow query shapes and the latest slow operations."""
+    with _lock:
+        operations = [dict(e) for e in _operations.values()]
+        shapes = [dict(s) for s in _slow_shapes.values()]
+        recent = list(_slow_log)[-limit:]
+
+    for entry in operations:
+        entry["mean_ms"] = entry["total_ms"] / entry["count"]
+        entry["reply_bytes_mean"] = entry["reply_bytes_total"] / entry["count"]
+    for shape in shapes:
+        shape["mean_ms"] = shape["total_ms"] / shape["count"]
+    return {
+        "enabled": MONGO_MONITORING_ENABLED,
+        "slow_ms": MONGO_SLOW_MS,
+        "large_reply_bytes": MONGO_LARGE_REPLY_BYTES,
+        "operations": sorted(operations, key=lambda e: e["total_ms"], reverse=True),
+        "slow_shapes": sorted(shapes, key=lambda s: s["total_ms"], reverse=True)[:limit],
+        "recent_slow": recent[::-1],
+    }
+
+
+def reset():
+    with _lock:
+        _operations.clear()
+        _slow_shapes.clear()
+        _slow_log.clear()
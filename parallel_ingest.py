@@ -0,0 +1,151 @@
+"""
+Multi-core CSV parsing for very large uploads.
+
+The file is split after its header into byte ranges that end on line
+boundaries; each range is parsed in a process pool with the header prepended
+(so every range reads exactly like the whole file would) and the frames come
+back in file order with a global RangeIndex, so row-number based fallbacks
+such as Sample_{n} stay consistent with a serial read.
+
+Quoted fields may contain newlines, which a byte-range split cannot see.
+Files with quotes in their first block are left to the serial reader, and
+any range that holds a quote has its row count checked against its lines;
+a mismatch raises SplitMismatch so the caller can re-read serially.
+"""
+import io
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+PARALLEL_INGEST_WORKERS = int(os.getenv("PARALLEL_INGEST_WORKERS", "0")) or os.cpu_count() or 1
+PARALLEL_INGEST_MIN_BYTES = int(os.getenv("PARALLEL_INGEST_MIN_BYTES", str(64 * 1024 * 1024)))
+PARALLEL_RANGE_BYTES = 32 * 1024 * 1024
+QUOTE_PROBE_BYTES = 64 * 1024
+
+
+class SplitMismatch(ValueError):
+    """A line-split piece parsed into fewer or more rows than it has lines (a quoted line break)."""
+
+
+def read_csv_with_plan(source, plan, engine="c"):
+    """
+    Parse only the planned columns with their pinned dtypes. Columns that do
+    not parse as floats (e.g. "<0.01" or "ND") are re-read untyped and coerced,
+    with the unparseable cells becoming NaN.
+    """
+    start = source.tell() if hasattr(source, "tell") else None
+    try:
+        return pd.read_csv(source, usecols=plan.get("usecols"), dtype=plan.get("dtype"), engine=engine)
+    except (ValueError, TypeError):
+        if start is None:
+            raise
+        source.seek(start)
+        df = pd.read_csv(source, usecols=plan.get("usecols"), engine=engine)
+        for col in plan.get("dtype") or {}:
+            if col in df.columns:
+                df[col] = pd.to_numeric(df[col], errors="coerce").astype("float64")
+        return df
+
+
+def read_header(path):
+    """The raw header line (with its newline) of a CSV file."""
+    with open(path, "rb") as f:
+        return f.readline()
+
+
+def can_split_by_lines(path):
+    """True when the file looks safe to split at newlines (no quoting in its first block)."""
+    with open(path, "rb") as f:
+        return b'"' not in f.read(QUOTE_PROBE_BYTES)
+
+
+def rows_match_lines(data, n_rows):
+    """
+    Whether a piece of CSV data (without its header) parsed into one row per
+    non-blank line. Only pieces holding a quote can disagree, so others pass
+    without counting.
+    """
+    if b'"' not in data:
+        return True
+    return n_rows == sum(1 for line in data.split(b"\n") if line.strip())
+
+
+def split_line_ranges(path, n_ranges):
+    """
+    Byte ranges [start, end) covering the rows after the header, each ending on a
+    line boundary. Returns (header bytes, ranges).
+    """
+    size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        header = f.readline()
+        data_start = f.tell()
+        step = max(1, (size - data_start) // max(1, n_ranges))
+
+        bounds = [data_start]
+        target = data_start + step
+        while target < size:
+            f.seek(target)
+            f.readline()
+            boundary = f.tell()
+            if boundary >= size:
+                break
+            if boundary > bounds[-1]:
+                bounds.append(boundary)
+            target = boundary + step
+        bounds.append(size)
+    return header, [(lo, hi) for lo, hi in zip(bounds[:-1], bounds[1:]) if hi > lo]
+
+
+def _parse_range(args):
+    """(frame, whether its rows match its lines); a piece that fails to parse counts as a mismatch."""
+    path, start, end, header, plan, engine = args
+    with open(path, "rb") as f:
+        f.seek(start)
+        data = f.read(end - start)
+    try:
+        frame = read_csv_with_plan(io.BytesIO(header + data), plan, engine)
+    except Exception:
+        if b'"' in data:
+            return None, False
+        raise
+    return frame, rows_match_lines(data, len(frame))
+
+
+def iter_parallel_frames(path, plan=None, engine="c", workers=PARALLEL_INGEST_WORKERS,
+                         range_bytes=PARALLEL_RANGE_BYTES):
+    """
+    Parse a CSV file in parallel and yield its pieces in file order, each with a
+    global RangeIndex. `plan` takes the usecols/dtype arguments of read_csv_with_plan.
+    Raises SplitMismatch when a quoted field spans lines.
+    """
+    size = os.path.getsize(path)
+    n_ranges = max(workers, -(-size // range_bytes))
+    header, ranges = split_line_ranges(path, n_ranges)
+    tasks = [(path, lo, hi, header, plan or {}, engine) for lo, hi in ranges]
+
+    offset = 0
+    with ProcessPoolExecutor(max_workers=max(1, min(workers, len(tasks)))) as pool:
+        for (frame, matches), (_, lo, hi, *_rest) in zip(pool.map(_parse_range, tasks), tasks):
+            if not matches:
+                raise SplitMismatch(f"{path}: bytes {lo}-{hi} hold a quoted line break")
+            frame.index = pd.RangeIndex(offset, offset + len(frame))
+            offset += len(frame)
+            yield frame
+
+
+def should_parse_in_parallel(path, workers=PARALLEL_INGEST_WORKERS, min_bytes=PARALLEL_INGEST_MIN_BYTES):
+    return workers > 1 and os.path.getsize(path) >= min_bytes and can_split_by_lines(path)
+
+
+def spill_to_named_file(stream, directory=None):
+    """
+    Copy a stream to a named temporary file so pool workers can open it by path.
+    The caller removes the file when done.
+    """
+    spill = tempfile.NamedTemporaryFile(suffix=".csv", dir=directory, delete=False)
+    with spill:
+        shutil.copyfileobj(stream, spill, 1024 * 1024)
+    return spill.name
@@ -15,11 +15,15 @@ from reportlab.lib.pagesizes import letter
 from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Image
 from reportlab.lib.styles import getSampleStyleSheet
 from reportlab.lib.units import inch
+from risk import RISK_SHORT_LABELS, classify_risk, risk_counts
+import parallel_ingest
+import mongo_monitoring
 import os
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 app = Flask(__name__)
 CORS(app)
-client = MongoClient("mongodb://localhost:27017/")
+client = MongoClient("mongodb://localhost:27017/", event_listeners=mongo_monitoring.listeners())
 db = client['heavy_metal_db']
 samples_collection = db['samples']
 uploads_collection = db['uploads']
@@ -50,18 +54,38 @@ METAL_KEYWORDS = {
     'Manganese': ['mn', 'manganese', 'mn_conc', 'mn_mg_l'],
 }
 
+# Exact-match index compiled once at import: lower-cased column name -> (metal, keyword priority)
+KEYWORD_INDEX = {
+    keyword: (metal, priority)
+    for metal, keywords in METAL_KEYWORDS.items()
+    for priority, keyword in enumerate(keywords)
+}
+
+
 def map_columns_to_metals(df):
-    metal_columns = {}
-    df_cols = [col.lower() for col in df.columns]
-    for metal, keywords in METAL_KEYWORDS.items():
-        for keyword in keywords:
-            if keyword in df_cols:
-                original_col_name = df.columns[df_cols.index(keyword)]
-                # Filter only for metals that have defined limits
-                if metal in STANDARD_LIMITS:
-                    metal_columns[metal] = original_col_name
-                break
-    return metal_columns
+    """
+    Resolve metal -> column with one dictionary lookup per column.
+    For each metal the column matching its earliest keyword wins, and among
+    equal names the first column, as before.
+    """
+    best = {}
+    for col in df.columns:
+        hit = KEYWORD_INDEX.get(str(col).lower())
+        if hit is None:
+            continue
+        metal, priority = hit
+        if metal in STANDARD_LIMITS and (metal not in best or priority < best[metal][0]):
+            best[metal] = (priority, col)
+    return {metal: best[metal][1] for metal in METAL_KEYWORDS if metal in best}
+
+
+def resolve_metal_schema(df):
+    """Map metal columns and coerce all of them to numeric in a single vectorized pass."""
+    metal_columns = map_columns_to_metals(df)
+    cols = list(dict.fromkeys(metal_columns.values()))
+    if cols:
+        df[cols] = df[cols].apply(pd.to_numeric, errors='coerce')
+    return df, metal_columns
 
 def compute_hmpi_vectorized(df, metal_cols):
     """
@@ -183,6 +207,112 @@ def generate_sample_charts(df, metal_columns):
 
     return sample_charts
 
+# Rows parsed, converted and inserted per insert_many call
+INGEST_BATCH_SIZE = 5000
+# Concurrent insert_many calls (each runs on its own pooled connection)
+INGEST_WORKERS = 4
+
+
+def build_sample_documents(chunk, file_id, sample_id_col, metal_columns, timestamp):
+    """Build the Mongo sample documents for one parsed chunk, column by column."""
+    n = len(chunk)
+    if sample_id_col in chunk.columns:
+        locations = chunk[sample_id_col].tolist()
+    else:
+        locations = [f"Sample_{i + 1}" for i in chunk.index]
+
+    # Metal values: float with NaN -> None, converted once per column
+    metal_values = []
+    for col_name in metal_columns.values():
+        values = pd.to_numeric(chunk[col_name], errors='coerce').astype(float)
+        metal_values.append((col_name, values.astype(object).where(values.notna(), None).tolist()))
+
+    has_geometry = 'Latitude' in chunk.columns and 'Longitude' in chunk.columns
+    if has_geometry:
+        coordinates = zip(chunk['Longitude'].tolist(), chunk['Latitude'].tolist())
+    else:
+        coordinates = [None] * n
+
+    docs = []
+    for i, coords in enumerate(coordinates):
+        doc = {
+            'uploadId': file_id,
+            'location': locations[i],
+            'timestamp': timestamp,
+        }
+        if has_geometry:
+            doc['geometry'] = {'type': 'Point', 'coordinates': list(coords)}
+        for col_name, values in metal_values:
+            doc[col_name] = values[i]
+        docs.append(doc)
+    return docs
+
+
+def _insert_batch(batch_number, docs):
+    samples_collection.insert_many(docs, ordered=False)
+    return batch_number, len(docs)
+
+
+def _record_batches(file_id, done):
+    """Report finished batches on the upload document and return how many rows they held."""
+    rows = 0
+    for future in done:
+        batch_number, count = future.result()
+        rows += count
+        uploads_collection.update_one(
+            {'_id': file_id},
+            {'$inc': {'record_count': count, 'batches_done': 1}}
+        )
+        print(f"[LOG] Upload {file_id}: batch {batch_number} inserted ({count} rows)")
+    return rows
+
+
+def iter_upload_chunks(source, by_range=False):
+    """
+    Parsed chunks of INGEST_BATCH_SIZE rows in file order, read from a stream or
+    path. With by_range the file (a path) is parsed on all cores by byte range,
+    raising parallel_ingest.SplitMismatch on a quoted line break; chunk indexes
+    stay global either way, so the Sample_{n} fallback numbers rows the same.
+    """
+    if by_range:
+        for frame in parallel_ingest.iter_parallel_frames(source):
+            for start in range(0, len(frame), INGEST_BATCH_SIZE):
+                yield frame.iloc[start:start + INGEST_BATCH_SIZE]
+        return
+
+    yield from pd.read_csv(source, encoding='utf-8', chunksize=INGEST_BATCH_SIZE)
+
+
+def ingest_upload_chunks(chunks, file_id, timestamp):
+    """Insert the chunks as sample documents, a few batches at a time. Returns (records, batches)."""
+    record_count = 0
+    batch_number = 0
+    metal_columns = None
+    pending = set()
+
+    with ThreadPoolExecutor(max_workers=INGEST_WORKERS) as executor:
+        for chunk in chunks:
+            if metal_columns is None:
+                metal_columns = map_columns_to_metals(chunk)
+                sample_id_col = 'Sample_ID' if 'Sample_ID' in chunk.columns else 'Location'
+
+            docs = build_sample_documents(chunk, file_id, sample_id_col, metal_columns, timestamp)
+            if not docs:
+                continue
+            pending.add(executor.submit(_insert_batch, batch_number, docs))
+            batch_number += 1
+
+            # Keep at most two batches per worker in flight so memory stays bounded
+            if len(pending) >= INGEST_WORKERS * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                record_count += _record_batches(file_id, done)
+
+        done, _ = wait(pending)
+        record_count += _record_batches(file_id, done)
+
+    return record_count, batch_number
+
+
 @app.route('/upload', methods=['POST'])
 def upload_file():
     if 'file' not in request.files:
@@ -193,55 +323,79 @@ def upload_file():
         return jsonify({'error': 'No selected file'}), 400
 
     if file:
+        spilled = None
         try:
             file_id = ObjectId()
-            file_stream = io.StringIO(file.read().decode('utf-8'))
-            df = pd.read_csv(file_stream)
-            
-            data_to_insert = []
-            
-            sample_id_col = 'Sample_ID' if 'Sample_ID' in df.columns else 'Location'
-            
-            metal_columns = map_columns_to_metals(df)
-            
-            for index, row in df.iterrows():
-                doc = {
-                    'uploadId': file_id,
-                    'location': row.get(sample_id_col, f"Sample_{index+1}"),
-                    'timestamp': datetime.utcnow(),
-                }
-                
-                if 'Latitude' in row and 'Longitude' in row:
-                    doc['geometry'] = {
-                        'type': 'Point',
-                        'coordinates': [row['Longitude'], row['Latitude']]
-                    }
-                
-                for metal, col_name in metal_columns.items():
-                    doc[col_name] = float(row[col_name]) if not pd.isna(row[col_name]) else None
-                
-                data_to_insert.append(doc)
-            
-            if data_to_insert:
-                samples_collection.insert_many(data_to_insert)
+            started_at = datetime.utcnow()
 
+            # Header document first so progress can be polled while batches land
             uploads_collection.insert_one({
                 '_id': file_id,
                 'filename': file.filename,
                 'userId': request.form.get('userId'),
-                'upload_date': datetime.utcnow(),
-                'record_count': len(data_to_insert)
+                'upload_date': started_at,
+                'status': 'processing',
+                'record_count': 0,
+                'batches_done': 0
             })
 
+            ingested = None
+            if parallel_ingest.PARALLEL_INGEST_WORKERS > 1 and (request.content_length or 0) >= parallel_ingest.PARALLEL_INGEST_MIN_BYTES:
+                spilled = parallel_ingest.spill_to_named_file(file.stream)
+                if parallel_ingest.can_split_by_lines(spilled):
+                    try:
+                        ingested = ingest_upload_chunks(iter_upload_chunks(spilled, by_range=True), file_id, started_at)
+                    except parallel_ingest.SplitMismatch as e:
+                        # The insert pool has drained by now, so every batch already written is removed here
+                        print(f"[LOG] Upload {file_id}: {e}; re-reading serially")
+                        samples_collection.delete_many({'uploadId': file_id})
+                        uploads_collection.update_one({'_id': file_id}, {'$set': {'record_count': 0, 'batches_done': 0}})
+
+            if ingested is None:
+                if spilled is not None:
+                    with open(spilled, 'rb') as f:
+                        ingested = ingest_upload_chunks(iter_upload_chunks(f), file_id, started_at)
+                else:
+                    ingested = ingest_upload_chunks(iter_upload_chunks(file.stream), file_id, started_at)
+            record_count, batch_number = ingested
+
+            uploads_collection.update_one(
+                {'_id': file_id},
+                {'$set': {'status': 'complete', 'record_count': record_count}}
+            )
+
+            elapsed = (datetime.utcnow() - started_at).total_seconds()
             return jsonify({
                 'message': 'File processed successfully',
                 'fileId': str(file_id),
-                'record_count': len(data_to_insert)
+                'record_count': record_count,
+                'batches': batch_number,
+                'rows_per_second': round(record_count / elapsed, 1) if elapsed > 0 else None
             }), 200
 
         except Exception as e:
             traceback.print_exc()
+            uploads_collection.update_one({'_id': file_id}, {'$set': {'status': 'failed', 'error': str(e)}})
             return jsonify({'error': f'An error occurred during file processing: {str(e)}'}), 500
+        finally:
+            if spilled is not None:
+                os.remove(spilled)
+
+
+@app.route('/upload_status/<file_id>', methods=['GET'])
+def upload_status(file_id):
+    if not ObjectId.is_valid(file_id):
+        return jsonify({'error': 'File not found'}), 404
+    upload_doc = uploads_collection.find_one({'_id': ObjectId(file_id)})
+    if not upload_doc:
+        return jsonify({'error': 'File not found'}), 404
+    return jsonify({
+        'fileId': file_id,
+        'status': upload_doc.get('status', 'complete'),
+        'record_count': upload_doc.get('record_count', 0),
+        'batches_done': upload_doc.get('batches_done'),
+        'error': upload_doc.get('error')
+    }), 200
 
 @app.route('/charts/<file_id>', methods=['GET'])
 def get_charts(file_id):
@@ -255,12 +409,7 @@ def get_charts(file_id):
             return jsonify({'error': 'No samples found for this file'}), 404
 
         df = pd.DataFrame(samples)
-        
-        for col in df.columns:
-            if any(kw in col.lower() for kw in sum(METAL_KEYWORDS.values(), [])):
-                df[col] = pd.to_numeric(df[col], errors='coerce')
-        
-        metal_columns = map_columns_to_metals(df)
+        df, metal_columns = resolve_metal_schema(df)
 
         if not metal_columns:
             return jsonify({'error': 'No heavy metal concentration data found'}), 400
@@ -276,14 +425,11 @@ def get_charts(file_id):
             line_fig = px.line(df_clean, x=df_clean.index, y='HMPI', title='HMPI Values Over Samples')
             charts['line_chart'] = json.loads(pio.to_json(line_fig))
         
-        bins = [0, 60, 100, np.inf]
-        labels = ['Safe (≤60)', 'Moderate (61–100)', 'High (>100)']
-        df_clean['RiskCategory'] = pd.cut(df_clean['HMPI'], bins=bins, labels=labels, right=True)
-        risk_counts = df_clean['RiskCategory'].value_counts().reset_index()
-        risk_counts.columns = ['RiskCategory', 'count']
-
-        if len(risk_counts) == 1:
-            risk = risk_counts['RiskCategory'].iloc[0]
+        counts = risk_counts(df_clean['HMPI'])
+        risk_count_df = pd.DataFrame({'RiskCategory': counts.index, 'count': counts.values})
+
+        if (counts > 0).sum() == 1:
+            risk = counts.idxmax()
             pie_fig = px.pie(
                 values=[1], 
                 names=[risk], 
@@ -292,7 +438,7 @@ def get_charts(file_id):
             )
         else:
             pie_fig = px.pie(
-                risk_counts, 
+                risk_count_df, 
                 values="count", 
                 names="RiskCategory", 
                 title="Risk Distribution"
@@ -342,12 +488,7 @@ def start_pdf_generation(file_id):
             return jsonify({'error': 'No samples found for this file'}), 404
 
         df = pd.DataFrame(samples)
-        
-        for col in df.columns:
-            if any(kw in col.lower() for kw in sum(METAL_KEYWORDS.values(), [])):
-                df[col] = pd.to_numeric(df[col], errors='coerce')
-        
-        metal_columns = map_columns_to_metals(df)
+        df, metal_columns = resolve_metal_schema(df)
 
         if not metal_columns:
             return jsonify({'error': 'No heavy metal concentration data found'}), 400
@@ -375,16 +516,15 @@ def start_pdf_generation(file_id):
         from reportlab.lib import colors
         
         table_data = [['Sample Location', 'HMPI Value', 'Risk Category']]
-        bins = [0, 60, 100, np.inf]
-        labels = ['Safe', 'Moderate', 'High']
-        df_clean['RiskCategory'] = pd.cut(df_clean['HMPI'], bins=bins, labels=labels, right=True)
-        
-        df = df.merge(df_clean[['HMPI', 'RiskCategory']], on='HMPI', how='left', suffixes=('', '_clean')).fillna({'RiskCategory_clean': 'N/A'})
-
-        for _, row in df.iterrows():
-            hmpi_val = f"{row['HMPI']:.2f}" if not pd.isna(row['HMPI']) else "N/A"
-            risk_cat = row.get('RiskCategory_clean', 'N/A')
-            table_data.append([row.get('location', 'N/A'), hmpi_val, risk_cat])
+        # Categories are assigned index-aligned, so duplicate HMPI values cannot multiply rows
+        df['HMPI'] = df['HMPI'].replace([np.inf, -np.inf], np.nan)
+        df['RiskCategory'] = classify_risk(df['HMPI'], labels=RISK_SHORT_LABELS, missing='N/A')
+
+        locations = df['location'].tolist() if 'location' in df.columns else ['N/A'] * len(df)
+        table_data.extend(
+            [location, "N/A" if hmpi != hmpi else f"{hmpi:.2f}", risk]
+            for location, hmpi, risk in zip(locations, df['HMPI'].tolist(), df['RiskCategory'].astype(str).tolist())
+        )
         
         table = Table(table_data, colWidths=[2*inch, 1.5*inch, 2*inch])
         table.setStyle(TableStyle([
@@ -413,8 +553,8 @@ def start_pdf_generation(file_id):
             story.append(Spacer(1, 0.2 * inch))
 
             # Pie Chart
-            pie_counts = df_clean['RiskCategory'].value_counts().reset_index()
-            pie_counts.columns = ['RiskCategory', 'count']
+            counts = risk_counts(df_clean['HMPI'], labels=RISK_SHORT_LABELS)
+            pie_counts = pd.DataFrame({'RiskCategory': counts.index, 'count': counts.values})
             pie_fig = px.pie(
                 pie_counts, values="count", names="RiskCategory", title="Risk Distribution"
             )
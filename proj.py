@@ -1,4 +1,4 @@
-from flask import Flask, json, request, jsonify, send_file,Response
+from flask import Flask, json, request, jsonify, send_file,Response, stream_with_context
 from flask_cors import CORS
 import pandas as pd
 import numpy as np
@@ -6,13 +6,35 @@ import io
 import os
 import traceback
 from google.auth.transport import requests
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne, ASCENDING, ReturnDocument
 import uuid
 import re
 import base64
 import math
+import zipfile
+import csv
+import struct
+import zlib
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import hmac
+import tempfile
+import importlib.util
+import shutil
+from xml.sax.saxutils import escape as xml_escape
 from bson import ObjectId
+from werkzeug.datastructures import FileStorage
 from pdf_export import generate_sample_charts
+import forecasting
+import metrics
+import memprofile
+import mongo_monitoring
+import parallel_ingest
+from parallel_ingest import read_csv_with_plan
+from risk import RISK_LABELS, RISK_SHORT_LABELS, RISK_COLORS, RISK_THRESHOLDS, risk_codes, classify_risk, risk_counts
 import plotly.graph_objects as go
 import plotly.express as px
 import plotly.io as pio
@@ -26,7 +48,9 @@ import base64
 from io import BytesIO
 from sklearn.cluster import DBSCAN
 from sklearn.preprocessing import StandardScaler
-from openpyxl import Workbook
+from scipy.spatial import cKDTree
+from scipy import sparse, special
+from openpyxl import Workbook, load_workbook
 from dotenv import load_dotenv
 import os
 from pymongo import MongoClient
@@ -41,9 +65,14 @@ MONGO_URI = os.getenv("MONGO_URI")
 
 app = Flask(__name__)
 CORS(app)
-client = MongoClient(MONGO_URI)
+metrics.init_app(app)
+memprofile.init_app(app)
+client = MongoClient(MONGO_URI, event_listeners=mongo_monitoring.listeners())
 db = client['heavy_metal_db']
 samples_collection = db['samples']
+site_timeseries_collection = db['site_timeseries']
+forecast_models_collection = db['forecast_models']
+upload_hashes_collection = db['upload_hashes']
 
 def verify_jwt():
     auth = request.headers.get("Authorization")
@@ -383,6 +412,7 @@ def get_pricing_info():
 def allowed_file(filename):
     return filename.lower().endswith(('.csv','.xls','.xlsx'))
 
+@metrics.timed("detect_metal_columns")
 def detect_metal_columns(df):
     metal_cols = {}
     for metal, keywords in METAL_KEYWORDS.items():
@@ -395,6 +425,7 @@ def detect_metal_columns(df):
             metal_cols[metal] = found_cols
     return metal_cols
 
+@metrics.timed("merge_metal_columns")
 def merge_metal_columns(df, metal_cols):
     merged_df = df.copy()
     merged_cols = {}
@@ -417,21 +448,25 @@ def validate_geo_columns(df):
         geo_cols[col] = matches[0] if matches else None
     return geo_cols
 
-def handle_missing_values(df, metal_cols, strategy='half', detection_limits=None):
+@metrics.timed("handle_missing_values")
+def handle_missing_values(df, metal_cols, strategy='half', detection_limits=None, fill_values=None):
+    """fill_values pins the per-metal fill (e.g. computed over a whole file that is processed in pieces)."""
     df_clean = df.copy()
     for metal in metal_cols:
         if metal not in df_clean.columns:
             continue
-        if strategy=='half':
+        if fill_values is not None and strategy != 'none':
+            df_clean[metal] = df_clean[metal].fillna(fill_values.get(metal, np.nan))
+        elif strategy=='half':
             fill_val = 0.5*df_clean[metal].min() if detection_limits is None else 0.5*detection_limits.get(metal,0)
             df_clean[metal] = df_clean[metal].fillna(fill_val)
 
         elif strategy=='zero':
-            df_clean[metal].fillna(0, inplace=True)
+            df_clean[metal] = df_clean[metal].fillna(0)
         elif strategy=='mean':
-            df_clean[metal].fillna(df_clean[metal].mean(), inplace=True)
+            df_clean[metal] = df_clean[metal].fillna(df_clean[metal].mean())
         elif strategy=='median':
-            df_clean[metal].fillna(df_clean[metal].median(), inplace=True)
+            df_clean[metal] = df_clean[metal].fillna(df_clean[metal].median())
         elif strategy=='none':
             df_clean[metal] = df_clean[metal].astype(float)
     return df_clean
@@ -448,10 +483,81 @@ STANDARD_LIMITS = {
     "Iron": 0.3,
     "Manganese": 0.1
 }
-def compute_hmpi_vectorized(df, metal_cols):
+
+IMPUTATION_STRATEGIES = ("half", "zero", "mean", "median", "none")
+
+# Changes whenever the limits change, so cached results of an identical file are not reused across standards
+STANDARDS_VERSION = hashlib.sha1(repr(sorted(STANDARD_LIMITS.items())).encode()).hexdigest()[:12]
+
+# Concentration unit stated in a header (e.g. As_mg_L, Pb_ug_L, "Cd (µg/L)", Zn_ppb) -> factor to mg/L
+UNIT_HEADER_PATTERNS = (
+    (re.compile(r'(?<![a-z])ng[\s_\-]*(?:/|per)?[\s_\-]*l(?![a-z])'), 1e-6),
+    (re.compile(r'(?<![a-z])(?:ug|µg|μg|mcg|microg)[\s_\-]*(?:/|per)?[\s_\-]*l(?![a-z])'), 0.001),
+    (re.compile(r'(?<![a-z])ppb(?![a-z])'), 0.001),
+    (re.compile(r'(?<![a-z])mg[\s_\-]*(?:/|per)?[\s_\-]*l(?![a-z])'), 1.0),
+    (re.compile(r'(?<![a-z])ppm(?![a-z])'), 1.0),
+)
+
+# Rows (evenly spaced) behind the fallback statistic when a header states no unit
+UNIT_SAMPLE_ROWS = 100_000
+
+
+def header_unit_factor(column):
+    """Factor to mg/L stated in a column header, or None when the header is silent."""
+    name = str(column).lower()
+    for pattern, factor in UNIT_HEADER_PATTERNS:
+        if pattern.search(name):
+            return factor
+    return None
+
+
+def sampled_unit_factor(values, metal, sample_rows=UNIT_SAMPLE_ROWS):
+    """
+    Fallback for unlabelled columns: values far above the standard (a sampled
+    maximum over 100 x limit) are taken to be μg/L.
+    """
+    values = np.asarray(values, dtype=float)
+    if len(values) > sample_rows:
+        values = values[np.linspace(0, len(values) - 1, sample_rows).astype(np.int64)]
+    values = values[~np.isnan(values)]
+    return 0.001 if len(values) and values.max() > 100 * STANDARD_LIMITS[metal] else 1.0
+
+
+def resolve_unit_schema(metal_cols, frames, source_cols=None):
+    """
+    Decide each metal's conversion to mg/L once per upload. A unit stated by
+    every source header of the metal (source_cols, as from detect_metal_columns)
+    wins; otherwise one sampled statistic over its values in `frames` decides.
+    Returns {"unit_factors": {metal: factor}, "unit_sources": {metal: "header" | "sampled"}}.
+    """
+    frames = [frames] if isinstance(frames, pd.DataFrame) else list(frames)
+    factors, sources = {}, {}
+    for metal, col in metal_cols.items():
+        if metal not in STANDARD_LIMITS or not frames or col not in frames[0].columns:
+            continue
+        stated = {header_unit_factor(c) for c in (source_cols or {}).get(metal, [col])}
+        if len(stated) == 1 and None not in stated:
+            factors[metal], sources[metal] = stated.pop(), "header"
+            continue
+        if len(stated - {None}) > 1:
+            print(f"[LOG] Conflicting units in the {metal} columns {source_cols[metal]}; sampling values instead")
+        values = np.concatenate([frame[col].to_numpy(dtype=float, na_value=np.nan) for frame in frames])
+        factors[metal], sources[metal] = sampled_unit_factor(values, metal), "sampled"
+    return {"unit_factors": factors, "unit_sources": sources}
+
+
+def upload_unit_factors(doc):
+    """Unit factors pinned when the upload was processed (None for uploads stored before they were)."""
+    return ((doc or {}).get("schema") or {}).get("unit_factors")
+
+
+@metrics.timed("compute_hmpi")
+def compute_hmpi_vectorized(df, metal_cols, unit_factors=None):
     """
     Compute HMPI for a dataframe with metal concentrations.
     Uranium is included in HMPI calculation only if present in DataFrame.
+    unit_factors pins the per-metal conversion to mg/L; by default it is
+    resolved from this frame (see resolve_unit_schema).
     """
     df_hmpi = df.copy()
 
@@ -463,14 +569,17 @@ def compute_hmpi_vectorized(df, metal_cols):
         return df_hmpi
 
     Wi_total = sum(1 / STANDARD_LIMITS[metal] for metal in valid_metals)
+    if unit_factors is None:
+        unit_factors = resolve_unit_schema(valid_metals, df_hmpi)["unit_factors"]
 
     for metal, col in valid_metals.items():
         Si = STANDARD_LIMITS[metal]
         Ci = df_hmpi[col].copy()
 
-        # Convert μg/L → mg/L if Ci is much higher than standard (heuristic)
-        if (Ci > 100 * Si).any():
-            Ci = Ci / 1000
+        # Convert μg/L → mg/L
+        factor = unit_factors.get(metal, 1.0)
+        if factor != 1.0:
+            Ci = Ci * factor
 
         Qi = (Ci / Si) * 100
         Wi = (1 / Si) / Wi_total
@@ -485,28 +594,257 @@ def compute_hmpi_vectorized(df, metal_cols):
     df_hmpi = df_hmpi.round(4)
     return df_hmpi
 
-def load_file(file):
+# "c" (default) or "pyarrow"; the Arrow engine is used only when pyarrow is installed
+CSV_PARSER_ENGINE = os.getenv("CSV_PARSER_ENGINE", "c").lower()
+if CSV_PARSER_ENGINE == "pyarrow" and importlib.util.find_spec("pyarrow") is None:
+    print("[LOG] CSV_PARSER_ENGINE=pyarrow but pyarrow is not installed; using the C parser")
+    CSV_PARSER_ENGINE = "c"
+
+
+def resolve_csv_read_plan(columns):
+    """
+    From the header alone, pick the columns the pipeline reads (Sample_ID,
+    location/lat/lon, sampling date, metals) and pin float64 for the numeric ones.
+    Returns read_csv keyword arguments for those columns.
+    """
+    columns = [str(col) for col in columns]
+    metal_cols = detect_metal_columns(pd.DataFrame(columns=columns))
+    numeric = {col for cols in metal_cols.values() for col in cols}
+    numeric |= {col for col in columns if col.lower() in ('latitude', 'longitude')}
+
+    keep = []
+    for position, col in enumerate(columns):
+        lowered = col.strip().lower()
+        if col in numeric or col == 'Sample_ID' or lowered in SAMPLING_DATE_COLUMNS \
+                or any(geo in lowered for geo in ('location', 'latitude', 'longitude')):
+            keep.append(position)
+
+    return {
+        "usecols": keep,
+        "dtype": {col: "float64" for col in columns if col in numeric}
+    }
+
+
+def read_csv_projected(stream):
+    """Two-phase read: sniff the header, then parse only what the pipeline needs."""
+    start = stream.tell()
+    header = pd.read_csv(stream, nrows=0).columns
+    stream.seek(start)
+    return read_csv_with_plan(stream, resolve_csv_read_plan(header), CSV_PARSER_ENGINE)
+
+
+# ========== EXCEL INGEST ==========
+
+EXCEL_INGEST_CHUNK_ROWS = 20000
+# "openpyxl" streams .xlsx in read-only mode; "calamine" (python-calamine) is a faster native reader for .xlsx and .xls
+EXCEL_READER = os.getenv("EXCEL_READER", "calamine" if importlib.util.find_spec("python_calamine") else "openpyxl").lower()
+
+
+def excel_header_names(values):
+    """Header cells named the way read_excel names them ("Unnamed: i", duplicates as "X.1")."""
+    names, seen = [], {}
+    for i, value in enumerate(values):
+        name = f"Unnamed: {i}" if value is None or (isinstance(value, str) and not value.strip()) else str(value)
+        if name in seen:
+            seen[name] += 1
+            name = f"{name}.{seen[name]}"
+        else:
+            seen[name] = 0
+        names.append(name)
+    return names
+
+
+def _select_sheet(sheet_names, sheet):
+    """Sheet by name, or by 0-based position when given an int or a digit string; first sheet by default."""
+    if sheet is None or sheet == "":
+        return sheet_names[0]
+    if sheet in sheet_names:
+        return sheet
+    if str(sheet).isdigit() and int(sheet) < len(sheet_names):
+        return sheet_names[int(sheet)]
+    raise ValueError(f"Sheet '{sheet}' not found; available sheets: {', '.join(sheet_names)}")
+
+
+def resolve_upload_sheet(stream, filename, sheet):
+    """
+    The sheet an upload is read from, in the form its dedup key uses: None for
+    CSV files and for the first sheet (however it was asked for), otherwise
+    the sheet's name. Raises ValueError for a sheet the workbook does not have.
+    """
+    if not filename.lower().endswith(('.xls', '.xlsx')):
+        return None
+    position = stream.tell()
+    try:
+        if EXCEL_READER == "calamine":
+            from python_calamine import CalamineWorkbook
+            sheet_names = CalamineWorkbook.from_filelike(stream).sheet_names
+        elif filename.lower().endswith('.xls'):
+            sheet_names = pd.ExcelFile(stream).sheet_names
+        else:
+            workbook = load_workbook(stream, read_only=True)
+            sheet_names = workbook.sheetnames
+            workbook.close()
+    finally:
+        stream.seek(position)
+    name = _select_sheet(sheet_names, sheet)
+    return None if name == sheet_names[0] else name
+
+
+def _iter_excel_rows(stream, filename, sheet):
+    """Cell values row by row, without building a cell object per cell."""
+    if EXCEL_READER == "calamine":
+        from python_calamine import CalamineWorkbook
+        workbook = CalamineWorkbook.from_filelike(stream)
+        yield from workbook.get_sheet_by_name(_select_sheet(workbook.sheet_names, sheet)).iter_rows()
+        return
+
+    if filename.lower().endswith('.xls'):
+        # openpyxl cannot read the legacy format; read_excel (xlrd) it is
+        df = pd.read_excel(stream, sheet_name=sheet if sheet not in (None, "") else 0, header=None)
+        yield from df.astype(object).where(df.notna(), None).itertuples(index=False, name=None)
+        return
+
+    workbook = load_workbook(stream, read_only=True, data_only=True)
+    try:
+        yield from workbook[_select_sheet(workbook.sheetnames, sheet)].iter_rows(values_only=True)
+    finally:
+        workbook.close()
+
+
+def iter_excel_frames(stream, filename, sheet=None, chunk_rows=EXCEL_INGEST_CHUNK_ROWS):
+    """
+    Stream one sheet as DataFrame chunks holding only the columns the pipeline
+    reads (see resolve_csv_read_plan), with the numeric ones coerced to float64.
+    Fully empty rows are skipped; the index runs on across chunks.
+    """
+    rows = _iter_excel_rows(stream, filename, sheet)
+    header = next(rows, None)
+    if header is None:
+        raise ValueError("The selected sheet is empty")
+    names = excel_header_names(header)
+    plan = resolve_csv_read_plan(names)
+    keep = plan["usecols"]
+    kept_names = [names[i] for i in keep]
+
+    offset = 0
+    while True:
+        chunk = []
+        for row in rows:
+            if any(value is not None and value != "" for value in row):
+                chunk.append([row[i] if i < len(row) else None for i in keep])
+            if len(chunk) >= chunk_rows:
+                break
+        if not chunk:
+            break
+
+        frame = pd.DataFrame(chunk, columns=kept_names, index=pd.RangeIndex(offset, offset + len(chunk)))
+        for col in plan["dtype"]:
+            frame[col] = pd.to_numeric(frame[col], errors="coerce").astype("float64")
+        offset += len(chunk)
+        yield frame
+        if len(chunk) < chunk_rows:
+            break
+    if offset == 0:
+        raise ValueError("The selected sheet has a header but no data rows")
+
+
+@metrics.timed("load_file")
+def load_file(file, sheet=None):
     """Reads CSV or Excel into pandas DataFrame"""
     if file.filename.lower().endswith('.csv'):
-        return pd.read_csv(file)
+        return read_csv_projected(file.stream)
     elif file.filename.lower().endswith(('.xls', '.xlsx')):
-        return pd.read_excel(file)
+        return pd.concat(list(iter_excel_frames(file.stream, file.filename, sheet)))
     else:
         raise ValueError("Unsupported file format")
 
-def preprocess_dataframe(df):
-    metal_cols = detect_metal_columns(df)      
+def merge_upload_metals(df, metal_cols=None):
+    metal_cols = detect_metal_columns(df) if metal_cols is None else metal_cols
     df_merged, merged_cols = merge_metal_columns(df, metal_cols)  
     
     if 'Uranium' in merged_cols and 'Uranium' not in df_merged.columns:
         merged_cols.pop('Uranium')
+    return df_merged, merged_cols
+
+def preprocess_dataframe(df, strategy="half", metal_cols=None):
+    df_merged, merged_cols = merge_upload_metals(df, metal_cols)
     
-    df_clean = handle_missing_values(df_merged, merged_cols, strategy="half")  
+    df_clean = handle_missing_values(df_merged, merged_cols, strategy=strategy)  
     geo_cols = validate_geo_columns(df_clean)  
     return df_clean, merged_cols
 
 
 
+# ========== UPLOAD SUMMARY AGGREGATES ==========
+
+SUMMARY_HISTOGRAM_BINS = 20
+SUMMARY_QUANTILES = (0.05, 0.25, 0.5, 0.75, 0.95)
+
+
+def _finite_or_none(value):
+    value = float(value)
+    return value if math.isfinite(value) else None
+
+
+def summarize_values(values) -> dict:
+    """Moments, quantiles and a fixed-bin histogram of one numeric column (NaN ignored)."""
+    values = pd.to_numeric(pd.Series(values), errors="coerce").to_numpy(dtype=float)
+    valid = values[np.isfinite(values)]
+    summary = {"count": int(valid.size), "missing": int(values.size - valid.size)}
+    if valid.size == 0:
+        summary.update({"mean": None, "std": None, "min": None, "max": None, "median": None,
+                        "quantiles": {}, "histogram": {"edges": [], "counts": []}})
+        return summary
+
+    quantiles = np.quantile(valid, SUMMARY_QUANTILES)
+    counts, edges = np.histogram(valid, bins=SUMMARY_HISTOGRAM_BINS)
+    summary.update({
+        "mean": _finite_or_none(valid.mean()),
+        "std": _finite_or_none(valid.std(ddof=1)) if valid.size > 1 else None,
+        "min": _finite_or_none(valid.min()),
+        "max": _finite_or_none(valid.max()),
+        "median": _finite_or_none(np.median(valid)),
+        "quantiles": {f"q{int(q * 100):02d}": _finite_or_none(v) for q, v in zip(SUMMARY_QUANTILES, quantiles)},
+        "histogram": {"edges": [float(e) for e in edges], "counts": counts.astype(int).tolist()},
+    })
+    return summary
+
+
+@metrics.timed("upload_summary")
+def compute_upload_summary(df_hmpi: pd.DataFrame, metals) -> dict:
+    """Aggregates stored with each upload so summaries, exports and reports never rescan the samples."""
+    hmpi = df_hmpi["HMPI"] if "HMPI" in df_hmpi.columns else pd.Series(np.nan, index=df_hmpi.index)
+    counts = risk_counts(hmpi)
+    return {
+        "total_samples": int(len(df_hmpi)),
+        "hmpi": summarize_values(hmpi),
+        "metals": {metal: summarize_values(df_hmpi[metal]) for metal in metals if metal in df_hmpi.columns},
+        "risk_counts": {label: int(counts[label]) for label in RISK_LABELS},
+        "computed_at": datetime.utcnow(),
+    }
+
+
+def get_upload_summary(file_id, doc=None):
+    """Stored summary of an upload; older uploads get it computed once from their features and saved."""
+    if doc is None or "summary" not in doc:
+        doc = samples_collection.find_one({'_id': file_id}, {'summary': 1})
+        if not doc:
+            return None
+    if doc.get("summary"):
+        return doc["summary"]
+
+    hmpi, conc = [], []
+    for batch in iter_upload_features(file_id):
+        for feature in batch:
+            hmpi.append(feature.get("HMPI"))
+            conc.append(feature.get("all_metal_conc") or {})
+    df = pd.DataFrame.from_records(conc)
+    df["HMPI"] = pd.to_numeric(pd.Series(hmpi, dtype=object), errors="coerce")
+    summary = compute_upload_summary(df, [m for m in df.columns if m in STANDARD_LIMITS])
+    samples_collection.update_one({'_id': file_id}, {'$set': {'summary': summary}})
+    return summary
+
+
 def prepare_geojson(df, geo_cols):
     if geo_cols.get('Latitude') and geo_cols.get('Longitude'):
         df_geo = df.copy()
@@ -529,8 +867,10 @@ def upload_file():
         df = load_file(file)
 
         
-        df_clean, merged_cols = preprocess_dataframe(df)
-        df_hmpi = compute_hmpi_vectorized(df_clean, merged_cols)
+        metal_cols = detect_metal_columns(df)
+        df_clean, merged_cols = preprocess_dataframe(df, metal_cols=metal_cols)
+        unit_factors = resolve_unit_schema(merged_cols, df_clean, metal_cols)["unit_factors"]
+        df_hmpi = compute_hmpi_vectorized(df_clean, merged_cols, unit_factors=unit_factors)
 
        
         valid_metals_for_geo = [m for m in merged_cols if m in df_hmpi.columns]
@@ -735,7 +1075,7 @@ def get_charts(file_id):
         metal_cols = {m: m for m in df.columns if m in STANDARD_LIMITS}
 
         # Compute HMPI
-        df_hmpi = compute_hmpi_vectorized(df, metal_cols)
+        df_hmpi = compute_hmpi_vectorized(df, metal_cols, unit_factors=upload_unit_factors(doc))
 
         charts = {}
 
@@ -751,13 +1091,10 @@ def get_charts(file_id):
             charts["line_chart"] = json.loads(pio.to_json(line_fig))
 
             # --- Risk Distribution Pie ---
-            bins = [0, 60, 100, np.inf]
-            labels = ["Safe (≤60)", "Moderate (61–100)", "High (>100)"]
-            df_clean["RiskCategory"] = pd.cut(df_clean["HMPI"], bins=bins, labels=labels, right=True)
-            risk_counts = df_clean["RiskCategory"].value_counts().reset_index()
-            risk_counts.columns = ["RiskCategory", "count"]
+            counts = pd.Series(get_upload_summary(file_id, doc)["risk_counts"]).reindex(list(RISK_LABELS), fill_value=0)
+            risk_count_df = pd.DataFrame({"RiskCategory": counts.index, "count": counts.values})
 
-            pie_fig = px.pie(risk_counts, values="count", names="RiskCategory", title="Risk Distribution")
+            pie_fig = px.pie(risk_count_df, values="count", names="RiskCategory", title="Risk Distribution")
             pie_fig.update_layout(
     paper_bgcolor="rgba(0,0,0,0)",
     font=dict(color="white")
@@ -773,7 +1110,12 @@ def get_charts(file_id):
             coords["Latitude"] = coords["geometry"].apply(
                 lambda g: g["coordinates"][1] if isinstance(g, dict) else None
             )
-            if not coords.empty:
+            # Large surveys are rendered server-side by /tiles instead of shipping every point
+            charts["heatmap_tiles"] = {
+                "url": f"/tiles/{file_id}/{{z}}/{{x}}/{{y}}.png",
+                "styles": list(TILE_STYLES),
+            }
+            if not coords.empty and len(coords) <= HEATMAP_POINT_LIMIT:
                 heatmap_fig = px.density_mapbox(
                     coords,
                     lat="Latitude",
@@ -820,58 +1162,1015 @@ def get_user(user_id):
     user["_id"] = str(user["_id"])
     return jsonify(user)
 
+# ========== PROCESSING PIPELINE ==========
+
+UPLOAD_SPOOL_MAX_MEMORY = 8 * 1024 * 1024
+UPLOAD_READ_CHUNK = 1024 * 1024
+# A duplicate upload waits for the first copy to finish processing; claims older than this are abandoned
+UPLOAD_CLAIM_TIMEOUT = timedelta(seconds=int(os.getenv("UPLOAD_CLAIM_TIMEOUT_SECONDS", "900")))
+UPLOAD_CLAIM_POLL_SECONDS = 0.5
+
+
+@metrics.timed("build_features")
+def build_geojson_features(df_hmpi, metals):
+    """GeoJSON-style feature per row, assembled from whole columns rather than row by row."""
+    n = len(df_hmpi)
+
+    def column(name):
+        return df_hmpi[name].tolist() if name in df_hmpi.columns else [None] * n
+
+    # Rows without a Sample_ID are numbered S1, S2... in file order, as /upload does
+    if "Sample_ID" in df_hmpi.columns:
+        sample_ids = df_hmpi["Sample_ID"].tolist()
+        unnamed = (df_hmpi["Sample_ID"].isna() | (df_hmpi["Sample_ID"] == "")).to_numpy()
+    else:
+        sample_ids = [None] * n
+        unnamed = np.ones(n, dtype=bool)
+    for number, i in enumerate(np.flatnonzero(unnamed), start=1):
+        sample_ids[i] = f"S{number}"
+    longitudes, latitudes = column("Longitude"), column("Latitude")
+    if "Latitude" in df_hmpi.columns and "Longitude" in df_hmpi.columns:
+        latlon_flags = (df_hmpi["Latitude"].notna() & df_hmpi["Longitude"].notna()).tolist()
+    else:
+        latlon_flags = [False] * n
+    hmpi = df_hmpi["HMPI"].round(4).astype(object).where(df_hmpi["HMPI"].notna(), None).tolist() \
+        if "HMPI" in df_hmpi.columns else [None] * n
+    metal_values = [(m, df_hmpi[m].tolist()) for m in metals]
+
+    features = []
+    for i in range(n):
+        metal_conc = {m: values[i] for m, values in metal_values if values[i] == values[i] and values[i] is not None}
+        features.append({
+            "Sample_ID": sample_ids[i],
+            "no_of_metals": len(metal_conc),
+            "all_metal_conc": metal_conc,
+            "geometry": {
+                "type": "Point",
+                "coordinates": [longitudes[i], latitudes[i]]
+            },
+            "latitudeandlongitudepresent": latlon_flags[i],
+            "HMPI": hmpi[i]
+        })
+    return features
+
+
+def run_processing_pipeline(df, strategy="half"):
+    """
+    Clean, score and convert one uploaded table. Returns (df_hmpi, metals,
+    features, schema), schema holding the unit factors the scores were computed with.
+    """
+    metal_cols = detect_metal_columns(df)
+    df_clean, merged_cols = preprocess_dataframe(df, strategy, metal_cols)
+    schema = resolve_unit_schema(merged_cols, df_clean, metal_cols)
+    df_hmpi = compute_hmpi_vectorized(df_clean, merged_cols, unit_factors=schema["unit_factors"])
+
+    # Only consider metals actually present in the DataFrame
+    metals = [m for m in merged_cols if m in df_hmpi.columns]
+    return df_hmpi, metals, build_geojson_features(df_hmpi, metals), schema
+
+
+def pinned_fill_values(frames, merged_cols, strategy):
+    """Fill value per metal over all pieces of one file, as handle_missing_values would compute it on the whole."""
+    if strategy == "none":
+        return None
+    fill_values = {}
+    for metal in merged_cols:
+        columns = [frame[metal] for frame in frames if metal in frame.columns]
+        if not columns:
+            continue
+        if strategy == "half":
+            fill_values[metal] = 0.5 * min((c.min() for c in columns), default=np.nan)
+        elif strategy == "zero":
+            fill_values[metal] = 0.0
+        elif strategy == "mean":
+            total, count = sum(c.sum() for c in columns), sum(c.count() for c in columns)
+            fill_values[metal] = total / count if count else np.nan
+        elif strategy == "median":
+            fill_values[metal] = pd.concat(columns, ignore_index=True).median()
+    return fill_values
+
+
+def run_chunked_processing_pipeline(frames, strategy="half", workers=parallel_ingest.PARALLEL_INGEST_WORKERS):
+    """
+    run_processing_pipeline over the pieces of one file (in order): they are
+    merged and scored on threads with the missing-value fills and unit factors
+    pinned from the whole file, so the result equals a serial run.
+
+    Scoring stays in this process: the fills need every piece first, and
+    shipping the pieces back to a process pool costs about what scoring them
+    (a few vectorized column operations) saves.
+    """
+    frames = list(frames)
+    if not frames:
+        raise ValueError("The file has no data rows")
+    metal_cols = detect_metal_columns(frames[0])
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        merged = list(pool.map(lambda frame: merge_upload_metals(frame, metal_cols), frames))
+        frames, merged_cols = [m[0] for m in merged], merged[0][1]
+
+        fill_values = pinned_fill_values(frames, merged_cols, strategy)
+        schema = resolve_unit_schema(merged_cols, frames, metal_cols)
+
+        def score(frame):
+            df_clean = handle_missing_values(frame, merged_cols, strategy=strategy, fill_values=fill_values)
+            return compute_hmpi_vectorized(df_clean, merged_cols, unit_factors=schema["unit_factors"])
+
+        df_hmpi = pd.concat(list(pool.map(score, frames)))
+
+    metals = [m for m in merged_cols if m in df_hmpi.columns]
+    return df_hmpi, metals, build_geojson_features(df_hmpi, metals), schema
+
+
+def run_parallel_processing_pipeline(path, strategy="half", workers=parallel_ingest.PARALLEL_INGEST_WORKERS):
+    """run_processing_pipeline for a large CSV on disk, with byte ranges parsed in a process pool."""
+    plan = resolve_csv_read_plan(pd.read_csv(path, nrows=0).columns)
+    frames = parallel_ingest.iter_parallel_frames(path, plan, CSV_PARSER_ENGINE, workers)
+    return run_chunked_processing_pipeline(frames, strategy, workers)
+
+
+def process_upload_file(file, strategy="half", sheet=None):
+    """
+    Run the pipeline on an uploaded file: large CSVs spilled to disk are parsed
+    in parallel, Excel sheets are streamed in row chunks.
+    """
+    filename = file.filename.lower()
+    path = getattr(file.stream, "name", None)
+    if filename.endswith('.csv') and isinstance(path, str) and os.path.exists(path) \
+            and parallel_ingest.should_parse_in_parallel(path):
+        file.stream.flush()
+        print(f"[LOG] Parsing {file.filename} in parallel ({os.path.getsize(path) // (1024 * 1024)} MB)")
+        try:
+            return run_parallel_processing_pipeline(path, strategy)
+        except parallel_ingest.SplitMismatch as e:
+            print(f"[LOG] {e}; parsing serially")
+            file.stream.seek(0)
+    if filename.endswith(('.xls', '.xlsx')):
+        return run_chunked_processing_pipeline(iter_excel_frames(file.stream, file.filename, sheet), strategy)
+    return run_processing_pipeline(load_file(file), strategy)
+
+
+def store_processed_upload(doc_id, df_hmpi, metals, features, sampling_date=None, content_key=None, schema=None):
+    """
+    Persist a processed upload and feed the per-site history (and its forecasts).
+    schema pins the unit factors so later recomputes score the stored values the same way.
+    """
+    created_at = datetime.utcnow()
+    doc = {
+        "_id": doc_id,
+        "GeoJSON": features,
+        "metals": metals,
+        "summary": compute_upload_summary(df_hmpi, metals),
+        "created_at": created_at
+    }
+    if content_key:
+        doc["content_key"] = content_key
+    if schema:
+        doc["schema"] = schema
+    with metrics.stage("mongo_insert", rows=len(features)):
+        samples_collection.insert_one(doc)
+
+    # Longitudinal per-site history; sampling_date covers files without a date column
+    with metrics.stage("timeseries_append", rows=len(df_hmpi)):
+        updated_sites = append_site_measurements(doc_id, df_hmpi, metals,
+                                                 created_at if sampling_date is None or pd.isna(sampling_date) else sampling_date)
+    if updated_sites:
+        schedule_site_forecasts(updated_sites)
+
+
+def spool_upload(file):
+    """
+    Copy an uploaded file into memory, or past UPLOAD_SPOOL_MAX_MEMORY into a
+    named temp file (which parallel parsing can open by path), hashing the
+    bytes on the way. Returns (FileStorage over the spool, sha256 hex digest);
+    release it with close_spool.
+    """
+    digest = hashlib.sha256()
+    spool = io.BytesIO()
+    with metrics.stage("spool_upload") as timing:
+        for chunk in iter(lambda: file.stream.read(UPLOAD_READ_CHUNK), b""):
+            digest.update(chunk)
+            if isinstance(spool, io.BytesIO) and spool.tell() + len(chunk) > UPLOAD_SPOOL_MAX_MEMORY:
+                disk = tempfile.NamedTemporaryFile(suffix=os.path.splitext(file.filename or "")[1], delete=False)
+                disk.write(spool.getvalue())
+                spool = disk
+            spool.write(chunk)
+        spool.flush()
+        timing.record(nbytes=spool.tell())
+    spool.seek(0)
+    return FileStorage(stream=spool, filename=file.filename, content_type=file.content_type), digest.hexdigest()
+
+
+def timed_jsonify(payload):
+    """jsonify, timed as the json_encode stage (large GeoJSON payloads make this a real cost)."""
+    with metrics.stage("json_encode") as timing:
+        response = jsonify(payload)
+        timing.record(nbytes=response.content_length)
+    return response
+
+
+def close_spool(file):
+    path = getattr(file.stream, "name", None)
+    file.stream.close()
+    if isinstance(path, str) and os.path.exists(path):
+        os.remove(path)
+
+
+def upload_content_key(content_hash, strategy, sheet=None):
+    """Identical bytes only give identical results under the same processing parameters."""
+    key = f"{content_hash}:{strategy}:{STANDARDS_VERSION}"
+    return f"{key}:{sheet}" if sheet else key
+
+
+def claim_upload(content_key, file_id):
+    """
+    Register file_id as the owner of content_key unless someone already is.
+    A new claim is "pending" until its results are stored. Returns the claim.
+    """
+    return upload_hashes_collection.find_one_and_update(
+        {"_id": content_key},
+        {
+            "$setOnInsert": {"file_id": file_id, "state": "pending", "ref_count": 1, "created_at": datetime.utcnow()},
+            "$set": {"last_seen": datetime.utcnow()}
+        },
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+
+
+def acquire_upload_reference(content_key, file_id):
+    """Take a reference on file_id's stored upload. False if its claim was released meanwhile."""
+    result = upload_hashes_collection.update_one(
+        {"_id": content_key, "file_id": file_id, "ref_count": {"$gt": 0}},
+        {"$inc": {"ref_count": 1}, "$set": {"last_seen": datetime.utcnow()}}
+    )
+    return result.modified_count == 1
+
+
+def ingest_upload(content_hash, strategy, run_pipeline, sampling_date=None, sheet=None):
+    """
+    Process and store an upload unless identical content was already processed
+    with the same parameters. run_pipeline() returns (df_hmpi, metals, features,
+    schema) and is only called by the request that claims the content first;
+    identical uploads arriving meanwhile wait for its results.
+    Returns the /process response payload.
+    """
+    content_key = upload_content_key(content_hash, strategy, sheet)
+
+    while True:
+        doc_id = str(uuid.uuid4())
+        claim = claim_upload(content_key, doc_id)
+        owner_id = claim["file_id"]
+        if owner_id == doc_id:
+            break
+
+        if claim.get("state", "ready") == "pending":
+            # Another request is processing the same content
+            if datetime.utcnow() - claim["created_at"] > UPLOAD_CLAIM_TIMEOUT:
+                upload_hashes_collection.delete_one({"_id": content_key, "file_id": owner_id, "state": "pending"})
+            else:
+                time.sleep(UPLOAD_CLAIM_POLL_SECONDS)
+            continue
+
+        # Same bytes, same parameters: hand back the stored results
+        doc = samples_collection.find_one({"_id": owner_id}, {"GeoJSON": 1})
+        if doc is None:
+            # The stored upload is gone; drop the stale claim and try again
+            upload_hashes_collection.delete_one({"_id": content_key, "file_id": owner_id})
+            continue
+        if acquire_upload_reference(content_key, owner_id):
+            print(f"[LOG] Duplicate upload {content_hash[:12]} -> {owner_id}")
+            return {"file_id": owner_id, "GeoJSON": doc["GeoJSON"], "duplicate": True}
+
+    # Load file, run pipeline and save to samples collection, with the aggregates every summary view reads
+    try:
+        df_hmpi, valid_metals_for_geo, features, schema = run_pipeline()
+        store_processed_upload(doc_id, df_hmpi, valid_metals_for_geo, features,
+                               sampling_date=sampling_date, content_key=content_key, schema=schema)
+    except Exception:
+        upload_hashes_collection.delete_one({"_id": content_key, "file_id": doc_id})
+        raise
+    upload_hashes_collection.update_one({"_id": content_key, "file_id": doc_id}, {"$set": {"state": "ready"}})
+
+    return {"file_id": doc_id, "GeoJSON": features}
+
+
 @app.route("/process", methods=["POST"])
 def process_file():
     if "file" not in request.files:
         return jsonify({"error": "No file uploaded"}), 400
 
-    file = request.files["file"]
+    strategy = request.form.get("strategy", "half")
+    if strategy not in IMPUTATION_STRATEGIES:
+        return jsonify({"error": f"strategy must be one of {', '.join(IMPUTATION_STRATEGIES)}"}), 400
+
+    file = None
     try:
-        # Load file
-        df = load_file(file)
+        file, content_hash = spool_upload(request.files["file"])
+        sampling_date = pd.to_datetime(request.form.get("sampling_date"), errors="coerce")
+        sheet = resolve_upload_sheet(file.stream, file.filename or "", request.form.get("sheet") or None)
+        return timed_jsonify(ingest_upload(content_hash, strategy, lambda: process_upload_file(file, strategy, sheet),
+                                           sampling_date, sheet=sheet))
+
+    except ValueError as e:
+        # Unreadable or empty file, unknown sheet
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        return jsonify({"error": str(e)}), 500
+    finally:
+        if file is not None:
+            close_spool(file)
 
-        # Run pipeline
-        df_clean, merged_cols = preprocess_dataframe(df)
-        df_hmpi = compute_hmpi_vectorized(df_clean, merged_cols)
 
-        # Only consider metals actually present in the DataFrame
-        valid_metals_for_geo = [m for m in merged_cols if m in df_hmpi.columns]
+@app.route("/uploads/<file_id>", methods=["DELETE"])
+def release_upload(file_id):
+    """
+    Release one reference to an upload. The stored results, their site
+    history and cached tiles / grids are deleted only when the last reference
+    is released; the forecasts of the affected sites are then refitted.
+    """
+    try:
+        doc = samples_collection.find_one({"_id": file_id}, {"content_key": 1})
+        if not doc:
+            return jsonify({"error": "File not found"}), 404
 
-        # Build GeoJSON features
-        features = []
-        for _, row in df_hmpi.iterrows():
-            metal_conc = {m: row[m] for m in valid_metals_for_geo if pd.notna(row[m])}
-            latlon_flag = pd.notna(row.get("Latitude")) and pd.notna(row.get("Longitude"))
+        remaining = 0
+        if doc.get("content_key"):
+            ref = upload_hashes_collection.find_one_and_update(
+                {"_id": doc["content_key"], "file_id": file_id, "ref_count": {"$gt": 0}},
+                {"$inc": {"ref_count": -1}},
+                return_document=ReturnDocument.AFTER
+            )
+            remaining = ref["ref_count"] if ref else 0
+
+        if remaining > 0:
+            return jsonify({"file_id": file_id, "deleted": False, "ref_count": remaining}), 200
+
+        if doc.get("content_key"):
+            # At ref_count 0 duplicates can no longer take a reference; they re-process once the claim is gone
+            upload_hashes_collection.delete_one({"_id": doc["content_key"], "file_id": file_id, "ref_count": 0})
+        samples_collection.delete_one({"_id": file_id})
+        updated_sites = refresh_latest_measurements(file_id)
+        with _point_cache_lock:
+            _point_cache.pop(file_id, None)
+        # Rendered tiles and grids are served from disk before the upload is looked up
+        shutil.rmtree(os.path.join(TILE_CACHE_DIR, file_id), ignore_errors=True)
+        shutil.rmtree(os.path.join(GRID_CACHE_DIR, file_id), ignore_errors=True)
+        if updated_sites:
+            schedule_site_forecasts(updated_sites)
+
+        return jsonify({"file_id": file_id, "deleted": True, "ref_count": 0}), 200
 
-            features.append({
-                "Sample_ID": row.get("Sample_ID", str(uuid.uuid4())),
-                "no_of_metals": len(metal_conc),
-                "all_metal_conc": metal_conc,
-                "geometry": {
-                    "type": "Point",
-                    "coordinates": [row.get("Longitude"), row.get("Latitude")]
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({"error": str(e)}), 500
+
+
+# ========== CHUNKED UPLOADS ==========
+
+UPLOAD_STAGING_DIR = os.getenv("UPLOAD_STAGING_DIR", "upload_staging")
+CHUNKED_UPLOAD_MAX_CHUNK = 64 * 1024 * 1024
+CHUNKED_UPLOAD_SUGGESTED_CHUNK = 8 * 1024 * 1024
+CHUNKED_UPLOAD_TTL = timedelta(hours=48)
+CHUNKED_PARSE_STEP = 8 * 1024 * 1024
+
+_chunked_uploads = {}
+_chunked_uploads_lock = threading.Lock()
+
+
+class ChunkedUpload:
+    """
+    One resumable upload staged on disk as <staging>/<upload_id>/data, plus a
+    meta.json with the parameters and the byte ranges received so far.
+
+    As soon as a contiguous prefix is on disk it is hashed and, for CSV, parsed
+    up to its last complete line (header prepended, so every piece is read
+    exactly like the whole file would be). Completing the upload then only
+    parses the remaining tail.
+    """
+
+    def __init__(self, upload_id, meta):
+        self.upload_id = upload_id
+        self.meta = meta
+        self.dir = os.path.join(UPLOAD_STAGING_DIR, upload_id)
+        self.data_path = os.path.join(self.dir, "data")
+        self.lock = threading.Lock()
+        self.parse_lock = threading.Lock()
+        self.digest = hashlib.sha256()
+        self.hashed_through = 0
+        self.header = None
+        self.parsed_through = 0
+        self.frames = []
+        self.parse_failed = False
+        self.read_plan = None
+        self.completed = False
+
+    @property
+    def is_csv(self):
+        return self.meta["filename"].lower().endswith(".csv")
+
+    def contiguous(self):
+        ranges = self.meta["ranges"]
+        return ranges[0][1] if ranges and ranges[0][0] == 0 else 0
+
+    def save_meta(self):
+        tmp_path = os.path.join(self.dir, "meta.json.tmp")
+        with open(tmp_path, "w") as f:
+            f.write(json.dumps(self.meta))
+        os.replace(tmp_path, os.path.join(self.dir, "meta.json"))
+
+    def record_range(self, start, end):
+        """Add [start, end) to the received ranges (caller holds self.lock)."""
+        ranges = sorted(self.meta["ranges"] + [[start, end]])
+        merged = [ranges[0]]
+        for lo, hi in ranges[1:]:
+            if lo <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], hi)
+            else:
+                merged.append([lo, hi])
+        self.meta["ranges"] = merged
+        self.meta["updated_at"] = datetime.utcnow().isoformat()
+        self.save_meta()
+
+    def matches_received(self, offset, length, chunk):
+        """Whether chunk (a file holding `length` bytes for `offset`) agrees with every already received byte it overlaps."""
+        end = offset + length
+        with open(self.data_path, "rb") as f:
+            for lo, hi in self.meta["ranges"]:
+                lo, hi = max(lo, offset), min(hi, end)
+                while lo < hi:
+                    step = min(UPLOAD_READ_CHUNK, hi - lo)
+                    f.seek(lo)
+                    chunk.seek(lo - offset)
+                    if f.read(step) != chunk.read(step):
+                        return False
+                    lo += step
+        return True
+
+    def store_chunk(self, offset, length, chunk):
+        """Copy a verified chunk into place. Returns why it was refused, or None once stored."""
+        with self.lock:
+            if self.completed:
+                return "Upload already completed"
+            if not self.matches_received(offset, length, chunk):
+                return "Chunk differs from data already received at this offset"
+            chunk.seek(0)
+            with open(self.data_path, "r+b") as f:
+                f.seek(offset)
+                shutil.copyfileobj(chunk, f, UPLOAD_READ_CHUNK)
+            self.record_range(offset, offset + length)
+        return None
+
+    def reset(self):
+        """Forget every received byte so the whole file can be sent again (the assembled file failed its checksum)."""
+        with self.parse_lock, self.lock:
+            with open(self.data_path, "r+b") as f:
+                f.truncate(0)
+                f.truncate(self.meta["size"])
+            self.digest = hashlib.sha256()
+            self.hashed_through = 0
+            self.header = None
+            self.parsed_through = 0
+            self.frames = []
+            self.parse_failed = False
+            self.read_plan = None
+            self.meta["ranges"] = []
+            self.meta["updated_at"] = datetime.utcnow().isoformat()
+            self.save_meta()
+            self.completed = False
+
+    def status(self):
+        received = sum(hi - lo for lo, hi in self.meta["ranges"])
+        return {
+            "upload_id": self.upload_id,
+            "filename": self.meta["filename"],
+            "size": self.meta["size"],
+            "received_bytes": received,
+            "contiguous_bytes": self.contiguous(),
+            "ranges": self.meta["ranges"],
+            "parsed_bytes": self.parsed_through,
+            "parsed_rows": int(sum(len(frame) for frame in self.frames)),
+            "complete": received == self.meta["size"]
+        }
+
+    def advance(self, final=False):
+        """Hash and parse whatever contiguous data has arrived since the last call."""
+        with self.parse_lock:
+            limit = self.contiguous()
+            with open(self.data_path, "rb") as f:
+                while self.hashed_through < limit:
+                    f.seek(self.hashed_through)
+                    data = f.read(min(CHUNKED_PARSE_STEP, limit - self.hashed_through))
+                    self.digest.update(data)
+                    self.hashed_through += len(data)
+                    if self.is_csv and not self.parse_failed:
+                        self._parse_through(f)
+                # The last line may have no trailing newline
+                if final and self.is_csv and not self.parse_failed and self.hashed_through == self.meta["size"] \
+                        and self.parsed_through < self.hashed_through:
+                    self._parse_through(f, to_end=True)
+
+    def _parse_through(self, f, to_end=False):
+        """Parse from parsed_through up to the last newline before hashed_through (or all of it with to_end)."""
+        f.seek(self.parsed_through)
+        data = f.read(self.hashed_through - self.parsed_through)
+        if not to_end:
+            cut = data.rfind(b"\n")
+            if cut < 0:
+                return
+            data = data[:cut + 1]
+        if self.header is None:
+            newline = data.find(b"\n")
+            if newline < 0:
+                return
+            self.header = data[:newline + 1]
+            self.read_plan = resolve_csv_read_plan(pd.read_csv(io.BytesIO(self.header), nrows=0).columns)
+            consumed, data = newline + 1, data[newline + 1:]
+        else:
+            consumed = 0
+        try:
+            if data.strip():
+                frame = read_csv_with_plan(io.BytesIO(self.header + data), self.read_plan, CSV_PARSER_ENGINE)
+                if not parallel_ingest.rows_match_lines(data, len(frame)):
+                    raise parallel_ingest.SplitMismatch(f"upload {self.upload_id}: quoted line break before byte {self.hashed_through}")
+                self.frames.append(frame)
+        except Exception:
+            # Quoted multi-line fields and the like: leave it to one full read on completion
+            traceback.print_exc()
+            self.parse_failed = True
+            return
+        self.parsed_through += consumed + len(data)
+
+    def load_dataframe(self):
+        self.advance(final=True)
+        if self.is_csv and not self.parse_failed:
+            if not self.frames:
+                return read_csv_projected(io.BytesIO(self.header or b""))
+            return pd.concat(self.frames, ignore_index=True) if len(self.frames) > 1 else self.frames[0]
+        with open(self.data_path, "rb") as f:
+            return load_file(FileStorage(stream=f, filename=self.meta["filename"]), self.meta.get("sheet"))
+
+
+def _chunked_upload_id(upload_id):
+    try:
+        return str(uuid.UUID(upload_id))
+    except ValueError:
+        return None
+
+
+def get_chunked_upload(upload_id):
+    """The in-memory state of an upload, re-created from its staging dir after a restart."""
+    upload_id = _chunked_upload_id(upload_id)
+    if upload_id is None:
+        return None
+    with _chunked_uploads_lock:
+        upload = _chunked_uploads.get(upload_id)
+        if upload is None:
+            meta_path = os.path.join(UPLOAD_STAGING_DIR, upload_id, "meta.json")
+            if not os.path.exists(meta_path):
+                return None
+            with open(meta_path) as f:
+                upload = ChunkedUpload(upload_id, json.loads(f.read()))
+            _chunked_uploads[upload_id] = upload
+        return upload
+
+
+def discard_chunked_upload(upload_id):
+    with _chunked_uploads_lock:
+        _chunked_uploads.pop(upload_id, None)
+    shutil.rmtree(os.path.join(UPLOAD_STAGING_DIR, upload_id), ignore_errors=True)
+
+
+def purge_stale_chunked_uploads():
+    if not os.path.isdir(UPLOAD_STAGING_DIR):
+        return
+    cutoff = (datetime.utcnow() - CHUNKED_UPLOAD_TTL).timestamp()
+    for name in os.listdir(UPLOAD_STAGING_DIR):
+        path = os.path.join(UPLOAD_STAGING_DIR, name)
+        if os.path.isdir(path) and os.path.getmtime(path) < cutoff:
+            discard_chunked_upload(name)
+
+
+def _advance_in_background(upload):
+    try:
+        if upload.parse_lock.locked():
+            return
+        upload.advance()
+    except Exception:
+        traceback.print_exc()
+
+
+@app.route("/uploads/chunked", methods=["POST"])
+def initiate_chunked_upload():
+    """
+    Start a resumable upload. JSON body: filename, size (bytes), optional sha256
+    of the whole file, strategy, sampling_date and sheet (as for /process).
+    """
+    try:
+        payload = request.get_json(silent=True) or {}
+        filename = os.path.basename(str(payload.get("filename", "")))
+        size = payload.get("size")
+        strategy = payload.get("strategy", "half")
+        if not filename.lower().endswith(('.csv', '.xls', '.xlsx')):
+            return jsonify({"error": "filename must be a .csv, .xls or .xlsx file"}), 400
+        if not isinstance(size, int) or size <= 0:
+            return jsonify({"error": "size must be a positive number of bytes"}), 400
+        if strategy not in IMPUTATION_STRATEGIES:
+            return jsonify({"error": f"strategy must be one of {', '.join(IMPUTATION_STRATEGIES)}"}), 400
+
+        purge_stale_chunked_uploads()
+        upload_id = str(uuid.uuid4())
+        meta = {
+            "filename": filename,
+            "size": size,
+            "sha256": (payload.get("sha256") or "").lower() or None,
+            "strategy": strategy,
+            "sampling_date": payload.get("sampling_date"),
+            "sheet": payload.get("sheet"),
+            "ranges": [],
+            "created_at": datetime.utcnow().isoformat()
+        }
+        upload = ChunkedUpload(upload_id, meta)
+        os.makedirs(upload.dir)
+        with open(upload.data_path, "wb") as f:
+            f.truncate(size)
+        upload.save_meta()
+        with _chunked_uploads_lock:
+            _chunked_uploads[upload_id] = upload
+
+        return jsonify({"upload_id": upload_id, "chunk_size": CHUNKED_UPLOAD_SUGGESTED_CHUNK,
+                        "max_chunk_size": CHUNKED_UPLOAD_MAX_CHUNK}), 201
+
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route("/uploads/chunked/<upload_id>", methods=["PUT"])
+def put_upload_chunk(upload_id):
+    """
+    Store one chunk: ?offset=<byte offset>, raw bytes as the body and their
+    sha256 in the X-Chunk-SHA256 header. Chunks may arrive in any order and be
+    re-sent; a chunk whose checksum does not match is not recorded, and one
+    that overlaps received data with different bytes is refused (409).
+    """
+    try:
+        upload = get_chunked_upload(upload_id)
+        if upload is None:
+            return jsonify({"error": "Upload not found"}), 404
+        if upload.completed:
+            return jsonify({"error": "Upload already completed"}), 409
+
+        offset = request.args.get("offset", type=int)
+        length = request.content_length
+        expected = (request.headers.get("X-Chunk-SHA256") or "").lower()
+        if offset is None or offset < 0:
+            return jsonify({"error": "offset query parameter required"}), 400
+        if not expected:
+            return jsonify({"error": "X-Chunk-SHA256 header required"}), 400
+        if not length or length > CHUNKED_UPLOAD_MAX_CHUNK or offset + length > upload.meta["size"]:
+            return jsonify({"error": "Chunk is empty, too large, or past the end of the file"}), 400
+
+        # Verified before it touches the staged file, so a bad chunk never overwrites good data
+        digest = hashlib.sha256()
+        written = 0
+        with tempfile.TemporaryFile(dir=upload.dir) as chunk:
+            for data in iter(lambda: request.stream.read(UPLOAD_READ_CHUNK), b""):
+                digest.update(data)
+                chunk.write(data)
+                written += len(data)
+            if written != length or digest.hexdigest() != expected:
+                return jsonify({"error": "Chunk checksum or length mismatch", "offset": offset}), 400
+
+            before = upload.contiguous()
+            refused = upload.store_chunk(offset, length, chunk)
+            if refused:
+                return jsonify({"error": refused, "offset": offset}), 409
+        if upload.contiguous() > before:
+            threading.Thread(target=_advance_in_background, args=(upload,), daemon=True).start()
+
+        return jsonify(upload.status()), 200
+
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route("/uploads/chunked/<upload_id>", methods=["GET"])
+def get_chunked_upload_status(upload_id):
+    upload = get_chunked_upload(upload_id)
+    if upload is None:
+        return jsonify({"error": "Upload not found"}), 404
+    return jsonify(upload.status()), 200
+
+
+@app.route("/uploads/chunked/<upload_id>/complete", methods=["POST"])
+def complete_chunked_upload(upload_id):
+    """
+    Verify the assembled file and process it like /process (including
+    deduplication). If it fails the sha256 given at initiation, the staged
+    data is dropped and every chunk has to be sent again.
+    """
+    try:
+        upload = get_chunked_upload(upload_id)
+        if upload is None:
+            return jsonify({"error": "Upload not found"}), 404
+
+        # Only one /complete gets past here; it also stops further chunks from being accepted
+        with upload.lock:
+            if upload.completed:
+                return jsonify({"error": "Upload is already being completed"}), 409
+            status = upload.status()
+            if not status["complete"]:
+                return jsonify({"error": "Upload is missing data", **status}), 409
+            upload.completed = True
+
+        try:
+            upload.advance(final=True)
+            content_hash = upload.digest.hexdigest()
+            if upload.meta["sha256"] and upload.meta["sha256"] != content_hash:
+                # Some chunk was wrong but we can't tell which: start over rather than refuse the resend as a conflict
+                upload.reset()
+                return jsonify({"error": "File checksum mismatch; the upload was reset, send every chunk again",
+                                "sha256": content_hash, **upload.status()}), 400
+
+            sampling_date = pd.to_datetime(upload.meta.get("sampling_date"), errors="coerce")
+            strategy = upload.meta["strategy"]
+            with open(upload.data_path, "rb") as f:
+                sheet = resolve_upload_sheet(f, upload.meta["filename"], upload.meta.get("sheet"))
+            result = ingest_upload(content_hash, strategy,
+                                   lambda: run_processing_pipeline(upload.load_dataframe(), strategy), sampling_date, sheet=sheet)
+        except Exception:
+            upload.completed = False
+            raise
+        discard_chunked_upload(upload.upload_id)
+        return timed_jsonify(result), 200
+
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({"error": str(e)}), 500
+
+
+# ========== SITE TIME SERIES ==========
+
+# Measurements per bucket document; a site-year that outgrows it continues in a new bucket
+TIMESERIES_BUCKET_SIZE = 500
+# Newest measurements (date, file_id, hmpi) mirrored in each bucket's "latest" for /sites/changes
+TIMESERIES_LATEST_SIZE = 2
+SAMPLING_DATE_COLUMNS = ('sampling_date', 'sample_date', 'date_sampled', 'date', 'sampling date', 'sample date')
+
+_timeseries_indexes_ready = False
+
+
+def ensure_timeseries_indexes():
+    global _timeseries_indexes_ready
+    if not _timeseries_indexes_ready:
+        site_timeseries_collection.create_index([("site_id", ASCENDING), ("year", ASCENDING), ("count", ASCENDING)])
+        site_timeseries_collection.create_index([("measurements.file_id", ASCENDING)])
+        _timeseries_indexes_ready = True
+
+
+def detect_sampling_date_column(df):
+    lowered = {str(col).strip().lower(): col for col in df.columns}
+    return next((lowered[name] for name in SAMPLING_DATE_COLUMNS if name in lowered), None)
+
+
+def _latest_entry(measurement):
+    return {"date": measurement["date"], "file_id": measurement["file_id"], "hmpi": measurement["hmpi"]}
+
+
+def refresh_latest_measurements(file_id):
+    """
+    Drop file_id's measurements from the site buckets and rebuild their "latest"
+    lists. Returns the ids of the sites that lost measurements.
+    """
+    affected = list(site_timeseries_collection.find(
+        {"measurements.file_id": file_id},
+        {"site_id": 1, "measurements.date": 1, "measurements.file_id": 1, "measurements.hmpi": 1}
+    ))
+    site_timeseries_collection.update_many(
+        {"measurements.file_id": file_id},
+        [{"$set": {
+            "measurements": {"$filter": {"input": "$measurements", "cond": {"$ne": ["$$this.file_id", file_id]}}},
+            "latest": {"$filter": {"input": {"$ifNull": ["$latest", []]}, "cond": {"$ne": ["$$this.file_id", file_id]}}}
+        }}, {"$set": {"count": {"$size": "$measurements"}}}]
+    )
+    operations = []
+    for bucket in affected:
+        kept = [m for m in bucket["measurements"] if m["file_id"] != file_id]
+        kept.sort(key=lambda m: m["date"], reverse=True)
+        # Skipped if an append landed in between; its $push already kept "latest" in order
+        operations.append(UpdateOne(
+            {"_id": bucket["_id"], "count": len(kept)},
+            {"$set": {"latest": [_latest_entry(m) for m in kept[:TIMESERIES_LATEST_SIZE]]}}
+        ))
+    if operations:
+        site_timeseries_collection.bulk_write(operations, ordered=False)
+    return sorted({bucket["site_id"] for bucket in affected})
+
+
+def append_site_measurements(file_id, df_hmpi, metals, default_date):
+    """
+    Append one measurement per identified sample to its site's bucket documents.
+
+    Measurements are grouped per (site, year) first, so each bucket receives a
+    single $push/$each upsert and the whole upload is one unordered bulk write.
+    Each bucket also keeps its TIMESERIES_LATEST_SIZE newest measurements in
+    "latest". Returns the ids of the sites that received measurements.
+    """
+    if "Sample_ID" not in df_hmpi.columns or df_hmpi.empty:
+        return []
+
+    site_ids = df_hmpi["Sample_ID"]
+    identified = site_ids.notna() & (site_ids.astype(str).str.strip() != "")
+    df_sites = df_hmpi.loc[identified]
+    if df_sites.empty:
+        return []
+
+    date_col = detect_sampling_date_column(df_sites)
+    dates = pd.to_datetime(df_sites[date_col], errors="coerce") if date_col else pd.Series(pd.NaT, index=df_sites.index)
+    dates = dates.fillna(pd.Timestamp(default_date))
+
+    hmpi = pd.to_numeric(df_sites["HMPI"], errors="coerce").round(4) if "HMPI" in df_sites.columns \
+        else pd.Series(np.nan, index=df_sites.index)
+    lon = df_sites["Longitude"].tolist() if "Longitude" in df_sites.columns else [None] * len(df_sites)
+    lat = df_sites["Latitude"].tolist() if "Latitude" in df_sites.columns else [None] * len(df_sites)
+    metal_values = {m: df_sites[m].tolist() for m in metals if m in df_sites.columns}
+
+    grouped = {}
+    for i, (site_id, date, value) in enumerate(zip(site_ids[identified].astype(str), dates.dt.to_pydatetime(), hmpi.tolist())):
+        measurement = {
+            "date": date,
+            "file_id": file_id,
+            "hmpi": None if value != value else value,
+            "metals": {m: v[i] for m, v in metal_values.items() if v[i] == v[i]},
+            "coordinates": [None if lon[i] != lon[i] else lon[i], None if lat[i] != lat[i] else lat[i]],
+        }
+        grouped.setdefault((site_id, date.year), []).append(measurement)
+
+    operations = []
+    for (site_id, year), measurements in grouped.items():
+        for start in range(0, len(measurements), TIMESERIES_BUCKET_SIZE):
+            part = measurements[start:start + TIMESERIES_BUCKET_SIZE]
+            part_dates = [m["date"] for m in part]
+            operations.append(UpdateOne(
+                {"site_id": site_id, "year": year, "count": {"$lte": TIMESERIES_BUCKET_SIZE - len(part)}},
+                {
+                    "$push": {
+                        "measurements": {"$each": part},
+                        "latest": {"$each": [_latest_entry(m) for m in part], "$sort": {"date": -1},
+                                   "$slice": TIMESERIES_LATEST_SIZE},
+                    },
+                    "$inc": {"count": len(part)},
+                    "$min": {"first_date": min(part_dates)},
+                    "$max": {"last_date": max(part_dates)},
                 },
-                "latitudeandlongitudepresent": latlon_flag,
-               "HMPI": round(row.get("HMPI", 0), 4) if pd.notna(row.get("HMPI")) else None
+                upsert=True
+            ))
 
-            })
+    if operations:
+        ensure_timeseries_indexes()
+        site_timeseries_collection.bulk_write(operations, ordered=False)
+    return sorted({site_id for site_id, _ in grouped})
 
-        # Save to samples collection
-        doc_id = str(uuid.uuid4())
-        samples_collection.insert_one({
-            "_id": doc_id,
-            "GeoJSON": features,
-            "created_at": datetime.utcnow()
-        })
 
-        return jsonify({"file_id": doc_id, "GeoJSON": features})
+def _parse_date_arg(name):
+    """?<name>= as a datetime (None when absent); ValueError when it is not a date."""
+    value = request.args.get(name)
+    if not value:
+        return None
+    parsed = pd.to_datetime(value, errors="coerce")
+    if pd.isna(parsed):
+        raise ValueError(f"'{name}' must be a date, e.g. 2024-03-31")
+    return parsed.to_pydatetime()
+
+
+@app.route('/sites/<site_id>/history', methods=['GET'])
+def get_site_history(site_id):
+    """All stored measurements of one site (optionally ?from=&to=), oldest first."""
+    try:
+        date_from, date_to = _parse_date_arg("from"), _parse_date_arg("to")
+        query = {"site_id": site_id}
+        if date_from:
+            query["last_date"] = {"$gte": date_from}
+        if date_to:
+            query["first_date"] = {"$lte": date_to}
+
+        measurements = []
+        for bucket in site_timeseries_collection.find(query, {"measurements": 1}).sort("year", ASCENDING):
+            for m in bucket["measurements"]:
+                if (date_from and m["date"] < date_from) or (date_to and m["date"] > date_to):
+                    continue
+                measurements.append(m)
+
+        if not measurements:
+            return jsonify({"error": "Site not found"}), 404
+
+        measurements.sort(key=lambda m: m["date"])
+        return jsonify({
+            "site_id": site_id,
+            "count": len(measurements),
+            "history": [{
+                "date": m["date"].strftime('%Y-%m-%d'),
+                "file_id": m["file_id"],
+                "hmpi": m["hmpi"],
+                "metals": m["metals"],
+                "coordinates": m["coordinates"]
+            } for m in measurements]
+        }), 200
 
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
-        import traceback
         traceback.print_exc()
         return jsonify({"error": str(e)}), 500
 
 
+@app.route('/sites/changes', methods=['GET'])
+def get_site_changes():
+    """
+    HMPI change per site between two campaigns (?from_file=&to_file=), or between
+    each site's last two measurements when no campaigns are given.
+    ?min_change= filters out smaller absolute HMPI changes.
+    """
+    try:
+        from_file, to_file = request.args.get("from_file"), request.args.get("to_file")
+        min_change = request.args.get("min_change", 0, type=float)
+
+        if from_file and to_file:
+            pipeline = [
+                {"$match": {"measurements.file_id": {"$in": [from_file, to_file]}}},
+                {"$unwind": "$measurements"},
+                {"$match": {"measurements.file_id": {"$in": [from_file, to_file]}}},
+                {"$sort": {"site_id": 1, "measurements.date": 1}},
+                {"$group": {"_id": "$site_id", "series": {"$push": {
+                    "date": "$measurements.date",
+                    "file_id": "$measurements.file_id",
+                    "hmpi": "$measurements.hmpi"
+                }}}},
+            ]
+            sites = site_timeseries_collection.aggregate(pipeline, allowDiskUse=True)
+        else:
+            # Only each bucket's newest measurements are read; a site's last two are among them
+            latest = {}
+            for bucket in site_timeseries_collection.find({}, {"site_id": 1, "latest": 1}):
+                latest.setdefault(bucket["site_id"], []).extend(bucket.get("latest") or [])
+            sites = ({"_id": site_id, "series": sorted(series, key=lambda m: m["date"])[-2:]}
+                     for site_id, series in latest.items())
+
+        changes = []
+        for site in sites:
+            series = site["series"]
+            if from_file and to_file:
+                before = [m for m in series if m["file_id"] == from_file]
+                after = [m for m in series if m["file_id"] == to_file]
+                if not before or not after:
+                    continue
+                before, after = before[-1], after[-1]
+            elif len(series) >= 2:
+                before, after = series[-2], series[-1]
+            else:
+                continue
+            if before["hmpi"] is None or after["hmpi"] is None:
+                continue
+
+            delta = after["hmpi"] - before["hmpi"]
+            if abs(delta) < min_change:
+                continue
+            before_risk, after_risk = RISK_SHORT_LABELS[risk_codes([before["hmpi"]])[0]], RISK_SHORT_LABELS[risk_codes([after["hmpi"]])[0]]
+            changes.append({
+                "site_id": site["_id"],
+                "from": {"date": before["date"].strftime('%Y-%m-%d'), "file_id": before["file_id"], "hmpi": before["hmpi"], "risk": before_risk},
+                "to": {"date": after["date"].strftime('%Y-%m-%d'), "file_id": after["file_id"], "hmpi": after["hmpi"], "risk": after_risk},
+                "change": round(delta, 4),
+                "pct_change": round(delta / before["hmpi"] * 100, 2) if before["hmpi"] else None,
+                "risk_changed": before_risk != after_risk
+            })
+
+        changes.sort(key=lambda c: abs(c["change"]), reverse=True)
+        return jsonify({"count": len(changes), "changes": changes}), 200
+
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route('/summary/<file_id>', methods=['GET'])
+def get_summary(file_id):
+    """Precomputed HMPI/metal statistics, histograms and risk counts of an upload."""
+    try:
+        summary = get_upload_summary(file_id)
+        if summary is None:
+            return jsonify({'error': 'File not found'}), 404
+        return jsonify({'file_id': file_id, 'summary': summary}), 200
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({'error': str(e)}), 500
+
+
 @app.route('/geojson/<file_id>', methods=['GET'])
 def get_geojson(file_id):
     doc = samples_collection.find_one({'_id': file_id})
@@ -880,48 +2179,83 @@ def get_geojson(file_id):
     return jsonify(doc['GeoJSON'])
 
 
-# REPLACE your existing @app.route('/download/<file_id>', methods=['GET']) function with this:
+# Features pulled from Mongo per $slice round-trip when streaming downloads
+DOWNLOAD_BATCH_SIZE = 5000
+
+CSV_BASE_COLUMNS = ['Sample_ID', 'HMPI', 'no_of_metals', 'Longitude', 'Latitude']
+
+
+def iter_upload_features(file_id, batch_size=DOWNLOAD_BATCH_SIZE):
+    """Yield the stored GeoJSON features of an upload in batches via $slice projections."""
+    offset = 0
+    while True:
+        # A $slice on its own is an exclusion projection (every other field comes back);
+        # naming a small field makes it an inclusion, so only the slice travels
+        doc = samples_collection.find_one({'_id': file_id},
+                                          {'_id': 0, 'created_at': 1, 'GeoJSON': {'$slice': [offset, batch_size]}})
+        batch = (doc or {}).get('GeoJSON') or []
+        if batch:
+            yield batch
+        if len(batch) < batch_size:
+            return
+        offset += batch_size
+
+
+def get_upload_metals(file_id, doc=None):
+    """Metal columns of an upload, in detection order, without materializing all features."""
+    if doc and doc.get('metals') is not None:
+        return list(doc['metals'])
+
+    seen = set()
+    for batch in iter_upload_features(file_id):
+        for feature in batch:
+            seen.update((feature.get('all_metal_conc') or {}).keys())
+    return [m for m in STANDARD_LIMITS if m in seen] + sorted(seen - set(STANDARD_LIMITS))
+
+
+def _csv_cell(value):
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return ''
+    return value
+
+
+def iter_features_csv(file_id, metals):
+    """Stream the upload as CSV text, one chunk per Mongo batch, with a fixed header."""
+    header = CSV_BASE_COLUMNS + metals
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    writer.writerow(header)
+
+    for batch in iter_upload_features(file_id):
+        for feature in batch:
+            coords = (feature.get('geometry') or {}).get('coordinates') or []
+            conc = feature.get('all_metal_conc') or {}
+            writer.writerow([
+                _csv_cell(feature.get('Sample_ID', '')),
+                _csv_cell(feature.get('HMPI', '')),
+                _csv_cell(feature.get('no_of_metals', '')),
+                _csv_cell(coords[0] if len(coords) > 0 else ''),
+                _csv_cell(coords[1] if len(coords) > 1 else ''),
+            ] + [_csv_cell(conc.get(m)) for m in metals])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate(0)
+
+    if buffer.tell():
+        yield buffer.getvalue()
+
 
 @app.route('/download/<file_id>', methods=['GET'])
 def download_file(file_id):
-    doc = samples_collection.find_one({'_id': file_id})
+    doc = samples_collection.find_one({'_id': file_id}, {'metals': 1})
     if not doc:
         return jsonify({'error': 'File not found'}), 404
 
-    # Convert GeoJSON back to tabular format for CSV download
-    geojson_data = doc['GeoJSON']
-    
-    # Build rows for CSV
-    rows = []
-    for feature in geojson_data:
-        row = {
-            'Sample_ID': feature.get('Sample_ID', ''),
-            'HMPI': feature.get('HMPI', ''),
-            'no_of_metals': feature.get('no_of_metals', ''),
-        }
-        
-        # Add coordinates if available
-        if feature.get('geometry') and feature['geometry'].get('coordinates'):
-            coords = feature['geometry']['coordinates']
-            row['Longitude'] = coords[0] if len(coords) > 0 else ''
-            row['Latitude'] = coords[1] if len(coords) > 1 else ''
-        else:
-            row['Longitude'] = ''
-            row['Latitude'] = ''
-        
-        # Add all metal concentrations
-        if feature.get('all_metal_conc'):
-            row.update(feature['all_metal_conc'])
-            
-        rows.append(row)
-    
-    # Create DataFrame and CSV
-    df = pd.DataFrame(rows)
-    csv_buffer = io.StringIO()
-    df.to_csv(csv_buffer, index=False)
-    
+    # Header is fixed before the first row so every streamed chunk lines up
+    metals = get_upload_metals(file_id, doc)
+
     return Response(
-        csv_buffer.getvalue(),
+        stream_with_context(iter_features_csv(file_id, metals)),
         mimetype="text/csv",
         headers={"Content-Disposition": f"attachment; filename=processed_{file_id}.csv"}
     )
@@ -1112,7 +2446,7 @@ def export_pdf(file_id):
             return jsonify({'error': 'No heavy metal data found'}), 400
 
         # Compute HMPI
-        df_hmpi = compute_hmpi_vectorized(df, metal_cols)
+        df_hmpi = compute_hmpi_vectorized(df, metal_cols, unit_factors=upload_unit_factors(doc))
 
         # Generate PDF
         pdf_buffer = generate_pdf_report(df_hmpi, metal_cols)  # must return BytesIO
@@ -1156,10 +2490,11 @@ def download_pdf_long(file_id):
             return jsonify({'error': 'No heavy metal data found'}), 400
 
         # Compute HMPI
-        df_hmpi = compute_hmpi_vectorized(df, metal_cols)
+        df_hmpi = compute_hmpi_vectorized(df, metal_cols, unit_factors=upload_unit_factors(doc))
 
         # Generate long report
-        pdf_buffer = generate_long_report_pdf(df_hmpi, file_id, file_name, metal_cols)
+        pdf_buffer = generate_long_report_pdf(df_hmpi, file_id, file_name, metal_cols,
+                                              summary=get_upload_summary(file_id, doc))
         
         # Ensure buffer is at position 0
         pdf_buffer.seek(0)
@@ -1210,10 +2545,11 @@ def download_pdf_short(file_id):
             return jsonify({'error': 'No heavy metal data found'}), 400
 
         # Compute HMPI
-        df_hmpi = compute_hmpi_vectorized(df, metal_cols)
+        df_hmpi = compute_hmpi_vectorized(df, metal_cols, unit_factors=upload_unit_factors(doc))
 
         # Generate short report
-        pdf_buffer = generate_short_report_pdf(df_hmpi, file_id, file_name, metal_cols)
+        pdf_buffer = generate_short_report_pdf(df_hmpi, file_id, file_name, metal_cols,
+                                               summary=get_upload_summary(file_id, doc))
         
         # Ensure buffer is at position 0
         pdf_buffer.seek(0)
@@ -1264,25 +2600,13 @@ def download_excel(file_id):
             return jsonify({'error': 'No heavy metal data found'}), 400
 
         # Compute HMPI
-        df_hmpi = compute_hmpi_vectorized(df, metal_cols)
-
-        # Export to Excel with error checking
-        excel_buffer = export_to_excel(df_hmpi, file_name)
-        
-        # Ensure buffer is at position 0
-        excel_buffer.seek(0)
-        
-        # Read buffer to ensure it's properly written
-        excel_data = excel_buffer.read()
-        excel_buffer = io.BytesIO(excel_data)
-        excel_buffer.seek(0)
+        df_hmpi = compute_hmpi_vectorized(df, metal_cols, unit_factors=upload_unit_factors(doc))
 
-        return send_file(
-            excel_buffer,
-            as_attachment=True,
-            download_name=f"HMPI_Data.xlsx",
-            mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-            
+        # Stream the workbook as it is written instead of buffering it
+        return Response(
+            stream_with_context(iter_excel_export(df_hmpi, file_name, summary=get_upload_summary(file_id, doc))),
+            mimetype=XLSX_CONTENT_TYPE,
+            headers={"Content-Disposition": "attachment; filename=HMPI_Data.xlsx"}
         )
 
     except Exception as e:
@@ -1304,7 +2628,41 @@ def convert_plotly_to_png(fig, width=1000, height=500):
         return None
 
 
-def generate_long_report_pdf(df_hmpi: pd.DataFrame, file_id: str, file_name: str, metal_cols: dict) -> BytesIO:
+def summary_table_rows(df_hmpi: pd.DataFrame) -> list:
+    """[Sample ID, HMPI, Risk] rows for the report summary tables, built column-wise."""
+    n = len(df_hmpi)
+    sample_ids = df_hmpi["Sample_ID"].astype(str).tolist() if "Sample_ID" in df_hmpi.columns else ["N/A"] * n
+    hmpi = pd.to_numeric(df_hmpi["HMPI"], errors="coerce").tolist()
+    risks = df_hmpi["RiskCategory"].astype(str).tolist() if "RiskCategory" in df_hmpi.columns else ["N/A"] * n
+    return [
+        [sample_id, "N/A" if value != value else f"{value:.4f}", risk]
+        for sample_id, value, risk in zip(sample_ids, hmpi, risks)
+    ]
+
+
+def hmpi_histogram_figure(hmpi_summary: dict, title: str):
+    """HMPI distribution bar chart drawn from the stored histogram bins and mean."""
+    edges = np.asarray(hmpi_summary["histogram"]["edges"], dtype=float)
+    hist_fig = go.Figure(go.Bar(
+        x=(edges[:-1] + edges[1:]) / 2,
+        y=hmpi_summary["histogram"]["counts"],
+        width=np.diff(edges),
+        marker_color="#4e73df"
+    ))
+    hist_fig.update_layout(title=title, xaxis_title="HMPI Value", yaxis_title="Frequency", bargap=0)
+
+    mean_val = hmpi_summary["mean"]
+    hist_fig.add_vline(
+        x=mean_val,
+        line_dash="dash",
+        line_color="red",
+        annotation_text=f"Mean = {mean_val:.2f}"
+    )
+    return hist_fig
+
+
+def generate_long_report_pdf(df_hmpi: pd.DataFrame, file_id: str, file_name: str, metal_cols: dict,
+                             summary: dict = None) -> BytesIO:
 
     buffer = io.BytesIO()
     doc = SimpleDocTemplate(
@@ -1322,15 +2680,11 @@ def generate_long_report_pdf(df_hmpi: pd.DataFrame, file_id: str, file_name: str
 
     try:
         df_hmpi_copy = df_hmpi.copy()
+        if summary is None:
+            summary = compute_upload_summary(df_hmpi, metal_cols)
 
-        risk_bins = [0, 60, 100, np.inf]
-        risk_labels = ["Safe (≤60)", "Moderate (61–100)", "High (>100)"]
-
-        df_hmpi_copy["RiskCategory"] = pd.cut(
-            df_hmpi_copy["HMPI"],
-            bins=risk_bins,
-            labels=risk_labels
-        )
+        risk_labels = list(RISK_LABELS)
+        df_hmpi_copy["RiskCategory"] = classify_risk(df_hmpi_copy["HMPI"], missing="N/A")
 
         # ================= PAGE 1 =================
         story.append(Paragraph("HMPI Comprehensive Analysis Report", styles['Title']))
@@ -1341,12 +2695,7 @@ def generate_long_report_pdf(df_hmpi: pd.DataFrame, file_id: str, file_name: str
 
         table_data = [['Sample ID', 'HMPI Value', 'Risk Category']]
 
-        for _, row in df_hmpi_copy.iterrows():
-            table_data.append([
-                str(row.get("Sample_ID", "N/A")),
-                f"{row['HMPI']:.4f}" if pd.notna(row["HMPI"]) else "N/A",
-                str(row.get("RiskCategory", "N/A"))
-            ])
+        table_data.extend(summary_table_rows(df_hmpi_copy))
 
         summary_table = Table(table_data, colWidths=[1.5 * inch, 1.5 * inch, 2 * inch])
         summary_table.setStyle(TableStyle([
@@ -1367,26 +2716,8 @@ def generate_long_report_pdf(df_hmpi: pd.DataFrame, file_id: str, file_name: str
         story.append(Paragraph("Global Analysis - Visualizations", styles['Heading1']))
         story.append(Spacer(1, 0.3 * inch))
 
-        hmpi_valid = df_hmpi_copy["HMPI"].dropna()
-
-        if len(hmpi_valid) > 0:
-            mean_val = hmpi_valid.mean()
-
-            hist_fig = px.histogram(
-                hmpi_valid,
-                nbins=20,
-                title="HMPI Distribution",
-                labels={'value': 'HMPI Value', 'count': 'Frequency'}
-            )
-
-            hist_fig.update_traces(marker_color="#4e73df")
-            hist_fig.add_vline(
-                x=mean_val,
-                line_dash="dash",
-                line_color="red",
-                annotation_text=f"Mean = {mean_val:.2f}"
-            )
-
+        if summary["hmpi"]["count"] > 0:
+            hist_fig = hmpi_histogram_figure(summary["hmpi"], "HMPI Distribution")
             hist_fig.update_layout(height=500, width=900)
 
             img_data = convert_plotly_to_png(hist_fig, 900, 500)
@@ -1396,11 +2727,11 @@ def generate_long_report_pdf(df_hmpi: pd.DataFrame, file_id: str, file_name: str
         story.append(Spacer(1, 0.3 * inch))
 
         # Risk Distribution Bar
-        risk_counts = df_hmpi_copy["RiskCategory"].value_counts().reindex(risk_labels, fill_value=0)
+        risk_count_series = pd.Series(summary["risk_counts"]).reindex(risk_labels, fill_value=0)
 
         risk_df = pd.DataFrame({
-            "Risk Category": risk_counts.index,
-            "Count": risk_counts.values
+            "Risk Category": risk_count_series.index,
+            "Count": risk_count_series.values
         })
 
         bar_fig = px.bar(
@@ -1520,7 +2851,8 @@ def generate_long_report_pdf(df_hmpi: pd.DataFrame, file_id: str, file_name: str
 
     buffer.seek(0)
     return buffer
-def generate_short_report_pdf(df_hmpi: pd.DataFrame, file_id: str, file_name: str, metal_cols: dict) -> BytesIO:
+def generate_short_report_pdf(df_hmpi: pd.DataFrame, file_id: str, file_name: str, metal_cols: dict,
+                              summary: dict = None) -> BytesIO:
 
     buffer = io.BytesIO()
 
@@ -1539,17 +2871,13 @@ def generate_short_report_pdf(df_hmpi: pd.DataFrame, file_id: str, file_name: st
 
     try:
         df_hmpi_copy = df_hmpi.copy()
+        if summary is None:
+            summary = compute_upload_summary(df_hmpi, metal_cols)
 
-        risk_bins = [0, 60, 100, np.inf]
-        risk_labels = ["Safe (≤60)", "Moderate (61–100)", "High (>100)"]
-
-        df_hmpi_copy["RiskCategory"] = pd.cut(
-            df_hmpi_copy["HMPI"],
-            bins=risk_bins,
-            labels=risk_labels
-        )
+        risk_labels = list(RISK_LABELS)
+        df_hmpi_copy["RiskCategory"] = classify_risk(df_hmpi_copy["HMPI"], missing="N/A")
 
-        risk_counts = df_hmpi_copy["RiskCategory"].value_counts().reindex(risk_labels, fill_value=0)
+        risk_count_series = pd.Series(summary["risk_counts"]).reindex(risk_labels, fill_value=0)
         total_samples = len(df_hmpi_copy)
 
         # ================= PAGE 1 =================
@@ -1561,12 +2889,7 @@ def generate_short_report_pdf(df_hmpi: pd.DataFrame, file_id: str, file_name: st
         # ===== SUMMARY TABLE (UNCHANGED AS REQUESTED) =====
         table_data = [['Sample ID', 'HMPI Value', 'Risk Category']]
 
-        for _, row in df_hmpi_copy.iterrows():
-            table_data.append([
-                str(row.get("Sample_ID", "N/A")),
-                f"{row['HMPI']:.4f}" if pd.notna(row["HMPI"]) else "N/A",
-                str(row.get("RiskCategory", "N/A"))
-            ])
+        table_data.extend(summary_table_rows(df_hmpi_copy))
 
         summary_table = Table(table_data, colWidths=[1.2 * inch, 1.2 * inch, 2 * inch])
         summary_table.setStyle(TableStyle([
@@ -1586,27 +2909,9 @@ def generate_short_report_pdf(df_hmpi: pd.DataFrame, file_id: str, file_name: st
         story.append(Spacer(1, 0.3 * inch))
 
         # ================= GLOBAL HISTOGRAM =================
-        hmpi_valid = df_hmpi_copy["HMPI"].dropna()
-
-        if len(hmpi_valid) > 0:
-
-            mean_val = hmpi_valid.mean()
-
-            hist_fig = px.histogram(
-                hmpi_valid,
-                nbins=20,
-                title="HMPI Distribution Overview",
-                labels={'value': 'HMPI Value', 'count': 'Frequency'}
-            )
-
-            hist_fig.update_traces(marker_color="#4e73df")
+        if summary["hmpi"]["count"] > 0:
 
-            hist_fig.add_vline(
-                x=mean_val,
-                line_dash="dash",
-                line_color="red",
-                annotation_text=f"Mean = {mean_val:.2f}"
-            )
+            hist_fig = hmpi_histogram_figure(summary["hmpi"], "HMPI Distribution Overview")
 
             hist_fig.update_layout(
                 height=500,
@@ -1624,8 +2929,8 @@ def generate_short_report_pdf(df_hmpi: pd.DataFrame, file_id: str, file_name: st
 
         # ================= RISK DISTRIBUTION BAR =================
         risk_df = pd.DataFrame({
-            "Risk Category": risk_counts.index,
-            "Count": risk_counts.values
+            "Risk Category": risk_count_series.index,
+            "Count": risk_count_series.values
         })
 
         bar_fig = px.bar(
@@ -1659,9 +2964,9 @@ def generate_short_report_pdf(df_hmpi: pd.DataFrame, file_id: str, file_name: st
         story.append(Paragraph("Analysis Conclusion", styles['Heading1']))
         story.append(Spacer(1, 0.3 * inch))
 
-        safe_pct = (risk_counts["Safe (≤60)"] / total_samples * 100) if total_samples else 0
-        moderate_pct = (risk_counts["Moderate (61–100)"] / total_samples * 100) if total_samples else 0
-        high_pct = (risk_counts["High (>100)"] / total_samples * 100) if total_samples else 0
+        safe_pct = (risk_count_series[RISK_LABELS[0]] / total_samples * 100) if total_samples else 0
+        moderate_pct = (risk_count_series[RISK_LABELS[1]] / total_samples * 100) if total_samples else 0
+        high_pct = (risk_count_series[RISK_LABELS[2]] / total_samples * 100) if total_samples else 0
 
         story.append(Paragraph(
             f"""
@@ -1710,110 +3015,398 @@ def generate_short_report_pdf(df_hmpi: pd.DataFrame, file_id: str, file_name: st
     return buffer
 
 
-def export_to_excel(df_hmpi: pd.DataFrame, file_name: str) -> BytesIO:
+# ========== STREAMING EXCEL EXPORT ==========
+
+# Rows serialized per chunk before the compressed bytes are handed to the client
+EXCEL_CHUNK_ROWS = 2000
+# Fast deflate level; sheet XML is highly repetitive so the size cost is small
+EXCEL_COMPRESS_LEVEL = 1
+
+XLSX_CONTENT_TYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+# Control characters that are not allowed in XML 1.0 cell text
+XLSX_ILLEGAL_CHARS_RE = re.compile(r'[\000-\010]|[\013-\014]|[\016-\037]')
+
+
+class _ZipStreamSink:
+    """Write-only, non-seekable file object that zipfile writes into.
+
+    zipfile falls back to data descriptors when the target cannot seek, so
+    every compressed byte can be drained and sent as soon as it is produced.
+    """
+
+    def __init__(self):
+        self._parts = []
+
+    def write(self, data):
+        self._parts.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self._parts)
+        self._parts = []
+        return data
+
+
+def _xlsx_column_cells(values, kind="object"):
+    """Serialize one column slice into a list of <c> elements (no cell refs)."""
+    if kind == "float":
+        return [f"<c><v>{v!r}</v></c>" if -math.inf < v < math.inf else "<c/>" for v in values]
+    if kind == "int":
+        return [f"<c><v>{v}</v></c>" for v in values]
+    if kind == "bool":
+        return [f'<c t="b"><v>{int(v)}</v></c>' for v in values]
+
+    cells = []
+    for v in values:
+        if v is None:
+            cells.append("<c/>")
+        elif isinstance(v, (bool, np.bool_)):
+            cells.append(f'<c t="b"><v>{int(v)}</v></c>')
+        elif isinstance(v, (int, np.integer)):
+            cells.append(f"<c><v>{int(v)}</v></c>")
+        elif isinstance(v, (float, np.floating)):
+            cells.append(f"<c><v>{float(v)!r}</v></c>" if math.isfinite(v) else "<c/>")
+        else:
+            text = XLSX_ILLEGAL_CHARS_RE.sub("", str(v))
+            cells.append(f'<c t="inlineStr"><is><t xml:space="preserve">{xml_escape(text)}</t></is></c>')
+    return cells
+
+
+def _xlsx_rows_xml(columns):
+    """Zip per-column cell lists into <row> elements."""
+    return "".join("<row>" + "".join(cells) + "</row>" for cells in zip(*columns))
+
+
+def _xlsx_column_values(series: pd.Series):
+    """Return (kind, plain Python values) for one column so cells are formatted without per-value type checks."""
+    values = series.to_numpy()
+    if values.dtype.kind == "f":
+        return "float", values.astype(float).tolist()
+    if values.dtype.kind in "iu":
+        return "int", values.tolist()
+    if values.dtype.kind == "b":
+        return "bool", values.tolist()
+    return "object", [None if (not isinstance(v, (dict, list)) and pd.isna(v)) else v for v in series.tolist()]
+
+
+def export_aggregates_from_summary(summary: dict) -> dict:
+    """Statistics / Risk Summary sheet values taken from a stored upload summary."""
+    hmpi = summary["hmpi"]
+    nan = float("nan")
+    return {
+        "total_samples": summary["total_samples"],
+        "mean": nan if hmpi["mean"] is None else hmpi["mean"],
+        "median": nan if hmpi["median"] is None else hmpi["median"],
+        "min": nan if hmpi["min"] is None else hmpi["min"],
+        "max": nan if hmpi["max"] is None else hmpi["max"],
+        "std": nan if hmpi["std"] is None else hmpi["std"],
+        "risk_counts": dict(summary["risk_counts"]),
+    }
+
+
+def compute_export_aggregates(df_hmpi: pd.DataFrame) -> dict:
+    """Compute every number the Statistics and Risk Summary sheets need in one pass over HMPI."""
+    hmpi = pd.to_numeric(df_hmpi["HMPI"], errors="coerce").to_numpy(dtype=float) if "HMPI" in df_hmpi.columns \
+        else np.full(len(df_hmpi), np.nan)
+    valid = hmpi[~np.isnan(hmpi)]
+    has_data = valid.size > 0
+
+    counts = risk_counts(hmpi)
+
+    return {
+        "total_samples": int(len(df_hmpi)),
+        "mean": float(valid.mean()) if has_data else float("nan"),
+        "median": float(np.median(valid)) if has_data else float("nan"),
+        "min": float(valid.min()) if has_data else float("nan"),
+        "max": float(valid.max()) if has_data else float("nan"),
+        "std": float(valid.std(ddof=1)) if valid.size > 1 else float("nan"),
+        "risk_counts": {label: int(counts[label]) for label in RISK_LABELS},
+    }
+
+
+def _xlsx_small_sheet(rows: list) -> str:
+    columns = [_xlsx_column_cells(col) for col in zip(*rows)]
+    return _xlsx_rows_xml(columns)
+
+
+def iter_excel_export(df_hmpi: pd.DataFrame, file_name: str, chunk_rows: int = EXCEL_CHUNK_ROWS, summary: dict = None):
     """
-    Export data to Excel with error checking and multiple sheets.
+    Stream an .xlsx workbook (HMPI Data, Statistics, Risk Summary, Metadata) as bytes.
+
+    Rows are serialized chunk by chunk straight into a deflate stream, so memory
+    stays bounded by one chunk regardless of the number of samples, and each
+    compressed chunk is yielded to the client as soon as it is written.
     """
-    buffer = BytesIO()
-    
+    sheet_names = ["HMPI Data", "Statistics", "Risk Summary", "Metadata"]
+    aggregates = export_aggregates_from_summary(summary) if summary else compute_export_aggregates(df_hmpi)
+
+    sheet_head = ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                  '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>')
+    sheet_tail = "</sheetData></worksheet>"
+
+    content_types = (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        + "".join(
+            f'<Override PartName="/xl/worksheets/sheet{i}.xml" '
+            'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+            for i in range(1, len(sheet_names) + 1))
+        + "</Types>"
+    )
+    root_rels = (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+        'Target="xl/workbook.xml"/></Relationships>'
+    )
+    workbook = (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+        'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships"><sheets>'
+        + "".join(f'<sheet name="{xml_escape(name)}" sheetId="{i}" r:id="rId{i}"/>'
+                  for i, name in enumerate(sheet_names, start=1))
+        + "</sheets></workbook>"
+    )
+    workbook_rels = (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        + "".join(
+            f'<Relationship Id="rId{i}" '
+            'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" '
+            f'Target="worksheets/sheet{i}.xml"/>'
+            for i in range(1, len(sheet_names) + 1))
+        + "</Relationships>"
+    )
+
     try:
-        # Make a copy to avoid modifying the original
-        df_export = df_hmpi.copy()
-        
-        # Create Excel writer
-        with pd.ExcelWriter(buffer, engine='openpyxl') as writer:
-            # Sheet 1: Main Data with HMPI
-            df_export.to_excel(writer, sheet_name='HMPI Data', index=False)
-            
+        sink = _ZipStreamSink()
+        with zipfile.ZipFile(sink, mode="w", compression=zipfile.ZIP_DEFLATED, compresslevel=EXCEL_COMPRESS_LEVEL) as zf:
+            zf.writestr("[Content_Types].xml", content_types)
+            zf.writestr("_rels/.rels", root_rels)
+            zf.writestr("xl/workbook.xml", workbook)
+            zf.writestr("xl/_rels/workbook.xml.rels", workbook_rels)
+            yield sink.drain()
+
+            # Sheet 1: Main Data with HMPI, written in bounded chunks
+            with zf.open("xl/worksheets/sheet1.xml", mode="w", force_zip64=True) as fh:
+                fh.write(sheet_head.encode("utf-8"))
+                fh.write(_xlsx_rows_xml([[c] for c in _xlsx_column_cells([str(col) for col in df_hmpi.columns])]).encode("utf-8"))
+                for start in range(0, len(df_hmpi), chunk_rows):
+                    chunk = [_xlsx_column_cells(values, kind) for kind, values in
+                             (_xlsx_column_values(df_hmpi[col].iloc[start:start + chunk_rows]) for col in df_hmpi.columns)]
+                    fh.write(_xlsx_rows_xml(chunk).encode("utf-8"))
+                    yield sink.drain()
+                fh.write(sheet_tail.encode("utf-8"))
+            yield sink.drain()
+
             # Sheet 2: Summary Statistics
-            summary_stats = {
-                'Metric': ['Total Samples', 'Mean HMPI', 'Median HMPI', 'Min HMPI', 'Max HMPI', 'Std Dev'],
-                'Value': [
-                    len(df_export),
-                    float(df_export['HMPI'].mean()),
-                    float(df_export['HMPI'].median()),
-                    float(df_export['HMPI'].min()),
-                    float(df_export['HMPI'].max()),
-                    float(df_export['HMPI'].std())
-                ]
-            }
-            pd.DataFrame(summary_stats).to_excel(writer, sheet_name='Statistics', index=False)
-            
+            stats_rows = [
+                ["Metric", "Value"],
+                ["Total Samples", aggregates["total_samples"]],
+                ["Mean HMPI", aggregates["mean"]],
+                ["Median HMPI", aggregates["median"]],
+                ["Min HMPI", aggregates["min"]],
+                ["Max HMPI", aggregates["max"]],
+                ["Std Dev", aggregates["std"]],
+            ]
+
             # Sheet 3: Risk Categories
-            risk_bins = [0, 60, 100, np.inf]
-            risk_labels = ["Safe (≤60)", "Moderate (61–100)", "High (>100)"]
-            df_export["RiskCategory"] = pd.cut(df_export["HMPI"], bins=risk_bins, labels=risk_labels, right=True)
-            risk_count = df_export["RiskCategory"].value_counts().reset_index()
-            risk_count.columns = ['Risk Category', 'Count']
-            risk_count['Percentage'] = (risk_count['Count'] / len(df_export) * 100).round(2)
-            risk_count.to_excel(writer, sheet_name='Risk Summary', index=False)
-            
+            total = aggregates["total_samples"]
+            risk_rows = [["Risk Category", "Count", "Percentage"]] + [
+                [label, count, round(count / total * 100, 2) if total else 0.0]
+                for label, count in aggregates["risk_counts"].items()
+            ]
+
             # Sheet 4: Metadata
-            metadata = {
-                'Field': ['File Name', 'Generated At', 'Total Samples', 'Analysis Date'],
-                'Value': [str(file_name), str(datetime.now().strftime('%Y-%m-%d %H:%M:%S')), int(len(df_export)), str(datetime.now().date())]
-            }
-            pd.DataFrame(metadata).to_excel(writer, sheet_name='Metadata', index=False)
-        
-        buffer.seek(0)
-        return buffer
-    
+            now = datetime.now()
+            metadata_rows = [
+                ["Field", "Value"],
+                ["File Name", str(file_name)],
+                ["Generated At", now.strftime('%Y-%m-%d %H:%M:%S')],
+                ["Total Samples", total],
+                ["Analysis Date", str(now.date())],
+            ]
+
+            for index, rows in enumerate([stats_rows, risk_rows, metadata_rows], start=2):
+                zf.writestr(f"xl/worksheets/sheet{index}.xml", sheet_head + _xlsx_small_sheet(rows) + sheet_tail)
+        yield sink.drain()
+
     except Exception as e:
         print(f"Error creating Excel file: {e}")
-        import traceback
         traceback.print_exc()
         raise
 
 
-def generate_leaflet_map_html(df_hmpi: pd.DataFrame, file_id: str) -> str:
-    import json
+def export_to_excel(df_hmpi: pd.DataFrame, file_name: str) -> BytesIO:
+    """
+    Export data to Excel with multiple sheets, collected into an in-memory buffer.
+    Endpoints should stream iter_excel_export directly instead.
+    """
+    buffer = BytesIO(b"".join(iter_excel_export(df_hmpi, file_name)))
+    buffer.seek(0)
+    return buffer
 
-    features = []
 
-    for _, row in df_hmpi.iterrows():
-        lat = row.get("Latitude")
-        lon = row.get("Longitude")
-        hmpi = row.get("HMPI")
-        sample_id = row.get("Sample_ID", "Unknown")
+# ========== MAP EXPORT CLUSTERING ==========
 
-        if pd.isna(lat) or pd.isna(lon):
-            continue
+# Above this many located samples the "auto" map mode switches to clustering
+MAP_CLUSTER_THRESHOLD = 2000
+# ?mode= values accepted by /download_map_html ("cluster" is short for "clustered")
+MAP_MODES = {"auto": "auto", "cluster": "clustered", "clustered": "clustered", "points": "points"}
+# Deepest zoom that gets a precomputed cluster level; beyond it raw points are shown
+MAP_MAX_CLUSTER_ZOOM = 16
+# Grid cell size (screen pixels) used when merging points at each zoom
+MAP_CLUSTER_RADIUS_PX = 60
 
-        if pd.isna(hmpi):
-            risk = "Unknown"
-            color = "#9e9e9e"
-        elif hmpi <= 60:
-            risk = "Safe"
-            color = "#2ecc71"
-        elif hmpi <= 100:
-            risk = "Moderate"
-            color = "#f39c12"
-        else:
-            risk = "High"
-            color = "#e74c3c"
-
-        metals = {}
-        for col in df_hmpi.columns:
-            if col not in ["Sample_ID", "Latitude", "Longitude", "HMPI"] and \
-               not str(col).endswith(("_Qi", "_Wi", "_SIi")):
-                val = row.get(col)
-                if pd.notna(val):
-                    try:
-                        metals[col] = round(float(val), 4)
-                    except:
-                        pass
 
-        features.append({
-            "lat": float(lat),
-            "lon": float(lon),
-            "sample_id": sample_id,
-            "hmpi": round(float(hmpi), 4) if pd.notna(hmpi) else 0,
-            "risk": risk,
-            "color": color,
-            "metals": metals
+def lonlat_to_mercator(lon, lat):
+    """Project lon/lat arrays to Web Mercator unit coordinates in [0, 1]."""
+    lat = np.clip(np.asarray(lat, dtype=float), -85.05112878, 85.05112878)
+    x = (np.asarray(lon, dtype=float) + 180.0) / 360.0
+    sin_lat = np.sin(np.radians(lat))
+    y = 0.5 - np.log((1 + sin_lat) / (1 - sin_lat)) / (4 * np.pi)
+    return x, y
+
+
+def mercator_to_lonlat(x, y):
+    lon = np.asarray(x, dtype=float) * 360.0 - 180.0
+    lat = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * np.asarray(y, dtype=float)))))
+    return lon, lat
+
+
+def build_cluster_levels(lon, lat, hmpi, max_zoom=MAP_MAX_CLUSTER_ZOOM, radius_px=MAP_CLUSTER_RADIUS_PX):
+    """
+    Hierarchical grid clustering of points for zooms max_zoom..0.
+
+    Each zoom merges the clusters of the zoom below it into grid cells of
+    radius_px screen pixels, so levels nest. Returns (levels, zoom_levels):
+    levels is a list of columnar dicts (lat, lon, count, mean, max) and
+    zoom_levels[z] is an index into levels, or None when zoom z shows the
+    raw points unchanged.
+    """
+    x, y = lonlat_to_mercator(lon, lat)
+    hmpi = np.asarray(hmpi, dtype=float)
+    valid = ~np.isnan(hmpi)
+
+    count = np.ones(len(x))
+    hmpi_sum = np.where(valid, hmpi, 0.0)
+    hmpi_count = valid.astype(float)
+    hmpi_max = np.where(valid, hmpi, -np.inf)
+
+    levels = []
+    zoom_levels = [None] * (max_zoom + 1)
+    current = None
+
+    for z in range(max_zoom, -1, -1):
+        cell = radius_px / (256.0 * 2 ** z)
+        grid_width = int(np.ceil(1.0 / cell)) + 1
+        key = np.floor(x / cell).astype(np.int64) * grid_width + np.floor(y / cell).astype(np.int64)
+        _, inverse = np.unique(key, return_inverse=True)
+        n_cells = int(inverse.max()) + 1 if len(inverse) else 0
+
+        if n_cells == len(x):
+            zoom_levels[z] = current
+            continue
+
+        new_count = np.bincount(inverse, weights=count, minlength=n_cells)
+        x = np.bincount(inverse, weights=x * count, minlength=n_cells) / new_count
+        y = np.bincount(inverse, weights=y * count, minlength=n_cells) / new_count
+        hmpi_sum = np.bincount(inverse, weights=hmpi_sum, minlength=n_cells)
+        hmpi_count = np.bincount(inverse, weights=hmpi_count, minlength=n_cells)
+        new_max = np.full(n_cells, -np.inf)
+        np.maximum.at(new_max, inverse, hmpi_max)
+        hmpi_max, count = new_max, new_count
+
+        c_lon, c_lat = mercator_to_lonlat(x, y)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = np.where(hmpi_count > 0, hmpi_sum / hmpi_count, np.nan)
+        levels.append({
+            "lat": np.round(c_lat, 5).tolist(),
+            "lon": np.round(c_lon, 5).tolist(),
+            "count": count.astype(int).tolist(),
+            "mean": [None if np.isnan(v) else round(float(v), 2) for v in mean],
+            "max": [None if not np.isfinite(v) else round(float(v), 2) for v in hmpi_max],
         })
+        current = len(levels) - 1
+        zoom_levels[z] = current
 
-    data_json = json.dumps(features)
+    return levels, zoom_levels
+
+
+def _embed_json(obj) -> str:
+    """JSON for a <script type="application/json"> block; '</' is escaped so the block cannot close early."""
+    import json
+    return json.dumps(obj, separators=(",", ":"), allow_nan=False).replace("</", "<\\/")
+
+
+def generate_leaflet_map_html(df_hmpi: pd.DataFrame, file_id: str, mode: str = "auto") -> str:
+    """
+    Build the downloadable Leaflet map.
+
+    Points are embedded column-wise (one array per field) instead of one
+    object per sample. In "clustered" mode (or "auto" above
+    MAP_CLUSTER_THRESHOLD samples) each zoom level gets a precomputed cluster
+    layer in its own JSON block, which the page only parses when that zoom is
+    first displayed; markers are drawn on a canvas for the visible area only.
+    """
+    lat = pd.to_numeric(df_hmpi["Latitude"], errors="coerce").to_numpy(dtype=float) \
+        if "Latitude" in df_hmpi.columns else np.full(len(df_hmpi), np.nan)
+    lon = pd.to_numeric(df_hmpi["Longitude"], errors="coerce").to_numpy(dtype=float) \
+        if "Longitude" in df_hmpi.columns else np.full(len(df_hmpi), np.nan)
+    located = ~(np.isnan(lat) | np.isnan(lon))
+
+    df_points = df_hmpi.loc[located]
+    lat, lon = lat[located], lon[located]
+    hmpi = pd.to_numeric(df_points["HMPI"], errors="coerce").to_numpy(dtype=float) \
+        if "HMPI" in df_points.columns else np.full(len(df_points), np.nan)
+    sample_ids = df_points["Sample_ID"].astype(str).tolist() \
+        if "Sample_ID" in df_points.columns else ["Unknown"] * len(df_points)
+
+    # Metal columns are resolved once, not per row
+    metal_names = [col for col in df_points.columns if col in STANDARD_LIMITS]
+    metals = {}
+    for col in metal_names:
+        values = np.round(pd.to_numeric(df_points[col], errors="coerce").to_numpy(dtype=float), 4)
+        metals[col] = [None if np.isnan(v) else float(v) for v in values]
+
+    points = {
+        "lat": np.round(lat, 6).tolist(),
+        "lon": np.round(lon, 6).tolist(),
+        "id": sample_ids,
+        "hmpi": [None if np.isnan(v) else round(float(v), 4) for v in hmpi],
+        "metals": metals,
+    }
+
+    use_clusters = mode == "clustered" or (mode == "auto" and len(points["lat"]) > MAP_CLUSTER_THRESHOLD)
+    if use_clusters and len(points["lat"]) > 1:
+        levels, zoom_levels = build_cluster_levels(lon, lat, hmpi)
+    else:
+        levels, zoom_levels = [], []
+
+    meta = {
+        "total": len(points["lat"]),
+        "bounds": [[float(lat.min()), float(lon.min())], [float(lat.max()), float(lon.max())]] if len(lat) else None,
+        "zoom_levels": zoom_levels,
+        "level_count": len(levels),
+        "thresholds": list(RISK_THRESHOLDS),
+        "labels": list(RISK_SHORT_LABELS),
+        "colors": list(RISK_COLORS),
+    }
+
+    level_blocks = "\n".join(
+        f'<script type="application/json" id="hmpi-level-{i}">{_embed_json(level)}</script>'
+        for i, level in enumerate(levels)
+    )
+    points_block = f'<script type="application/json" id="hmpi-points">{_embed_json(points)}</script>'
+    meta_json = _embed_json(meta)
 
     return f"""
 <!DOCTYPE html>
@@ -1934,11 +3527,30 @@ html, body {{
 
 </div>
 
+{points_block}
+{level_blocks}
+
 <script>
 
-const data = {data_json};
+const meta = {meta_json};
+const levelCache = {{}};
+
+// Cluster levels and raw points are parsed lazily, the first time they are needed
+function loadBlock(id) {{
+    if (!(id in levelCache)) {{
+        levelCache[id] = JSON.parse(document.getElementById(id).textContent);
+    }}
+    return levelCache[id];
+}}
+
+function riskOf(hmpi) {{
+    if (hmpi === null || hmpi === undefined) return ["Unknown", "#9e9e9e"];
+    if (hmpi <= meta.thresholds[0]) return [meta.labels[0], meta.colors[0]];
+    if (hmpi <= meta.thresholds[1]) return [meta.labels[1], meta.colors[1]];
+    return [meta.labels[2], meta.colors[2]];
+}}
 
-const map = L.map('map').setView([28.45, 77.02], 12);
+const map = L.map('map', {{ preferCanvas: true }}).setView([28.45, 77.02], 12);
 
 // Professional Light Basemap
 L.tileLayer('https://{{s}}.basemaps.cartocdn.com/light_all/{{z}}/{{x}}/{{y}}{{r}}.png', {{
@@ -1946,49 +3558,79 @@ L.tileLayer('https://{{s}}.basemaps.cartocdn.com/light_all/{{z}}/{{x}}/{{y}}{{r}
     maxZoom: 19
 }}).addTo(map);
 
-let bounds = [];
-
-data.forEach(sample => {{
-
-    const marker = L.marker([sample.lat, sample.lon], {{
-        icon: L.divIcon({{
-            className: '',
-            html: `<div style="
-                width: 14px;
-                height: 14px;
-                background: ${{sample.color}};
-                border-radius: 50%;
-                border: 2px solid white;
-                box-shadow: 0 0 6px rgba(0,0,0,0.4);
-            "></div>`,
-            iconSize: [14,14]
-        }})
-    }}).addTo(map);
+const renderer = L.canvas({{ padding: 0.5 }});
+const layer = L.layerGroup().addTo(map);
 
+function pointPopup(data, i) {{
+    const hmpi = data.hmpi[i];
     let metalHtml = "";
-    if(sample.metals && Object.keys(sample.metals).length > 0) {{
+    const names = Object.keys(data.metals);
+    if (names.length > 0) {{
         metalHtml += "<hr>";
-        Object.entries(sample.metals).forEach(([k,v]) => {{
-            metalHtml += "<b>" + k + ":</b> " + v + " mg/L<br>";
+        names.forEach(k => {{
+            const v = data.metals[k][i];
+            if (v !== null) metalHtml += "<b>" + k + ":</b> " + v + " mg/L<br>";
         }});
     }}
+    return "<b>" + data.id[i] + "</b><br>" +
+        "HMPI: <b>" + (hmpi === null ? "N/A" : hmpi) + "</b><br>" +
+        "Risk: <b>" + riskOf(hmpi)[0] + "</b>" +
+        metalHtml;
+}}
 
-    marker.bindPopup(
-        "<b>" + sample.sample_id + "</b><br>" +
-        "HMPI: <b>" + sample.hmpi + "</b><br>" +
-        "Risk: <b>" + sample.risk + "</b>" +
-        metalHtml
-    );
+function render() {{
+    layer.clearLayers();
+    const z = map.getZoom();
+    const levelIndex = z < meta.zoom_levels.length ? meta.zoom_levels[z] : null;
+    const view = map.getBounds().pad(0.2);
+
+    if (levelIndex === null || levelIndex === undefined) {{
+        const data = loadBlock("hmpi-points");
+        for (let i = 0; i < data.lat.length; i++) {{
+            if (!view.contains([data.lat[i], data.lon[i]])) continue;
+            L.circleMarker([data.lat[i], data.lon[i]], {{
+                renderer: renderer,
+                radius: 7,
+                color: "white",
+                weight: 2,
+                fillColor: riskOf(data.hmpi[i])[1],
+                fillOpacity: 1
+            }}).bindPopup(() => pointPopup(data, i)).addTo(layer);
+        }}
+        return;
+    }}
 
-    bounds.push([sample.lat, sample.lon]);
+    const level = loadBlock("hmpi-level-" + levelIndex);
+    for (let i = 0; i < level.lat.length; i++) {{
+        if (!view.contains([level.lat[i], level.lon[i]])) continue;
+        const count = level.count[i];
+        const marker = L.circleMarker([level.lat[i], level.lon[i]], {{
+            renderer: renderer,
+            radius: count > 1 ? 8 + 4 * Math.log10(count) : 7,
+            color: "white",
+            weight: 2,
+            fillColor: riskOf(level.max[i])[1],
+            fillOpacity: 0.85
+        }}).addTo(layer);
+        marker.bindTooltip(String(count), {{ permanent: count > 1, direction: "center", className: "" }});
+        marker.bindPopup(
+            "<b>" + count + " samples</b><br>" +
+            "Mean HMPI: <b>" + (level.mean[i] === null ? "N/A" : level.mean[i]) + "</b><br>" +
+            "Max HMPI: <b>" + (level.max[i] === null ? "N/A" : level.max[i]) + "</b><br>" +
+            "Risk (max): <b>" + riskOf(level.max[i])[0] + "</b>"
+        );
+        marker.on("dblclick", () => map.setView([level.lat[i], level.lon[i]], Math.min(z + 2, 19)));
+    }}
+}}
 
-}});
+map.on("moveend", render);
 
-if(bounds.length > 0) {{
-    map.fitBounds(bounds, {{ padding: [40,40] }});
+if (meta.bounds) {{
+    map.fitBounds(meta.bounds, {{ padding: [40,40] }});
 }}
+render();
 
-document.getElementById("count").innerText = data.length;
+document.getElementById("count").innerText = meta.total;
 
 </script>
 
@@ -2002,6 +3644,11 @@ def download_map_html(file_id):
     Download an interactive HTML map for HMPI data - fully self-contained, no external dependencies.
     """
     try:
+        # Map mode: auto | cluster(ed) | points
+        map_mode = MAP_MODES.get(request.args.get("mode", "auto"))
+        if map_mode is None:
+            return jsonify({'error': 'mode must be one of auto, cluster, points'}), 400
+
         # Fetch the sample document
         doc = samples_collection.find_one({'_id': file_id})
         if not doc:
@@ -2032,10 +3679,10 @@ def download_map_html(file_id):
             return jsonify({'error': 'No heavy metal data found'}), 400
 
         # Compute HMPI
-        df_hmpi = compute_hmpi_vectorized(df, metal_cols)
+        df_hmpi = compute_hmpi_vectorized(df, metal_cols, unit_factors=upload_unit_factors(doc))
 
         # Generate HTML map
-        html_content = generate_leaflet_map_html(df_hmpi, file_id)
+        html_content = generate_leaflet_map_html(df_hmpi, file_id, map_mode)
 
         return Response(
             html_content,
@@ -2049,49 +3696,623 @@ def download_map_html(file_id):
         return jsonify({'error': str(e)}), 500
 
 
-@app.route("/hmpi-charts-csv", methods=["POST"])
-def hmpi_charts_csv():
+# ========== HEATMAP TILES ==========
+
+TILE_SIZE = 256
+TILE_CACHE_DIR = os.getenv("TILE_CACHE_DIR", "tile_cache")
+# Kernel radius in screen pixels, matching the radius of the Plotly density heatmap
+TILE_KERNEL_RADIUS = 30
+TILE_STYLES = ("density", "max")
+# Uploads whose projected points are kept in memory for tile and grid rendering
+POINT_CACHE_SIZE = 8
+# Above this many located samples /charts only returns the tile URL, not a Plotly heatmap
+HEATMAP_POINT_LIMIT = 5000
+
+_point_cache = OrderedDict()
+_point_cache_lock = threading.Lock()
+
+
+def load_upload_points(file_id):
+    """
+    Located samples of an upload as arrays (lon, lat, Web Mercator x/y, HMPI, metals),
+    sorted by mercator x. Kept in a small LRU so tiles of the same upload reuse them.
+    """
+    with _point_cache_lock:
+        if file_id in _point_cache:
+            _point_cache.move_to_end(file_id)
+            return _point_cache[file_id]
+
+    lon, lat, hmpi, sample_ids, conc = [], [], [], [], []
+    for batch in iter_upload_features(file_id):
+        for feature in batch:
+            coords = (feature.get('geometry') or {}).get('coordinates') or [None, None]
+            lon.append(coords[0] if len(coords) > 0 and coords[0] is not None else np.nan)
+            lat.append(coords[1] if len(coords) > 1 and coords[1] is not None else np.nan)
+            hmpi.append(feature.get('HMPI') if feature.get('HMPI') is not None else np.nan)
+            sample_ids.append(feature.get('Sample_ID'))
+            conc.append(feature.get('all_metal_conc') or {})
+
+    if not sample_ids:
+        return None
+
+    lon = np.asarray(lon, dtype=float)
+    lat = np.asarray(lat, dtype=float)
+    hmpi = np.asarray(hmpi, dtype=float)
+    located = ~(np.isnan(lon) | np.isnan(lat))
+    metals = pd.DataFrame.from_records(conc).apply(pd.to_numeric, errors='coerce')
+
+    x, y = lonlat_to_mercator(lon[located], lat[located])
+    order = np.argsort(x, kind="stable")
+    points = {
+        "lon": lon[located][order],
+        "lat": lat[located][order],
+        "x": x[order],
+        "y": y[order],
+        "hmpi": hmpi[located][order],
+        "sample_id": np.asarray(sample_ids, dtype=object)[located][order],
+        "metals": metals.loc[located].iloc[order].reset_index(drop=True),
+        "unit_factors": upload_unit_factors(samples_collection.find_one({'_id': file_id}, {'schema.unit_factors': 1})),
+        "density_scale": {},
+    }
+
+    with _point_cache_lock:
+        _point_cache[file_id] = points
+        while len(_point_cache) > POINT_CACHE_SIZE:
+            _point_cache.popitem(last=False)
+    return points
+
+
+def encode_png(rgba: np.ndarray) -> bytes:
+    """Encode an HxWx4 uint8 array as PNG using zlib only."""
+    height, width, _ = rgba.shape
+    raw = np.zeros((height, width * 4 + 1), dtype=np.uint8)
+    raw[:, 1:] = rgba.reshape(height, width * 4)
+
+    def chunk(tag, data):
+        body = tag + data
+        return struct.pack(">I", len(data)) + body + struct.pack(">I", zlib.crc32(body) & 0xffffffff)
+
+    header = struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0)
+    return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header)
+            + chunk(b"IDAT", zlib.compress(raw.tobytes(), 6)) + chunk(b"IEND", b""))
+
+
+def _separable_filter(grid, radius, reducer):
+    """Apply a (2r+1)-wide separable filter: Gaussian-weighted sum or running max."""
+    offsets = np.arange(-radius, radius + 1)
+    if reducer == "sum":
+        weights = np.exp(-0.5 * (offsets / (radius / 2.0)) ** 2)
+    for axis in (0, 1):
+        padded = np.pad(grid, [(radius, radius) if a == axis else (0, 0) for a in (0, 1)],
+                        constant_values=0 if reducer == "sum" else -np.inf)
+        out = np.zeros_like(grid) if reducer == "sum" else np.full_like(grid, -np.inf)
+        size = grid.shape[axis]
+        for i, offset in enumerate(offsets):
+            window = padded[radius + offset: radius + offset + size] if axis == 0 \
+                else padded[:, radius + offset: radius + offset + size]
+            if reducer == "sum":
+                out += weights[i] * window
+            else:
+                np.maximum(out, window, out=out)
+        grid = out
+    return grid
+
+
+def _risk_colormap():
+    """256-entry RGBA lookup table running green → orange → red."""
+    stops = np.array([0.0, 0.5, 1.0])
+    rgb = np.array([[46, 204, 113], [243, 156, 18], [231, 76, 60]], dtype=float)
+    t = np.linspace(0, 1, 256)
+    lut = np.zeros((256, 4), dtype=np.uint8)
+    for c in range(3):
+        lut[:, c] = np.interp(t, stops, rgb[:, c]).astype(np.uint8)
+    lut[:, 3] = np.clip(60 + t * 180, 0, 255).astype(np.uint8)
+    return lut
+
+
+TILE_COLORMAP = _risk_colormap()
+
+
+def _density_scale(points, z, radius):
+    """Peak weighted density at zoom z, so every tile of one zoom shares a colour scale."""
+    scale = points["density_scale"].get(z)
+    if scale is None:
+        world = TILE_SIZE * 2 ** z
+        cells = (np.floor(points["x"] * world / radius).astype(np.int64) * (world // radius + 2)
+                 + np.floor(points["y"] * world / radius).astype(np.int64))
+        _, inverse = np.unique(cells, return_inverse=True)
+        weights = np.nan_to_num(points["hmpi"], nan=0.0)
+        scale = float(np.bincount(inverse, weights=weights).max()) if len(weights) else 0.0
+        points["density_scale"][z] = scale
+    return scale
+
+
+def render_hmpi_tile(points, z, x, y, style="density", radius=TILE_KERNEL_RADIUS) -> bytes:
+    """Rasterize one XYZ tile of the HMPI surface with vectorized binning."""
+    world = TILE_SIZE * 2 ** z
+    size = TILE_SIZE + 2 * radius
+
+    # Points are sorted by mercator x, so the tile's column range is two binary searches
+    x0 = (x * TILE_SIZE - radius) / world
+    x1 = ((x + 1) * TILE_SIZE + radius) / world
+    lo, hi = np.searchsorted(points["x"], [x0, x1])
+    px = points["x"][lo:hi] * world - x * TILE_SIZE + radius
+    py = points["y"][lo:hi] * world - y * TILE_SIZE + radius
+    values = points["hmpi"][lo:hi]
+    keep = (py >= 0) & (py < size) & ~np.isnan(values)
+    px, py, values = px[keep].astype(np.int64), py[keep].astype(np.int64), values[keep]
+
+    rgba = np.zeros((TILE_SIZE, TILE_SIZE, 4), dtype=np.uint8)
+    if len(values) == 0:
+        return encode_png(rgba)
+
+    flat = py * size + px
+    if style == "max":
+        grid = np.full(size * size, -np.inf)
+        np.maximum.at(grid, flat, values)
+        grid = _separable_filter(grid.reshape(size, size), radius // 3 or 1, "max")
+        grid = grid[radius:radius + TILE_SIZE, radius:radius + TILE_SIZE]
+        has_data = np.isfinite(grid)
+        # 0 → green, 60–100 → orange, ≥ 150 → red, on an absolute HMPI scale
+        level = np.clip(np.where(has_data, grid, 0) / 150.0, 0, 1)
+    else:
+        grid = np.bincount(flat, weights=values, minlength=size * size).reshape(size, size)
+        grid = _separable_filter(grid, radius, "sum")[radius:radius + TILE_SIZE, radius:radius + TILE_SIZE]
+        peak = _density_scale(points, z, radius) or 1.0
+        level = np.clip(grid / peak, 0, 1)
+        has_data = level > 0.02
+
+    rgba[:] = TILE_COLORMAP[(level * 255).astype(np.uint8)]
+    rgba[~has_data] = 0
+    return encode_png(rgba)
+
+
+@app.route("/tiles/<file_id>/<int:z>/<int:x>/<int:y>.png", methods=["GET"])
+def get_hmpi_tile(file_id, z, x, y):
+    """XYZ raster tile of the HMPI heatmap (?style=density|max), cached on disk."""
     try:
-        data = request.json
-        geojson_data = data.get("GeoJSON") or data.get("file_data")
-        if not geojson_data:
-            return jsonify({"error": "GeoJSON not provided"}), 400
+        style = request.args.get("style", "density")
+        if style not in TILE_STYLES:
+            return jsonify({"error": f"Unknown style '{style}'"}), 400
+        if not re.fullmatch(r"[\w-]+", file_id) or not (0 <= z <= 22) or not (0 <= x < 2 ** z and 0 <= y < 2 ** z):
+            return jsonify({"error": "Invalid tile address"}), 400
+
+        tile_path = os.path.join(TILE_CACHE_DIR, file_id, style, str(z), str(x), f"{y}.png")
+        if not os.path.exists(tile_path):
+            points = load_upload_points(file_id)
+            if points is None:
+                return jsonify({"error": "File not found"}), 404
+
+            png = render_hmpi_tile(points, z, x, y, style)
+            os.makedirs(os.path.dirname(tile_path), exist_ok=True)
+            tmp_path = f"{tile_path}.{uuid.uuid4().hex}.tmp"
+            with open(tmp_path, "wb") as fh:
+                fh.write(png)
+            os.replace(tmp_path, tile_path)
+
+        response = send_file(os.path.abspath(tile_path), mimetype="image/png")
+        response.headers["Cache-Control"] = "public, max-age=86400"
+        return response
+
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({"error": str(e)}), 500
+
+
+# ========== IDW INTERPOLATION GRIDS ==========
+
+GRID_CACHE_DIR = os.getenv("GRID_CACHE_DIR", "grid_cache")
+GRID_MAX_CELLS = 4000 * 4000
+# Neighbours allowed per grid cell (?k=)
+GRID_MAX_NEIGHBOURS = 64
+# Cell x neighbour entries evaluated per KD-tree query block, bounding the k-neighbour arrays
+GRID_BLOCK_CELLS = 65536 * 12
+
+
+def _interpolation_source(points, variable):
+    """KD-tree and values for one variable (HMPI or a metal), cached on the upload's point arrays."""
+    trees = points.setdefault("trees", {})
+    if variable not in trees:
+        if variable == "HMPI":
+            values = points["hmpi"]
+        elif variable in points["metals"].columns:
+            values = points["metals"][variable].to_numpy(dtype=float)
+        else:
+            return None
+        valid = ~np.isnan(values)
+        xy = np.column_stack([points["x"][valid], points["y"][valid]])
+        trees[variable] = (cKDTree(xy), values[valid]) if valid.any() else None
+    return trees[variable]
+
+
+def idw_grid(tree, values, bbox, width, height, k=12, power=2.0):
+    """
+    Inverse-distance-weighted surface on a north-up lon/lat grid.
+
+    bbox is (min_lon, min_lat, max_lon, max_lat); cell centres are projected to
+    Web Mercator (the space the tree was built in) and evaluated in blocks of
+    GRID_BLOCK_CELLS // k cells so the neighbour arrays stay bounded.
+    """
+    min_lon, min_lat, max_lon, max_lat = bbox
+    k = max(1, min(int(k), len(values)))
+    lons = min_lon + (np.arange(width) + 0.5) * (max_lon - min_lon) / width
+    lats = max_lat - (np.arange(height) + 0.5) * (max_lat - min_lat) / height
+    gx, _ = lonlat_to_mercator(lons, np.zeros_like(lons))
+    _, gy = lonlat_to_mercator(np.zeros_like(lats), lats)
+
+    grid = np.empty(width * height, dtype=np.float32)
+    block_cells = max(1, GRID_BLOCK_CELLS // k)
+    for start in range(0, width * height, block_cells):
+        cells = np.arange(start, min(start + block_cells, width * height))
+        qx, qy = gx[cells % width], gy[cells // width]
+        dist, idx = tree.query(np.column_stack([qx, qy]), k=k, workers=-1)
+        if k == 1:
+            dist, idx = dist[:, None], idx[:, None]
+        neighbour_values = values[idx]
+        exact = dist[:, 0] == 0
+        with np.errstate(divide="ignore"):
+            weights = 1.0 / np.power(dist, power)
+        weights[exact] = 0
+        weights[exact, 0] = 1
+        grid[cells[0]:cells[-1] + 1] = (weights * neighbour_values).sum(axis=1) / weights.sum(axis=1)
+    return grid.reshape(height, width)
+
+
+@app.route("/interpolate/<file_id>", methods=["GET"])
+def interpolate_surface(file_id):
+    """
+    Continuous IDW surface of HMPI (or ?variable=<Metal>) over a grid.
+
+    Query: width, height (cells), bbox=min_lon,min_lat,max_lon,max_lat
+    (defaults to the sample extent), k, power, format=png|json.
+    Grids are cached on disk per parameter set.
+    """
+    try:
+        variable = request.args.get("variable", "HMPI")
+        width = int(request.args.get("width", 500))
+        height = int(request.args.get("height", width))
+        k = int(request.args.get("k", 12))
+        power = float(request.args.get("power", 2))
+        out_format = request.args.get("format", "png")
+
+        if width <= 0 or height <= 0 or width * height > GRID_MAX_CELLS:
+            return jsonify({"error": f"Grid must have between 1 and {GRID_MAX_CELLS} cells"}), 400
+        if not 1 <= k <= GRID_MAX_NEIGHBOURS:
+            return jsonify({"error": f"k must be between 1 and {GRID_MAX_NEIGHBOURS}"}), 400
+        if out_format not in ("png", "json"):
+            return jsonify({"error": "format must be png or json"}), 400
+        if not re.fullmatch(r"[\w-]+", file_id):
+            return jsonify({"error": "Invalid file id"}), 400
+
+        points = load_upload_points(file_id)
+        if points is None:
+            return jsonify({"error": "File not found"}), 404
+        source = _interpolation_source(points, variable)
+        if source is None:
+            return jsonify({"error": f"No located values for '{variable}'"}), 400
+        tree, values = source
+
+        if request.args.get("bbox"):
+            bbox = tuple(float(v) for v in request.args["bbox"].split(","))
+            if len(bbox) != 4 or bbox[0] >= bbox[2] or bbox[1] >= bbox[3]:
+                return jsonify({"error": "bbox must be min_lon,min_lat,max_lon,max_lat"}), 400
+        else:
+            bbox = (float(points["lon"].min()), float(points["lat"].min()),
+                    float(points["lon"].max()), float(points["lat"].max()))
+            if bbox[0] == bbox[2] or bbox[1] == bbox[3]:
+                bbox = (bbox[0] - 0.01, bbox[1] - 0.01, bbox[2] + 0.01, bbox[3] + 0.01)
+
+        params = json.dumps([variable, width, height, [round(v, 8) for v in bbox], k, power])
+        cache_key = hashlib.sha1(params.encode("utf-8")).hexdigest()
+        cache_path = os.path.join(GRID_CACHE_DIR, file_id, f"{cache_key}.npy")
+        if os.path.exists(cache_path):
+            grid = np.load(cache_path)
+        else:
+            grid = idw_grid(tree, values, bbox, width, height, k=k, power=power)
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            tmp_path = f"{cache_path}.{uuid.uuid4().hex}.tmp.npy"
+            np.save(tmp_path, grid)
+            os.replace(tmp_path, cache_path)
+
+        bounds_header = ",".join(str(v) for v in bbox)
+        if out_format == "json":
+            # GeoTIFF-style affine transform: (x0, dx, 0, y0, 0, -dy), north-up, float32 little-endian
+            return jsonify({
+                "variable": variable,
+                "width": width,
+                "height": height,
+                "bbox": list(bbox),
+                "transform": [bbox[0], (bbox[2] - bbox[0]) / width, 0, bbox[3], 0, -(bbox[3] - bbox[1]) / height],
+                "dtype": "float32",
+                "min": float(np.nanmin(grid)),
+                "max": float(np.nanmax(grid)),
+                "values": base64.b64encode(grid.astype("<f4").tobytes()).decode("ascii"),
+            }), 200
+
+        # Colour on an absolute scale: HMPI 150, or 1.5x the standard limit for a metal
+        full_scale = 150.0 if variable == "HMPI" else 1.5 * STANDARD_LIMITS.get(variable, float(np.nanmax(grid)) or 1.0)
+        level = np.clip(np.nan_to_num(grid / full_scale), 0, 1)
+        rgba = TILE_COLORMAP[(level * 255).astype(np.uint8)]
+        return Response(
+            encode_png(rgba),
+            mimetype="image/png",
+            headers={"X-Bounds": bounds_header, "Cache-Control": "public, max-age=86400"}
+        )
+
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({"error": str(e)}), 500
+
+
+# ========== HOTSPOT ANALYSIS (Getis-Ord Gi*) ==========
+
+EARTH_RADIUS_M = 6371008.8
+# Two-sided z thresholds for 99 / 95 / 90 % confidence
+GI_CONFIDENCE_LEVELS = ((2.576, 99), (1.960, 95), (1.645, 90))
+# Default neighbour band: this percentile of the nearest-neighbour distances
+HOTSPOT_BAND_PERCENTILE = 95
+# Neighbour pairs a band may produce before the request is refused
+HOTSPOT_MAX_PAIRS = 5_000_000
+# Neighbour graphs kept per upload (the default band plus recent ?distance values)
+HOTSPOT_GRAPH_CACHE_SIZE = 4
+
+
+def _upload_variable(points, variable):
+    """Values of HMPI, a metal concentration or a metal's <Metal>_SIi for the upload's located samples."""
+    if variable == "HMPI":
+        return points["hmpi"]
+    metals = points["metals"]
+    if variable in metals.columns:
+        return metals[variable].to_numpy(dtype=float)
+    if variable.endswith("_SIi"):
+        if "indices" not in points:
+            metal_cols = {m: m for m in metals.columns if m in STANDARD_LIMITS}
+            points["indices"] = compute_hmpi_vectorized(metals, metal_cols, unit_factors=points.get("unit_factors"))
+        if variable in points["indices"].columns:
+            return points["indices"][variable].to_numpy(dtype=float)
+    return None
+
 
-        rows = []
-        for sample in geojson_data:
-            sample_id = sample.get("Sample_ID", "Unknown")
-            conc = sample.get("all_metal_conc", {})
-            limits = {metal: STANDARD_LIMITS.get(metal, 0) for metal in conc.keys()}
+def distance_band_graph(points, distance_m=None):
+    """
+    Binary distance-band weights (self included, as Gi* requires) as a CSR matrix.
+
+    Samples are placed on the sphere in metres so the band is a true distance.
+    Without a band, the HOTSPOT_BAND_PERCENTILE nearest-neighbour distance is
+    used, so one remote sample cannot widen the band for everyone; samples with
+    no neighbour inside the band are linked to their nearest one instead.
+    Bands that would pair up more than HOTSPOT_MAX_PAIRS samples raise
+    ValueError. The default graph and the last few requested bands are cached
+    on the upload's point arrays.
+    """
+    graphs = points.setdefault("neighbour_graphs", OrderedDict())
+    if "sphere_tree" not in points:
+        lat, lon = np.radians(points["lat"]), np.radians(points["lon"])
+        xyz = EARTH_RADIUS_M * np.column_stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)])
+        points["sphere_tree"] = cKDTree(xyz)
+        dist, idx = points["sphere_tree"].query(xyz, k=2, workers=-1)
+        points["nearest"] = (dist[:, 1], idx[:, 1])
+    tree = points["sphere_tree"]
+    nearest_dist, nearest_idx = points["nearest"]
+
+    default = distance_m is None
+    if default:
+        distance_m = float(np.percentile(nearest_dist, HOTSPOT_BAND_PERCENTILE)) * 1.0001
+
+    key = "default" if default else round(float(distance_m), 3)
+    if key in graphs:
+        graphs.move_to_end(key)
+        return graphs[key], distance_m
+
+    # count_neighbors counts ordered pairs plus each sample with itself
+    pair_count = (int(tree.count_neighbors(tree, distance_m)) - tree.n) // 2
+    if pair_count > HOTSPOT_MAX_PAIRS:
+        raise ValueError(f"A {distance_m:.0f} m band links {pair_count} sample pairs "
+                         f"(limit {HOTSPOT_MAX_PAIRS}); use a smaller ?distance")
+
+    pairs = tree.query_pairs(distance_m, output_type="ndarray")
+    n = tree.n
+    isolated = np.flatnonzero(nearest_dist > distance_m)
+    rows = np.concatenate([pairs[:, 0], pairs[:, 1], isolated, nearest_idx[isolated], np.arange(n)])
+    cols = np.concatenate([pairs[:, 1], pairs[:, 0], nearest_idx[isolated], isolated, np.arange(n)])
+    graph = sparse.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(n, n))
+    # Pairs added from both ends of an isolated sample's link are summed; weights stay binary
+    graph.data[:] = 1.0
+
+    graphs[key] = graph
+    while len(graphs) > HOTSPOT_GRAPH_CACHE_SIZE:
+        graphs.popitem(last=False)
+    return graph, distance_m
+
+
+def getis_ord_gi_star(weights, values):
+    """Gi* z-scores and two-sided p-values for values under a (binary) sparse weight matrix."""
+    n = len(values)
+    mean = values.mean()
+    s = np.sqrt((values ** 2).mean() - mean ** 2)
+    w_sum = np.asarray(weights.sum(axis=1)).ravel()
+    w_sq_sum = np.asarray(weights.multiply(weights).sum(axis=1)).ravel()
+
+    numerator = weights @ values - mean * w_sum
+    denominator = s * np.sqrt(np.maximum(n * w_sq_sum - w_sum ** 2, 0) / (n - 1))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        z = np.where(denominator > 0, numerator / denominator, 0.0)
+    p = special.erfc(np.abs(z) / np.sqrt(2))
+    return z, p
+
+
+@app.route("/hotspots/<file_id>", methods=["GET"])
+def get_hotspots(file_id):
+    """
+    Hot and cold spots of HMPI (or ?variable=<Metal> / <Metal>_SIi) as GeoJSON.
+
+    ?distance=<metres> sets the neighbour band; ?all=1 also returns
+    samples that are not significant.
+    """
+    try:
+        variable = request.args.get("variable", "HMPI")
+        distance_m = request.args.get("distance", type=float)
+        include_all = request.args.get("all", "0") in ("1", "true")
+        if "distance" in request.args and (distance_m is None or not math.isfinite(distance_m) or distance_m <= 0):
+            return jsonify({"error": "distance must be a positive number of metres"}), 400
+
+        points = load_upload_points(file_id)
+        if points is None:
+            return jsonify({"error": "File not found"}), 404
+        if len(points["x"]) < 3:
+            return jsonify({"error": "At least 3 located samples are required"}), 400
 
-            row = {"Sample_ID": sample_id}
+        values = _upload_variable(points, variable)
+        if values is None:
+            return jsonify({"error": f"Unknown variable '{variable}'"}), 400
 
-            # Bar/Radar chart data (rounding to 4 decimals)
-            for metal, value in conc.items():
-                row[f"{metal}_Actual"] = round(float(value), 4) if value is not None else None
-                row[f"{metal}_Limit"] = round(float(limits.get(metal, 0)), 4)
+        weights, distance_m = distance_band_graph(points, distance_m)
+        valid = ~np.isnan(values)
+        if valid.sum() < 3:
+            return jsonify({"error": f"Not enough values for '{variable}'"}), 400
+        if not valid.all():
+            weights = weights[valid][:, valid]
+        z, p = getis_ord_gi_star(weights, values[valid])
 
-            # Pie chart data (just actuals, rounded)
-            row["Pie_Values"] = ",".join([f"{float(v):.4f}" for v in conc.values() if v is not None])
+        lon, lat = points["lon"][valid], points["lat"][valid]
+        sample_ids = points["sample_id"][valid]
+        vals = values[valid]
 
-            # Heatmap (round correlations too)
-            if len(conc) > 1:
-                df = pd.DataFrame([conc])
-                corr = df.corr().round(4)  # round correlations to 4 decimals
-                row["Heatmap"] = corr.to_csv(index=True, float_format="%.4f")
+        features = []
+        counts = {"hot": 0, "cold": 0}
+        for i in range(len(z)):
+            confidence = next((level for threshold, level in GI_CONFIDENCE_LEVELS if abs(z[i]) >= threshold), 0)
+            if confidence:
+                kind = "hot" if z[i] > 0 else "cold"
+                counts[kind] += 1
+                category = f"{'Hot' if kind == 'hot' else 'Cold'} Spot - {confidence}% Confidence"
+            elif include_all:
+                category = "Not Significant"
             else:
-                row["Heatmap"] = "1.0000"
+                continue
+            features.append({
+                "type": "Feature",
+                "geometry": {"type": "Point", "coordinates": [float(lon[i]), float(lat[i])]},
+                "properties": {
+                    "sample_id": str(sample_ids[i]),
+                    "value": round(float(vals[i]), 4),
+                    "gi_z": round(float(z[i]), 4),
+                    "p_value": round(float(p[i]), 6),
+                    "confidence": confidence,
+                    "category": category
+                }
+            })
+
+        return jsonify({
+            "type": "FeatureCollection",
+            "features": features,
+            "variable": variable,
+            "distance_band_m": round(float(distance_m), 2),
+            "hot_spots": counts["hot"],
+            "cold_spots": counts["cold"]
+        }), 200
+
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({"error": str(e)}), 500
+
+
+CHARTS_CSV_CHUNK_ROWS = 5000
+
+
+def pairwise_correlation(values):
+    """
+    Pearson correlation between the columns of `values` (samples x metals), each
+    pair over the samples where both are present -- the same result as
+    DataFrame.corr(), from a handful of matrix products.
+    """
+    present = np.isfinite(values)
+    x = np.where(present, values, 0.0)
+    m = present.astype(float)
+
+    n = m.T @ m                      # samples where both i and j are present
+    sum_x = x.T @ m                  # sum of i over those samples
+    sum_xx = (x * x).T @ m           # sum of i^2 over those samples
+    sum_xy = x.T @ x
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        cov = sum_xy - sum_x * sum_x.T / n
+        var_i = sum_xx - sum_x ** 2 / n
+        corr = cov / np.sqrt(var_i * var_i.T)
+    corr[(n < 2) | (var_i <= 0) | (var_i.T <= 0)] = np.nan
+    np.fill_diagonal(corr, np.where(np.diag(n) >= 2, 1.0, np.nan))
+    return np.clip(corr, -1.0, 1.0)
+
+
+def _format_column(values):
+    """4-decimal text for a float column, blank where missing."""
+    return ["" if v != v else f"{v:.4f}" for v in np.asarray(values, dtype=float).tolist()]
 
-            rows.append(row)
 
-        # Convert all rows to DataFrame
-        csv_df = pd.DataFrame(rows)
+def _csv_text(value):
+    text = str(value)
+    if any(c in text for c in ',"\n\r'):
+        return '"' + text.replace('"', '""') + '"'
+    return text
 
-        # Write CSV with 4 decimal places
-        csv_buffer = io.StringIO()
-        csv_df.to_csv(csv_buffer, index=False, float_format="%.4f")
+
+def iter_charts_csv(sample_ids, metals, actual, chunk_rows=CHARTS_CSV_CHUNK_ROWS):
+    """
+    Per-sample Actual/Limit/Pie columns, then a blank line and the metal-by-metal
+    correlation matrix across all samples.
+
+    Every column is formatted once as text and rows are assembled by
+    concatenating whole columns, which is far cheaper than writing row by row.
+    """
+    present = np.isfinite(actual)
+
+    header = ["Sample_ID"]
+    columns = [np.array([_csv_text(sample_id) for sample_id in sample_ids], dtype=object)]
+    actual_text = []
+    for j, metal in enumerate(metals):
+        header += [f"{metal}_Actual", f"{metal}_Limit"]
+        actual_text.append(_format_column(actual[:, j]))
+        columns.append(np.array(actual_text[-1], dtype=object))
+        columns.append(np.where(present[:, j], f"{float(STANDARD_LIMITS.get(metal, 0)):.4f}", "").astype(object))
+
+    # Pie values: the sample's present actuals, comma-joined in metal order
+    header.append("Pie_Values")
+    pie = [",".join(filter(None, row)) for row in zip(*actual_text)] if metals else [""] * len(sample_ids)
+    columns.append(np.array([f'"{v}"' if "," in v else v for v in pie], dtype=object))
+
+    yield ",".join(_csv_text(name) for name in header) + "\n"
+    for start in range(0, len(sample_ids), chunk_rows):
+        lines = columns[0][start:start + chunk_rows]
+        for column in columns[1:]:
+            lines = lines + "," + column[start:start + chunk_rows]
+        yield "\n".join(lines.tolist()) + "\n"
+
+    corr = pairwise_correlation(actual)
+    section = ["", ",".join(["Correlation"] + [_csv_text(metal) for metal in metals])]
+    section += [",".join([_csv_text(metal)] + _format_column(corr[j])) for j, metal in enumerate(metals)]
+    yield "\n".join(section) + "\n"
+
+
+@app.route("/hmpi-charts-csv", methods=["POST"])
+def hmpi_charts_csv():
+    try:
+        data = request.json
+        geojson_data = data.get("GeoJSON") or data.get("file_data")
+        if not geojson_data:
+            return jsonify({"error": "GeoJSON not provided"}), 400
+
+        sample_ids = [sample.get("Sample_ID", "Unknown") for sample in geojson_data]
+        conc = pd.DataFrame.from_records([sample.get("all_metal_conc") or {} for sample in geojson_data])
+        metals = [str(metal) for metal in conc.columns]
+        actual = conc.apply(pd.to_numeric, errors="coerce").to_numpy(dtype=float) if metals \
+            else np.empty((len(sample_ids), 0))
 
         return Response(
-            csv_buffer.getvalue(),
+            stream_with_context(iter_charts_csv(sample_ids, metals, actual)),
             mimetype="text/csv",
             headers={"Content-Disposition": "attachment; filename=hmpi_charts.csv"}
         )
@@ -2104,10 +4325,21 @@ def hmpi_charts_csv():
 
 # ========== PREDICTIONS ENDPOINTS ==========
 
+# The predictions views use their own palette, and call the top band "Risk" on the spatial map
+PREDICTION_RISK_LABELS = ("Safe", "Moderate", "Risk")
+PREDICTION_RISK_COLORS = ("#22c55e", "#eab308", "#ef4444")
+
+PREDICTIONS_FILE = "future_hmpi_predictions_2026.csv"
+_predictions_refresh_lock = threading.Lock()
+# Sites waiting for a warm-start forecast, drained by at most one worker thread at a time
+_forecast_queue_lock = threading.Lock()
+_pending_forecast_sites = set()
+_forecast_worker = None
+
 def load_predictions_csv():
     """Load and parse predictions CSV file"""
     try:
-        predictions_file = "future_hmpi_predictions_2026.csv"
+        predictions_file = PREDICTIONS_FILE
         if not os.path.exists(predictions_file):
             return None
         df = pd.read_csv(predictions_file)
@@ -2223,22 +4455,16 @@ def get_predictions_spatial():
             "Predicted_HMPI_Ensemble": "mean"
         }).reset_index()
 
+        # Determine risk category for every sample in one pass
+        codes = risk_codes(sample_groups["Predicted_HMPI_Ensemble"])
+
         # Create features for Leaflet
         features = []
-        for _, row in sample_groups.iterrows():
+        for code, (_, row) in zip(codes, sample_groups.iterrows()):
             ensemble_val = float(row["Predicted_HMPI_Ensemble"])
             sample_id = str(row["Sample_ID"])
-
-            # Determine risk category
-            if ensemble_val <= 60:
-                risk_category = "Safe"
-                color = "#22c55e"  # Green
-            elif ensemble_val <= 100:
-                risk_category = "Moderate"
-                color = "#eab308"  # Yellow
-            else:
-                risk_category = "Risk"
-                color = "#ef4444"  # Red
+            risk_category = PREDICTION_RISK_LABELS[code]
+            color = PREDICTION_RISK_COLORS[code]
 
             # Get latest predictions for this sample
             sample_latest = latest_df[latest_df["Sample_ID"] == sample_id]
@@ -2349,16 +4575,9 @@ def get_cluster_zones():
                 continue  # skip noise
 
             avg_hmpi = cluster_points["Predicted_HMPI_Ensemble"].mean()
-
-            if avg_hmpi <= 60:
-                risk = "Safe"
-                color = "#22c55e"
-            elif avg_hmpi <= 100:
-                risk = "Moderate"
-                color = "#eab308"
-            else:
-                risk = "High"
-                color = "#ef4444"
+            code = risk_codes([avg_hmpi])[0]
+            risk = RISK_SHORT_LABELS[code]
+            color = PREDICTION_RISK_COLORS[code]
 
             clusters.append({
                 "cluster_id": int(cluster_id),
@@ -2376,18 +4595,97 @@ def get_cluster_zones():
         return jsonify({"error": str(e)}), 500
 
 
+def update_site_forecasts(site_ids):
+    """Warm-start the forecasts of sites that just got new measurements (runs off the request thread)."""
+    try:
+        with _predictions_refresh_lock:
+            result = forecasting.update_site_predictions(site_timeseries_collection, forecast_models_collection,
+                                                         PREDICTIONS_FILE, site_ids)
+        if result is not None and result.get("full_refresh"):
+            print(f"[LOG] Forecast months overtaken by new data; refitted all {result['sites']} sites in {result['elapsed_seconds']}s")
+        elif result is not None:
+            print(f"[LOG] Forecasts updated for {result['sites']} sites ({result['warm']} warm) in {result['elapsed_seconds']}s")
+    except Exception:
+        traceback.print_exc()
+
+
+def schedule_site_forecasts(site_ids):
+    """
+    Queue sites for a warm-start forecast. Uploads that land while a run is in
+    progress merge into the next run instead of each waiting on the refresh lock.
+    """
+    global _forecast_worker
+    with _forecast_queue_lock:
+        _pending_forecast_sites.update(site_ids)
+        if _forecast_worker is None:
+            # Not a daemon: shutdown waits for the in-flight run instead of killing it mid-write
+            _forecast_worker = threading.Thread(target=_drain_site_forecasts, name="site-forecasts")
+            _forecast_worker.start()
+
+
+def _drain_site_forecasts():
+    """Run forecast updates until no sites are pending, then let the next upload start a fresh worker."""
+    global _forecast_worker
+    while True:
+        with _forecast_queue_lock:
+            if not _pending_forecast_sites:
+                _forecast_worker = None
+                return
+            site_ids = sorted(_pending_forecast_sites)
+            _pending_forecast_sites.clear()
+        update_site_forecasts(site_ids)
+
+
+@app.route("/predictions/refresh", methods=["POST"])
+def refresh_predictions():
+    """
+    Re-fit the forecasting models for every site in the time-series store and
+    rewrite the predictions file. Optional JSON/form fields: horizon (months),
+    or sites (list of site ids) to warm-start just those sites from saved state.
+    """
+    if not _predictions_refresh_lock.acquire(blocking=False):
+        return jsonify({"error": "A predictions refresh is already running"}), 409
+    try:
+        payload = request.get_json(silent=True) or request.form
+        sites = payload.get("sites")
+        if sites:
+            result = forecasting.update_site_predictions(site_timeseries_collection, forecast_models_collection,
+                                                         PREDICTIONS_FILE, sites)
+            if result is None:
+                return jsonify({"error": "No saved forecast models; run a full refresh first"}), 409
+            return jsonify(result), 200
+
+        horizon = int(payload.get("horizon", forecasting.FORECAST_HORIZON))
+        if not 1 <= horizon <= 60:
+            return jsonify({"error": "horizon must be between 1 and 60 months"}), 400
+
+        result = forecasting.refresh_predictions(site_timeseries_collection, PREDICTIONS_FILE, horizon=horizon,
+                                                 model_collection=forecast_models_collection)
+        if result["rows"] == 0:
+            return jsonify({"error": "No site history to forecast from", **result}), 404
+
+        print(f"[LOG] Predictions refreshed: {result['sites']} sites in {result['elapsed_seconds']}s")
+        return jsonify(result), 200
+
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({"error": str(e)}), 500
+    finally:
+        _predictions_refresh_lock.release()
+
+
 @app.route("/predictions/csv-download", methods=["GET"])
 def download_predictions_csv():
     """Download the predictions CSV file"""
     try:
-        predictions_file = "future_hmpi_predictions_2026.csv"
+        predictions_file = PREDICTIONS_FILE
         if not os.path.exists(predictions_file):
             return jsonify({"error": "Predictions file not found"}), 404
 
         return send_file(
             predictions_file,
             as_attachment=True,
-            download_name="future_hmpi_predictions_2026.csv",
+            download_name=os.path.basename(PREDICTIONS_FILE),
             mimetype="text/csv"
         )
 
@@ -2397,5 +4695,57 @@ def download_predictions_csv():
         return jsonify({"error": str(e)}), 500
 
 
+# ========== METRICS ==========
+
+@app.route("/metrics", methods=["GET"])
+def prometheus_metrics():
+    """Stage and endpoint timings of this worker in the Prometheus text format."""
+    if not metrics.METRICS_ENABLED:
+        return jsonify({"error": "Metrics are disabled (METRICS_ENABLED=0)"}), 404
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+
+# ========== ADMIN ==========
+
+# Admin endpoints are off unless this is set; requests then need it in the X-Admin-Token header
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+
+
+def admin_refusal():
+    """The error response for a request that may not use the admin endpoints, or None."""
+    if not ADMIN_TOKEN:
+        return jsonify({"error": "Not found"}), 404
+    if not hmac.compare_digest(request.headers.get("X-Admin-Token", "").encode(), ADMIN_TOKEN.encode()):
+        return jsonify({"error": "Unauthorized"}), 401
+    return None
+
+
+@app.route("/admin/memory-profile", methods=["GET", "DELETE"])
+def memory_profile():
+    """Per-route memory aggregates of the sampled requests (DELETE clears them)."""
+    refusal = admin_refusal()
+    if refusal:
+        return refusal
+    if request.method == "DELETE":
+        memprofile.reset()
+        return jsonify({"success": True})
+    report = memprofile.summary(top=request.args.get("top", memprofile.MEMPROFILE_ROUTE_SITES, type=int))
+    if not report["sample_rate"]:
+        report["message"] = "Memory profiling is off; set MEMPROFILE_SAMPLE_RATE (0-1) to sample requests"
+    return jsonify(report)
+
+
+@app.route("/admin/mongo-stats", methods=["GET", "DELETE"])
+def mongo_stats():
+    """Mongo time and reply bytes per collection / command, slow query shapes and recent slow operations."""
+    refusal = admin_refusal()
+    if refusal:
+        return refusal
+    if request.method == "DELETE":
+        mongo_monitoring.reset()
+        return jsonify({"success": True})
+    return jsonify(mongo_monitoring.summary(limit=request.args.get("limit", 50, type=int)))
+
+
 if __name__ == '__main__':
     app.run(debug=True, port=5000)
\ No newline at end of file
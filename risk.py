@@ -0,0 +1,53 @@
+"""
+HMPI risk classification shared by proj.py and pdf_export.py.
+
+Categories are assigned index-aligned in one vectorized step, so callers
+never have to join categories back onto samples by HMPI value.
+"""
+import numpy as np
+import pandas as pd
+
+# Upper bounds (inclusive) of the Safe and Moderate bands
+RISK_THRESHOLDS = (60, 100)
+
+RISK_LABELS = ("Safe (≤60)", "Moderate (61–100)", "High (>100)")
+RISK_SHORT_LABELS = ("Safe", "Moderate", "High")
+RISK_COLORS = ("#2ecc71", "#f39c12", "#e74c3c")
+UNKNOWN_RISK_COLOR = "#9e9e9e"
+
+
+def _as_float_array(hmpi) -> np.ndarray:
+    if isinstance(hmpi, pd.Series):
+        return pd.to_numeric(hmpi, errors="coerce").to_numpy(dtype=float)
+    values = np.asarray(hmpi)
+    if values.dtype.kind in "fiub":
+        return values.astype(float).ravel()
+    return pd.to_numeric(pd.Series(values.ravel()), errors="coerce").to_numpy(dtype=float)
+
+
+def risk_codes(hmpi) -> np.ndarray:
+    """Band index per value: 0 = Safe (≤60), 1 = Moderate (60, 100], 2 = High (>100), -1 = missing."""
+    values = _as_float_array(hmpi)
+    codes = np.searchsorted(np.asarray(RISK_THRESHOLDS, dtype=float), values, side="left").astype(np.int8)
+    codes[np.isnan(values)] = -1
+    return codes
+
+
+def classify_risk(hmpi, labels=RISK_LABELS, missing=None) -> pd.Series:
+    """
+    Risk label for every value, aligned to the input's index when it is a Series.
+    Missing HMPI gets `missing` (NaN when None).
+    """
+    codes = risk_codes(hmpi)
+    index = hmpi.index if isinstance(hmpi, pd.Series) else None
+    categories = list(labels) if missing is None else list(labels) + [missing]
+    if missing is not None:
+        codes = np.where(codes < 0, len(labels), codes)
+    return pd.Series(pd.Categorical.from_codes(codes, categories=categories), index=index, name="RiskCategory")
+
+
+def risk_counts(hmpi, labels=RISK_LABELS) -> pd.Series:
+    """Number of samples per risk label (all labels present, missing HMPI excluded)."""
+    codes = risk_codes(hmpi)
+    counts = np.bincount(codes[codes >= 0], minlength=len(labels))
+    return pd.Series(counts, index=list(labels), name="count")
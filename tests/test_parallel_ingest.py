@@ -0,0 +1,62 @@
+import functools
+import io
+
+import pytest
+
+import parallel_ingest
+
+RANGE_BYTES = 16 * 1024
+
+
+def write_quoted_break_csv(path):
+    """A CSV whose only quoted field (holding a line break) starts past the quote probe."""
+    lines = ["Sample_ID,Latitude,Longitude,Lead,Note"]
+    n = 0
+    while sum(len(line) + 1 for line in lines) <= parallel_ingest.QUOTE_PROBE_BYTES + RANGE_BYTES:
+        n += 1
+        lines.append(f"S{n},12.{n % 1000:03d},77.{n % 997:03d},0.0{n % 9},plain")
+    n += 1
+    lines.append(f'S{n},12.5,77.5,0.02,"first line\nsecond line"')
+    for _ in range(200):
+        n += 1
+        lines.append(f"S{n},13.{n % 1000:03d},78.{n % 997:03d},0.0{n % 9},plain")
+    path.write_bytes(("\n".join(lines) + "\n").encode())
+    return n
+
+
+def test_quoted_line_break_after_probe_raises_split_mismatch(tmp_path):
+    path = tmp_path / "quoted.csv"
+    write_quoted_break_csv(path)
+    assert parallel_ingest.can_split_by_lines(str(path))
+
+    with pytest.raises(parallel_ingest.SplitMismatch):
+        list(parallel_ingest.iter_parallel_frames(str(path), workers=2, range_bytes=RANGE_BYTES))
+
+
+def test_upload_reinserts_serially_after_split_mismatch(tmp_path, monkeypatch):
+    mongomock = pytest.importorskip("mongomock")
+    import pdf_export
+
+    db = mongomock.MongoClient()["heavy_metal_db"]
+    monkeypatch.setattr(pdf_export, "samples_collection", db["samples"])
+    monkeypatch.setattr(pdf_export, "uploads_collection", db["uploads"])
+    monkeypatch.setattr(pdf_export, "INGEST_BATCH_SIZE", 500)
+    monkeypatch.setattr(parallel_ingest, "PARALLEL_INGEST_WORKERS", 2)
+    monkeypatch.setattr(parallel_ingest, "PARALLEL_INGEST_MIN_BYTES", 0)
+    monkeypatch.setattr(parallel_ingest, "iter_parallel_frames",
+                        functools.partial(parallel_ingest.iter_parallel_frames, workers=2, range_bytes=RANGE_BYTES))
+
+    path = tmp_path / "quoted.csv"
+    rows = write_quoted_break_csv(path)
+    response = pdf_export.app.test_client().post(
+        "/upload", data={"file": (io.BytesIO(path.read_bytes()), "quoted.csv")},
+        content_type="multipart/form-data")
+
+    assert response.status_code == 200, response.get_json()
+    assert response.get_json()["record_count"] == rows
+    upload = db["uploads"].find_one()
+    assert upload["status"] == "complete"
+    assert upload["record_count"] == rows
+    assert upload["batches_done"] == response.get_json()["batches"]
+    assert db["samples"].count_documents({}) == rows
+    assert len(db["samples"].distinct("location")) == rows